@@ -0,0 +1,124 @@
+"""Memory used by idle connections.
+
+Opens N idle connections through a port mapping, and reports the RSS
+growth of the tinap process, scaled to 10k connections. The upstream
+server and the clients run in a child process, so they are not counted.
+
+Usage: python benchmarks/bench_memory.py [--connections 10000] [--rtt 100]
+"""
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import os
+import resource
+import time
+
+from tinap.mapping import Mapping
+from tinap.util import set_logger, UPSTREAMS
+from tinap.tests.support import make_args
+
+
+def rss():
+    """Current resident set size, in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # the peak, in KB on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = min(hard, needed)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+
+def _peer(conn, count):
+    """Runs the upstream server and opens *count* client connections.
+    """
+    _raise_fd_limit(count * 2 + 500)
+
+    async def _run():
+        loop = asyncio.get_event_loop()
+        upstream = await loop.create_server(
+            asyncio.Protocol, "127.0.0.1", 0, backlog=4096
+        )
+        conn.send(upstream.sockets[0].getsockname()[1])
+        port = await loop.run_in_executor(None, conn.recv)
+        clients = []
+        for start in range(0, count, 100):
+            batch = min(100, count - start)
+            clients += await asyncio.gather(
+                *[
+                    loop.create_connection(asyncio.Protocol, "127.0.0.1", port)
+                    for i in range(batch)
+                ]
+            )
+        conn.send(len(clients))
+        await loop.run_in_executor(None, conn.recv)
+        for transport, __ in clients:
+            transport.close()
+        upstream.close()
+
+    asyncio.get_event_loop().run_until_complete(_run())
+
+
+def run(count, rtt):
+    limit = _raise_fd_limit(count * 2 + 500)
+    if limit < count * 2 + 500:
+        count = (limit - 500) // 2
+        print("File descriptors limited to %d, using %d connections" % (limit, count))
+
+    set_logger()
+    conn, child_conn = multiprocessing.Pipe()
+    peer = multiprocessing.Process(target=_peer, args=(child_conn, count))
+    peer.start()
+    loop = asyncio.get_event_loop()
+
+    async def _run():
+        upstream_port = await loop.run_in_executor(None, conn.recv)
+        mapping = Mapping(
+            "127.0.0.1", 0, "127.0.0.1", upstream_port, make_args(rtt=rtt)
+        )
+        await mapping.start()
+        gc.collect()
+        before = rss()
+        conn.send(mapping.port)
+        await loop.run_in_executor(None, conn.recv)
+        deadline = time.time() + 30
+        while len(UPSTREAMS) < count and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        connected = len(UPSTREAMS)
+        gc.collect()
+        after = rss()
+        conn.send("stop")
+        mapping.close()
+        return connected, after - before
+
+    try:
+        connected, growth = loop.run_until_complete(_run())
+    finally:
+        peer.join(timeout=10)
+    print("%d idle connections" % connected)
+    print("RSS growth: %.1f MB" % (growth / 1024.0 / 1024.0))
+    if connected:
+        per_conn = growth / float(connected)
+        print("Per connection: %.0f bytes" % per_conn)
+        print("Per 10k connections: %.1f MB" % (per_conn * 10000 / 1024.0 / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--rtt", type=float, default=100.0)
+    args = parser.parse_args()
+    run(args.connections, args.rtt)
+
+
+if __name__ == "__main__":
+    main()
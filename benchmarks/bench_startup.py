@@ -0,0 +1,166 @@
+"""Startup time.
+
+Runs the tinap command several times, and measures how long it takes to
+import tinap and to accept connections, and exits with an error when the
+median time to listening is above --budget (500ms by default).
+
+Then writes a config file with a range of N mappings, and measures how
+long it takes to load it and to bind all the listeners.
+
+Usage: python benchmarks/bench_startup.py [--mappings 1000] [--base-port 30000]
+                                          [--runs 10] [--budget MS]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tinap.config import load_config, create_mappings
+from tinap.mapping import Mappings
+from tinap.util import set_logger
+from tinap.tests.support import make_args
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CLI = """
+import sys, time
+start = time.perf_counter()
+import tinap
+print(time.perf_counter() - start, flush=True)
+sys.exit(tinap.main())
+"""
+
+
+def _wait_listening(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return time.perf_counter()
+        except OSError:
+            time.sleep(0.001)
+    raise RuntimeError("tinap is not listening on %d" % port)
+
+
+def run_cli(runs, port):
+    """Returns the median time to listening.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (ROOT, env.get("PYTHONPATH")) if path
+    )
+    command = [sys.executable, "-c", _CLI, "--port", str(port)]
+    command += ["--upstream-port", str(port + 1)]
+    imports, listening = [], []
+    for __ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        try:
+            listening.append(_wait_listening(port) - start)
+            imports.append(float(proc.stdout.readline()))
+        finally:
+            # the signal handlers are set once the listeners are bound
+            time.sleep(0.05)
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.communicate(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+
+    print("runs:      %d" % runs)
+    print("import:    %.1fms" % (statistics.median(imports) * 1000))
+    print("listening: %.1fms" % (statistics.median(listening) * 1000))
+    return statistics.median(listening)
+
+
+async def _bind(mappings, serial):
+    registry = Mappings()
+    start = time.perf_counter()
+    if serial:
+        for mapping in mappings:
+            await registry.add(mapping)
+    else:
+        await registry.add_all(mappings)
+    duration = time.perf_counter() - start
+    registry.close()
+    await registry.wait_closed()
+    return duration
+
+
+def run(count, base_port, serial):
+    # each listener is a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < count + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, count + 100), hard))
+
+    config = {
+        "profiles": {"3g": {"rtt": 300, "inkbps": 1600, "outkbps": 768}},
+        "mappings": [
+            {
+                "listen": "127.0.0.1:%d-%d" % (base_port, base_port + count - 1),
+                "upstream": "127.0.0.1:8080",
+                "profile": "3g",
+            }
+        ],
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tinap.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        start = time.perf_counter()
+        mappings = create_mappings(load_config(path), make_args())
+        parsing = time.perf_counter() - start
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        binding = loop.run_until_complete(_bind(mappings, serial))
+    finally:
+        loop.close()
+
+    print("mappings: %d (%s)" % (count, serial and "serial" or "concurrent"))
+    print("config:   %.1fms" % (parsing * 1000))
+    print("binding:  %.1fms" % (binding * 1000))
+    print("total:    %.1fms" % ((parsing + binding) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mappings", type=int, default=1000)
+    parser.add_argument("--base-port", type=int, default=30000)
+    parser.add_argument(
+        "--serial", action="store_true", help="Bind the listeners one by one."
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=500.0,
+        help="Maximum median time to listening, in ms. 0 means no check.",
+    )
+    args = parser.parse_args()
+    listening = run_cli(args.runs, args.base_port)
+    print()
+    set_logger()
+    run(args.mappings, args.base_port, args.serial)
+    if args.budget > 0 and listening * 1000 > args.budget:
+        sys.exit(
+            "Over budget: %.1fms to listening, %.1fms allowed"
+            % (listening * 1000, args.budget)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""TLS handshake rate of the DoH listener contexts.
+
+Measures full handshakes with an RSA and with an ECDSA certificate, and
+resumed handshakes with session tickets. The server runs in a child
+process, so its CPU time per handshake can be reported apart from the
+client's. Certificates are created with the openssl command.
+
+Usage: python benchmarks/bench_tls.py [--handshakes 1000]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+
+from tinap.tls import create_context
+
+
+def _create_certs(tmpdir):
+    certs = {}
+    keys = {
+        "rsa": ["-newkey", "rsa:2048"],
+        "ecdsa": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"],
+    }
+    for name, key in keys.items():
+        certfile = os.path.join(tmpdir, name + ".pem")
+        keyfile = os.path.join(tmpdir, name + "-key.pem")
+        command = ["openssl", "req", "-x509", "-nodes", "-days", "1"]
+        command += ["-subj", "/CN=tinap", "-keyout", keyfile, "-out", certfile]
+        subprocess.check_call(command + key, stderr=subprocess.DEVNULL)
+        certs[name] = certfile, keyfile
+    return certs
+
+
+class _Hello(asyncio.Protocol):
+    def connection_made(self, transport):
+        # the client reads it, and gets the session tickets with it
+        transport.write(b"x")
+
+
+def _server(conn, certs):
+    async def _run():
+        loop = asyncio.get_event_loop()
+        ports = {}
+        for name, cert in certs.items():
+            server = await loop.create_server(
+                _Hello, "127.0.0.1", 0, ssl=create_context([cert])
+            )
+            ports[name] = server.sockets[0].getsockname()[1]
+        conn.send(ports)
+        while True:
+            command = await loop.run_in_executor(None, conn.recv)
+            if command == "stop":
+                return
+            conn.send(time.process_time())
+
+    asyncio.get_event_loop().run_until_complete(_run())
+
+
+def _handshakes(port, count, resume):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    session = None
+    resumed = 0
+    for i in range(count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock = ctx.wrap_socket(sock, session=session)
+        sock.recv(1)
+        if resume:
+            session = sock.session
+        resumed += sock.session_reused
+        sock.close()
+    return resumed
+
+
+def run(count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certs = _create_certs(tmpdir)
+        conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_server, args=(child_conn, certs))
+        server.start()
+        try:
+            ports = conn.recv()
+            for name, resume in (("rsa", False), ("ecdsa", False), ("ecdsa", True)):
+                conn.send("cpu")
+                cpu = conn.recv()
+                start = time.perf_counter()
+                resumed = _handshakes(ports[name], count, resume)
+                duration = time.perf_counter() - start
+                conn.send("cpu")
+                cpu = conn.recv() - cpu
+                print(
+                    "%-6s %-8s %6.0f handshakes/s, server CPU %.3fms per handshake, %d resumed"
+                    % (
+                        name,
+                        resume and "resumed" or "full",
+                        count / duration,
+                        cpu * 1000 / count,
+                        resumed,
+                    )
+                )
+        finally:
+            conn.send("stop")
+            server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handshakes", type=int, default=1000)
+    args = parser.parse_args()
+    run(args.handshakes)
+
+
+if __name__ == "__main__":
+    main()
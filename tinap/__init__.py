@@ -6,11 +6,23 @@ import functools
 import logging
 import sys
 
-from tinap.forwarder import Forwarder
-from tinap.util import shutdown, sync_shutdown, set_logger
+from tinap.connect import Connector
+from tinap.bottleneck import DISCIPLINES
+from tinap.mapping import Mapping, Mappings, parse_port_mapping, parse_address
+from tinap.profile import REMOVE_TCP_OVERHEAD, Profile, ClientLinks  # NOQA
+from tinap.util import (
+    shutdown,
+    sync_shutdown,
+    set_logger,
+    stop_logger,
+    cancel_tasks,
+)
+from tinap.stats import STATS
+from tinap.limits import start_admission, stop_admission
+from tinap.replay import open_archive, close_archive
+from tinap.diagnostics import Diagnostics
+from tinap.api import Proxy  # NOQA
 
-# TCP overhead (value taken from tsproxy)
-REMOVE_TCP_OVERHEAD = 1460.0 / 1500.0
 _PORT_MAPPING_HELP = """\
 Comma-separated list of port forwarding rules each rule
 is composed of <source_host>:<source_port>/<target_host>:<target_port>
@@ -21,7 +33,7 @@ Example (forwards port 80 and 443 to 8080 and 8282):
 """
 
 
-def get_args():
+def get_parser():
     parser = argparse.ArgumentParser(description="Tinap port forwarder")
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose mode", default=False
@@ -36,6 +48,73 @@ def get_args():
     parser.add_argument(
         "--port-mapping", type=str, help=_PORT_MAPPING_HELP, default=None
     )
+    parser.add_argument(
+        "--udp-port-mapping",
+        type=str,
+        default=None,
+        help="Same as --port-mapping, for UDP datagrams (QUIC, DNS...)",
+    )
+    parser.add_argument(
+        "--proxy",
+        type=str,
+        default=None,
+        help="Comma-separated list of <host>:<port> addresses serving "
+        "SOCKS5 and HTTP CONNECT clients, for any upstream.",
+    )
+    parser.add_argument(
+        "--udp-timeout",
+        type=float,
+        default=30.0,
+        help="Forget UDP flows idle for that long (in seconds).",
+    )
+    parser.add_argument(
+        "--access-log",
+        type=float,
+        default=0.0,
+        help="Fraction of the connections (0 to 1) that get an access log "
+        "line with their totals when they are closed.",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        default=None,
+        help="Records the forwarded data in that pcapng file, as it's "
+        "received and as it's released by the shaping.",
+    )
+    parser.add_argument(
+        "--capture-snaplen",
+        type=int,
+        default=0,
+        help="Bytes of payload captured per chunk. 0 means everything.",
+    )
+    parser.add_argument(
+        "--capture-buffer",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Bytes of chunks waiting to be written to the capture file. "
+        "When it's full, chunks are not captured.",
+    )
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Appends the upstream responses to that archive, by request.",
+    )
+    archive.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Serves the responses recorded in that archive, without "
+        "connecting to the upstreams.",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="JSON or TOML (.toml) file describing the port mappings, "
+        "their shaping profiles and shared link groups.",
+    )
 
     parser.add_argument(
         "-r", "--rtt", type=float, default=0.0, help="Round Trip Time Latency (in ms)."
@@ -54,8 +133,237 @@ def get_args():
         default=0.0,
         help="Upload Bandwidth (in 1000 bits/s - Kbps).",
     )
+    parser.add_argument(
+        "--per-client",
+        action="store_true",
+        default=False,
+        help="Emulate one link per client address, shared by all the "
+        "connections of the client, instead of one per connection.",
+    )
+    parser.add_argument(
+        "--client-idle-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds after which the link of a client without "
+        "connections is dropped (with --per-client).",
+    )
+
+    parser.add_argument(
+        "--handshake-rtts",
+        type=float,
+        default=0.0,
+        help="Round trips added when a connection is opened, to emulate "
+        "the handshake (e.g. 1 for TCP, 2 for TCP+TLS 1.3).",
+    )
+
+    # upstream connection options
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=5.0,
+        help="Upstream connection timeout (in seconds).",
+    )
+    parser.add_argument(
+        "--connect-retries",
+        type=int,
+        default=0,
+        help="Number of times a failed upstream connection is retried.",
+    )
+    parser.add_argument(
+        "--connect-retry-delay",
+        type=float,
+        default=500.0,
+        help="Delay before the first retry, doubled for each retry (in ms).",
+    )
+    parser.add_argument(
+        "--happy-eyeballs-delay",
+        type=float,
+        default=250.0,
+        help="Delay between connection attempts to the upstream "
+        "addresses (in ms).",
+    )
+    parser.add_argument(
+        "--dns-ttl",
+        type=float,
+        default=60.0,
+        help="How long resolved upstream names are cached (in seconds).",
+    )
+    parser.add_argument(
+        "--dns-cache-size",
+        type=int,
+        default=1024,
+        help="Maximum number of cached upstream names.",
+    )
+
+    parser.add_argument(
+        "--control",
+        type=str,
+        default=None,
+        help="Unix socket path (or host:port) of the control socket, "
+        "used to change the shaping profiles and the port mappings "
+        "at runtime.",
+    )
+    parser.add_argument(
+        "--hook",
+        type=str,
+        action="append",
+        default=None,
+        help="module:factory hook called on the data of every TCP "
+        "connection, see tinap.hooks. Can be repeated.",
+    )
+    parser.add_argument(
+        "--diagnostics-dir",
+        type=str,
+        default=None,
+        help="Directory of the diagnostics written on SIGUSR1 or on the "
+        '"diagnose" control command. Default: the temporary directory.',
+    )
+    parser.add_argument(
+        "--profile-duration",
+        type=float,
+        default=10.0,
+        help="Seconds profiled by a diagnosis.",
+    )
+    parser.add_argument(
+        "--coordinator",
+        type=str,
+        default=None,
+        help="Unix socket path (or host:port) of a link coordinator. "
+        "The link groups and per-client links are then shared with the "
+        "other instances using it.",
+    )
+    parser.add_argument(
+        "--coordinator-listen",
+        type=str,
+        default=None,
+        help="Run a link coordinator on this Unix socket path (or "
+        "host:port).",
+    )
+
+    # connection limits
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0.0,
+        help="Close connections idle for that long (in seconds). "
+        "0 means never.",
+    )
+    parser.add_argument(
+        "--max-lifetime",
+        type=float,
+        default=0.0,
+        help="Close connections opened for that long (in seconds). "
+        "0 means never.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=0,
+        help="Maximum active connections per port mapping. Extra "
+        "connections wait for a free slot. 0 means unlimited.",
+    )
+    parser.add_argument(
+        "--max-loop-lag",
+        type=float,
+        default=0.0,
+        help="Hold new connections while the event loop runs that late "
+        "(in ms). 0 means unlimited.",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=0,
+        help="Hold new connections while that many bytes are queued for "
+        "shaping. 0 means unlimited.",
+    )
+    parser.add_argument(
+        "--overload-backlog",
+        type=int,
+        default=128,
+        help="New connections held while overloaded. The next ones are "
+        "closed.",
+    )
+
+    # upstream connection pool options
+    parser.add_argument(
+        "--pool-min",
+        type=int,
+        default=0,
+        help="Idle upstream connections kept open per port mapping.",
+    )
+    parser.add_argument(
+        "--pool-max",
+        type=int,
+        default=0,
+        help="Maximum idle upstream connections per port mapping. "
+        "0 disables the pool.",
+    )
+    parser.add_argument(
+        "--pool-idle-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds after which an idle pooled connection is replaced.",
+    )
+
+    # socket options
+    parser.add_argument(
+        "--no-nodelay",
+        dest="tcp_nodelay",
+        action="store_false",
+        default=True,
+        help="Keep Nagle's algorithm enabled.",
+    )
+    parser.add_argument(
+        "--socket-buffer",
+        type=int,
+        default=None,
+        help="Send and receive buffer size of the sockets (in bytes). By "
+        "default they are sized from the rtt and bandwidth, 0 keeps the "
+        "system defaults.",
+    )
+    parser.add_argument(
+        "--notsent-lowat",
+        type=int,
+        default=16384,
+        help="TCP_NOTSENT_LOWAT of the sockets (in bytes). 0 keeps the "
+        "system default.",
+    )
+
+    # bottleneck queue options
+    parser.add_argument(
+        "--queue-limit",
+        type=int,
+        default=0,
+        help="Bottleneck queue size per link direction (in bytes). "
+        "0 means unlimited for TCP connections, and 4 bandwidth-delay "
+        "products (at least 64KB) for the shaped UDP flows, which drop "
+        "datagrams like a router when it's full.",
+    )
+    parser.add_argument(
+        "--queue-discipline",
+        type=str,
+        choices=DISCIPLINES,
+        default="droptail",
+        help="Bottleneck queue discipline.",
+    )
+    parser.add_argument(
+        "--codel-target",
+        type=float,
+        default=5.0,
+        help="CoDel target queuing delay (in ms).",
+    )
+    parser.add_argument(
+        "--codel-interval",
+        type=float,
+        default=100.0,
+        help="CoDel interval (in ms).",
+    )
 
-    return parser.parse_args()
+    return parser
+
+
+def get_args(argv=None):
+    return get_parser().parse_args(argv)
 
 
 def main(args=None):
@@ -66,18 +374,17 @@ def main(args=None):
     if args is None:
         args = get_args()
 
-    port_mapping = {}
+    udp_port_mapping = {}
+    if args.udp_port_mapping is not None:
+        udp_port_mapping = parse_port_mapping(args.udp_port_mapping)
     if args.port_mapping is not None:
-        for item in args.port_mapping.split(","):
-            item = item.strip()
-            if not item:
-                continue
-            source, target = item.split("/")
-            source_host, source_port = source.split(":")
-            target_host, target_port = target.split(":")
-            port_mapping[source_host, int(source_port)] = target_host, int(target_port)
+        port_mapping = parse_port_mapping(args.port_mapping)
+    elif args.config is None and not udp_port_mapping and args.proxy is None:
+        port_mapping = {
+            (args.host, args.port): (args.upstream_host, args.upstream_port)
+        }
     else:
-        port_mapping[args.host, args.port] = args.upstream_host, args.upstream_port
+        port_mapping = {}
 
     logger = set_logger(args.verbose and logging.DEBUG or logging.INFO)
     if sys.platform == "win32":
@@ -87,11 +394,6 @@ def main(args=None):
         loop = asyncio.get_event_loop()
 
     if args.verbose:
-        for (host, port), (upstream_host, upstream_port) in port_mapping.items():
-            logger.info(
-                "Starting Forwarder %s:%d => %s:%s"
-                % (host, port, upstream_host, upstream_port)
-            )
         if args.rtt > 0:
             logger.debug("Round Trip Latency (ms): %d" % args.rtt)
         else:
@@ -104,53 +406,164 @@ def main(args=None):
             logger.debug("Upload bandwidth (kbps): %s" % args.outkbps)
         else:
             logger.debug("Unlimited Upload bandwidth")
-    else:
+        if args.handshake_rtts > 0:
+            logger.debug("Handshake round trips: %s" % args.handshake_rtts)
+        if args.per_client:
+            logger.debug("One link per client address")
+        if args.pool_max > 0 or args.pool_min > 0:
+            logger.debug(
+                "Upstream pool size: %d-%d" % (args.pool_min, args.pool_max)
+            )
+        if args.queue_limit > 0 or args.queue_discipline != "droptail":
+            logger.debug(
+                "Bottleneck queue: %s, limit (bytes): %d"
+                % (args.queue_discipline, args.queue_limit)
+            )
+        else:
+            logger.debug("Unlimited bottleneck queue")
+
+    args.codel_target = args.codel_target / 1000.0
+    args.codel_interval = args.codel_interval / 1000.0
 
-        for (host, port), (upstream_host, upstream_port) in port_mapping.items():
-            logger.info(
-                "Starting Forwarder %s:%d => %s:%d (rtt=%d, inkbps=%s, outkbps=%s)"
-                % (
+    connector = Connector.from_args(args)
+
+    servers = []
+    # the optional subsystems are only imported when they're used, to
+    # keep the startup short: see benchmarks/bench_startup.py
+    if args.coordinator_listen is not None:
+        from tinap.coordinator import start_coordinator
+
+        servers.append(
+            loop.run_until_complete(start_coordinator(args.coordinator_listen))
+        )
+        logger.info("Link coordinator listening on %s" % args.coordinator_listen)
+    coordinator = None
+    if args.coordinator is not None:
+        from tinap.coordinator import CoordinatorClient
+
+        coordinator = CoordinatorClient(args.coordinator)
+        logger.info("Sharing the links with %s" % args.coordinator)
+
+    link = None
+    if args.per_client:
+        # the mappings with the default profile, from the command line,
+        # the config file or the control socket, share it, so a client
+        # gets the same link on all of them
+        link = ClientLinks(
+            "clients",
+            Profile(args.rtt, args.inkbps, args.outkbps),
+            idle_timeout=args.client_idle_timeout,
+            coordinator=coordinator,
+        )
+    to_add = [
+        Mapping(
+            host,
+            port,
+            upstream_host,
+            upstream_port,
+            args,
+            connector=connector,
+            link=link,
+        )
+        for (host, port), (upstream_host, upstream_port) in port_mapping.items()
+    ]
+    to_add += [
+        Mapping(
+            host,
+            port,
+            upstream_host,
+            upstream_port,
+            args,
+            connector=connector,
+            link=link,
+            protocol="udp",
+        )
+        for (host, port), (upstream_host, upstream_port) in udp_port_mapping.items()
+    ]
+    if args.proxy is not None:
+        for address in args.proxy.split(","):
+            if not address.strip():
+                continue
+            host, port = parse_address(address)
+            to_add.append(
+                Mapping(
                     host,
                     port,
-                    upstream_host,
-                    upstream_port,
-                    args.rtt,
-                    args.inkbps,
-                    args.outkbps,
+                    None,
+                    None,
+                    args,
+                    connector=connector,
+                    link=link,
+                    protocol="proxy",
                 )
             )
+    if args.config is not None:
+        from tinap.config import load_config, create_mappings
 
-    if args.rtt > 0:
-        # the latency is in seconds, and divided by two for each direction.
-        args.rtt = args.rtt / 2000.0
-    if args.outkbps > 0:
-        args.outkbps = args.outkbps * REMOVE_TCP_OVERHEAD
-    if args.inkbps > 0:
-        args.inkbps = args.inkbps * REMOVE_TCP_OVERHEAD
+        to_add += create_mappings(
+            load_config(args.config),
+            args,
+            connector,
+            coordinator=coordinator,
+            client_links=link,
+        )
 
-    servers = []
-    for (host, port), (upstream_host, upstream_port) in port_mapping.items():
-        server = loop.create_server(
-            functools.partial(
-                Forwarder, host, port, upstream_host, upstream_port, args
-            ),
-            host,
-            port,
+    if args.capture is not None:
+        from tinap.capture import start_capture
+
+        start_capture(
+            args.capture, snaplen=args.capture_snaplen, maxbytes=args.capture_buffer
+        )
+        logger.info("Capturing the traffic in %s" % args.capture)
+    if args.record is not None:
+        open_archive(args.record)
+        logger.info("Recording the upstream responses in %s" % args.record)
+    elif args.replay is not None:
+        archive = open_archive(args.replay, replay=True)
+        logger.info("Replaying %d responses from %s" % (len(archive), args.replay))
+
+    # all listeners are bound concurrently
+    mappings = Mappings()
+    loop.run_until_complete(mappings.add_all(to_add))
+    servers.insert(0, mappings)
+    diagnostics = Diagnostics(
+        mappings, directory=args.diagnostics_dir, duration=args.profile_duration
+    )
+    if args.max_loop_lag > 0 or args.max_queued > 0:
+        start_admission(
+            mappings,
+            max_lag=args.max_loop_lag / 1000.0,
+            max_queued=args.max_queued,
+            backlog=args.overload_backlog,
         )
-        server = loop.run_until_complete(server)
-        assert server is not None
-        servers.append(server)
 
+    if args.control is not None:
+        from tinap.control import start_control_server
+
+        control = loop.run_until_complete(
+            start_control_server(
+                args.control,
+                mappings,
+                args,
+                connector=connector,
+                coordinator=coordinator,
+                diagnostics=diagnostics,
+                client_links=link,
+            )
+        )
+        logger.info("Control socket listening on %s" % args.control)
+        servers.append(control)
     if sys.platform != "win32":
         for sig in (signal.SIGTERM, signal.SIGINT):
             loop.add_signal_handler(
                 sig, lambda sig=sig: asyncio.ensure_future(shutdown(servers))
             )
+        loop.add_signal_handler(signal.SIGUSR1, diagnostics.run)
     else:
         try:
             import win32api
         except ImportError:
-            print("You need to run 'pip install pywin32'")
+            logger.error("You need to run 'pip install pywin32'")
             raise
         win32api.SetConsoleCtrlHandler(
             functools.partial(loop.call_soon_threadsafe, sync_shutdown, servers), True
@@ -160,8 +573,21 @@ def main(args=None):
         for server in servers:
             loop.run_until_complete(server.wait_closed())
     finally:
+        diagnostics.close()
+        if coordinator is not None:
+            coordinator.close()
+        cancel_tasks(loop)
         loop.close()
-    print("Bye")
+        stop_admission()
+        if args.capture is not None:
+            from tinap.capture import stop_capture
+
+            stop_capture()
+        close_archive()
+    for line in STATS.report():
+        logger.info(line)
+    logger.info("Bye")
+    stop_logger()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+# encoding: utf-8
+"""Embeddable API.
+
+Runs shaped port mappings on the caller's loop, for instance in a test
+suite::
+
+    async with tinap.Proxy(["127.0.0.1:8080"], Profile(rtt=100)) as proxy:
+        host, port = proxy.addresses[0]
+        ...
+
+The listeners are bound to ports picked by the system. Nothing global is
+set up: no loop, signal handler or log handler. Leaving the block closes
+the listeners and the connections before it returns.
+"""
+import argparse
+
+from tinap.connect import Connector
+from tinap.mapping import Mapping, Mappings, parse_address
+from tinap.profile import Profile
+
+_DEFAULTS = None
+
+
+def default_args(**options):
+    """Returns the command-line options with their default values,
+    updated with *options*. Durations are in the command-line units.
+    """
+    global _DEFAULTS
+    if _DEFAULTS is None:
+        # the command-line module imports this one
+        from tinap import get_parser
+
+        _DEFAULTS = vars(get_parser().parse_args([]))
+    args = argparse.Namespace(**_DEFAULTS)
+    for name, value in options.items():
+        if name not in _DEFAULTS:
+            raise TypeError("Unknown option %r" % name)
+        setattr(args, name, value)
+    # converted like main() does
+    args.codel_target = args.codel_target / 1000.0
+    args.codel_interval = args.codel_interval / 1000.0
+    return args
+
+
+def _parse_upstream(upstream):
+    if upstream is None:
+        return None, None
+    if isinstance(upstream, str):
+        return parse_address(upstream)
+    return upstream
+
+
+class Proxy:
+    """Shaped port mappings, one per upstream.
+
+    - upstreams: list of "host:port" or (host, port) upstreams. With the
+      "proxy" protocol, use None.
+    - profile: Profile, or dict of rtt/inkbps/outkbps, shared by all the
+      mappings. Updating it applies to the live connections.
+    - host: address the listeners are bound to.
+    - protocol: "tcp", "udp" or "proxy".
+    - link: LinkGroup shared by all the connections.
+    - hooks: hook factories of the connections, see tinap.hooks.
+    - options: any command-line option, by its argument name, e.g.
+      handshake_rtts=2 or queue_limit=65536.
+    """
+
+    def __init__(
+        self,
+        upstreams,
+        profile=None,
+        host="127.0.0.1",
+        protocol="tcp",
+        link=None,
+        hooks=None,
+        **options
+    ):
+        self.args = default_args(**options)
+        if profile is None:
+            profile = Profile()
+        elif isinstance(profile, dict):
+            profile = Profile(**profile)
+        if link is not None:
+            profile = link.profile
+        self.profile = profile
+        self.connector = Connector.from_args(self.args)
+        self.mappings = Mappings()
+        self._to_add = [
+            Mapping(
+                host,
+                0,
+                *_parse_upstream(upstream),
+                self.args,
+                profile=profile,
+                connector=self.connector,
+                link=link,
+                protocol=protocol,
+                hooks=hooks,
+            )
+            for upstream in upstreams
+        ]
+
+    @property
+    def addresses(self):
+        """(host, port) of the listeners, in the order of the upstreams.
+        """
+        return [(mapping.host, mapping.port) for mapping in self.mappings]
+
+    async def start(self):
+        await self.mappings.add_all(self._to_add)
+        return self
+
+    async def close(self):
+        """Closes the listeners and aborts the connections.
+        """
+        self.mappings.close()
+        for mapping in self.mappings:
+            await mapping.close_connections()
+        await self.mappings.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
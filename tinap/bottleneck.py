@@ -0,0 +1,136 @@
+# encoding: utf-8
+"""Bottleneck queue models.
+
+A real link has a finite buffer in front of it. When that buffer overflows
+(drop-tail) or when packets sit in it for too long (CoDel), the router
+drops packets and the TCP sender backs off.
+
+We can't drop bytes from a TCP stream, so here a "drop" means that the
+Throttler pauses reading from the sender until the queue recovers. Each
+discipline exposes a `congested` flag that the Throttler follows.
+"""
+import math
+
+# Below this backlog CoDel never drops (one full-size ethernet frame).
+MTU = 1514
+
+DISCIPLINES = ("droptail", "codel")
+
+
+class DropTail:
+    """Pauses the sender when the queue holds *limit* bytes or more,
+    and resumes it once the queue drained below half of it.
+
+    A limit of 0 means an infinite buffer.
+    """
+
+    name = "droptail"
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.congested = False
+        self.drops = 0
+        self._overflowing = False
+
+    def _overflow(self, backlog):
+        if self.limit <= 0:
+            return False
+        if backlog >= self.limit:
+            if not self._overflowing:
+                self.drops += 1
+            self._overflowing = True
+        elif backlog <= self.limit // 2:
+            # hysteresis, so we don't flip for every chunk
+            self._overflowing = False
+        return self._overflowing
+
+    def enqueue(self, now, backlog):
+        """Called when a chunk was queued. Returns the congestion state.
+        """
+        self.congested = self._overflow(backlog)
+        return self.congested
+
+    def dequeue(self, now, sojourn, backlog):
+        """Called when a chunk left the queue after *sojourn* seconds.
+        Returns the congestion state.
+        """
+        self.congested = self._overflow(backlog)
+        return self.congested
+
+
+class CoDel(DropTail):
+    """Controlled Delay (RFC 8289).
+
+    The sender is paused as long as CoDel is in its dropping state, i.e.
+    once the queuing delay stayed above *target* for at least *interval*
+    seconds, and until it goes back under *target*. The *limit* still
+    applies as a hard cap, like in the drop-tail discipline.
+
+    `drops` counts the packets a real CoDel queue would have dropped.
+    """
+
+    name = "codel"
+
+    def __init__(self, limit=0, target=0.005, interval=0.1):
+        super().__init__(limit)
+        self.target = target
+        self.interval = interval
+        self.dropping = False
+        self.first_above_time = 0
+        self.drop_next = 0
+        self.count = 0
+        self.lastcount = 0
+
+    def _control_law(self, t):
+        return t + self.interval / math.sqrt(self.count)
+
+    def _ok_to_drop(self, now, sojourn, backlog):
+        if sojourn < self.target or backlog <= MTU:
+            self.first_above_time = 0
+            return False
+        if self.first_above_time == 0:
+            self.first_above_time = now + self.interval
+            return False
+        return now >= self.first_above_time
+
+    def enqueue(self, now, backlog):
+        self.congested = self._overflow(backlog) or self.dropping
+        return self.congested
+
+    def dequeue(self, now, sojourn, backlog):
+        overflowing = self._overflow(backlog)
+        ok_to_drop = self._ok_to_drop(now, sojourn, backlog)
+
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+            elif now >= self.drop_next:
+                self.count += 1
+                self.drops += 1
+                self.drop_next = self._control_law(self.drop_next)
+        elif ok_to_drop:
+            self.dropping = True
+            self.drops += 1
+            delta = self.count - self.lastcount
+            if delta > 1 and now - self.drop_next < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.lastcount = self.count
+            self.drop_next = self._control_law(now)
+
+        self.congested = overflowing or self.dropping
+        return self.congested
+
+
+def create_discipline(name="droptail", limit=0, target=0.005, interval=0.1):
+    """Returns a new queue discipline, or None if the queue is unbounded
+    and there's nothing to model.
+    """
+    if name == "droptail":
+        if limit <= 0:
+            return None
+        return DropTail(limit)
+    if name == "codel":
+        return CoDel(limit, target, interval)
+    raise ValueError("Unknown queue discipline %r" % name)
@@ -0,0 +1,289 @@
+# encoding: utf-8
+"""Packet capture of the forwarded traffic, in pcapng.
+
+Each chunk is recorded twice: when tinap receives it (interface 0,
+"received") and when the Throttler releases it, after the emulated
+bandwidth and latency (interface 1, "released"). TCP/IP headers are
+synthesized from the client address and the address it connected to,
+with sequence numbers that follow the stream, so Wireshark can
+reassemble it.
+
+The data path only appends a tuple to a ring, bounded by the bytes of
+the chunks it holds. A background thread builds the packets and writes
+them by batches. When the ring is full, records are dropped instead of
+slowing down the connections.
+"""
+import collections
+import ipaddress
+import struct
+import threading
+import time
+
+from tinap.stats import STATS
+from tinap.util import get_capture, set_capture
+
+RECEIVED = 0
+RELEASED = 1
+
+_OPEN = 2
+_CLOSE = 3
+
+# pcapng
+_LINKTYPE_RAW = 101
+_SHB = 0x0A0D0D0A
+_IDB = 0x00000001
+_EPB = 0x00000006
+_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# IPv6 and TCP headers
+_MAX_HEADERS = 40 + 20
+
+# a segment has to fit in an IP packet
+_MAX_SEGMENT = 65535 - 60 - 20
+
+_TCP_PSH_ACK = 0x18
+
+
+def _pad(data):
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def _option(code, value):
+    return struct.pack("<HH", code, len(value)) + _pad(value)
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def _checksum(header):
+    total = sum(struct.unpack("!%dH" % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _packed(host, ipv6):
+    address = ipaddress.ip_address(host)
+    if ipv6 and address.version == 4:
+        address = ipaddress.IPv6Address("::ffff:%s" % address)
+    return address.packed
+
+
+class _Flow:
+    """What the writer knows about a connection.
+    """
+
+    __slots__ = ("ipv6", "client", "server", "seqs")
+
+    def __init__(self, client, server):
+        self.ipv6 = ":" in client[0] or ":" in server[0]
+        self.client = _packed(client[0], self.ipv6), client[1]
+        self.server = _packed(server[0], self.ipv6), server[1]
+        # next sequence number, per (stage, direction)
+        self.seqs = {}
+
+    def header(self, src, dst, seq, ack, length):
+        """Returns the IP and TCP headers of a segment of *length* bytes.
+        """
+        tcp = struct.pack(
+            "!HHIIBBHHH",
+            src[1],
+            dst[1],
+            seq & 0xFFFFFFFF,
+            ack & 0xFFFFFFFF,
+            5 << 4,
+            _TCP_PSH_ACK,
+            65535,
+            0,  # checksum, not computed
+            0,
+        )
+        if self.ipv6:
+            ip = struct.pack(
+                "!IHBB16s16s", 6 << 28, len(tcp) + length, 6, 64, src[0], dst[0]
+            )
+            return ip + tcp
+        ip = struct.pack(
+            "!BBHHHBBH4s4s",
+            0x45,
+            0,
+            20 + len(tcp) + length,
+            0,
+            0x4000,  # don't fragment
+            64,
+            6,
+            0,
+            src[0],
+            dst[0],
+        )
+        return ip[:10] + struct.pack("!H", _checksum(ip)) + ip[12:] + tcp
+
+
+class Capture:
+    """Writes the records to *path*.
+
+    - snaplen: bytes of payload kept per chunk, 0 keeps everything.
+    - maxbytes: bytes of payload kept in the ring before dropping.
+    - interval: seconds between two batches.
+    """
+
+    def __init__(self, path, snaplen=0, maxbytes=64 * 1024 * 1024, interval=0.05):
+        self.path = path
+        self.snaplen = snaplen
+        self.maxbytes = maxbytes
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self._ring = collections.deque()
+        # bytes queued in the ring: each counter has a single writer, the
+        # event loop and the background thread, so no lock is needed
+        self._appended = 0
+        self._flushed = 0
+        self._ids = 0
+        self._stopped = threading.Event()
+        self._flows = {}
+        self._file = open(path, "wb")
+        self._file.write(self._headers())
+        self._thread = threading.Thread(target=self._run, name="tinap-capture")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _headers(self):
+        shb = struct.pack("<IHHq", _BYTE_ORDER_MAGIC, 1, 0, -1)
+        shb += _option(4, b"tinap") + _option(0, b"")
+        res = _block(_SHB, shb)
+        for name in (b"received", b"released"):
+            # the snaplen of the interface counts the headers
+            snaplen = self.snaplen and self.snaplen + _MAX_HEADERS
+            idb = struct.pack("<HHI", _LINKTYPE_RAW, 0, snaplen)
+            idb += _option(2, b"tinap-" + name) + _option(0, b"")
+            res += _block(_IDB, idb)
+        return res
+
+    def connection(self, client, server):
+        """Returns the recorder of a connection between the *client* and
+        the *server* addresses, as (host, port) tuples.
+        """
+        self._ids += 1
+        # bookkeeping records are never dropped
+        self._ring.append((_OPEN, self._ids, (client[:2], server[:2])))
+        return ConnectionCapture(self, self._ids)
+
+    def record(self, stage, conn_id, direction, data):
+        length = len(data)
+        if self.snaplen and length > self.snaplen:
+            data = data[: self.snaplen]
+        size = len(data)
+        if self._appended - self._flushed + size > self.maxbytes:
+            self.dropped += 1
+            return
+        self._appended += size
+        self._ring.append((stage, conn_id, direction, time.time(), data, length))
+
+    def _packets(self, record):
+        kind, conn_id = record[0], record[1]
+        if kind == _OPEN:
+            self._flows[conn_id] = _Flow(*record[2])
+            return b""
+        if kind == _CLOSE:
+            self._flows.pop(conn_id, None)
+            return b""
+        flow = self._flows.get(conn_id)
+        if flow is None:
+            return b""
+        __, __, direction, when, data, length = record
+        if direction == "in":
+            src, dst = flow.client, flow.server
+        else:
+            src, dst = flow.server, flow.client
+        key = kind, direction
+        seq = flow.seqs.get(key, 1)
+        ack = flow.seqs.get((kind, direction == "in" and "out" or "in"), 1)
+        flow.seqs[key] = seq + length
+
+        res = []
+        micros = int(when * 1000000)
+        offset = 0
+        while True:
+            segment = data[offset : offset + _MAX_SEGMENT]
+            seglen = min(length - offset, _MAX_SEGMENT)
+            packet = flow.header(src, dst, seq + offset, ack, seglen) + segment
+            epb = struct.pack(
+                "<IIIII",
+                kind,
+                micros >> 32,
+                micros & 0xFFFFFFFF,
+                len(packet),
+                len(packet) - len(segment) + seglen,
+            )
+            res.append(_block(_EPB, epb + _pad(packet)))
+            offset += _MAX_SEGMENT
+            if offset >= length:
+                break
+        return b"".join(res)
+
+    def _flush(self):
+        ring = self._ring
+        batch = []
+        flushed = 0
+        while ring:
+            record = ring.popleft()
+            batch.append(self._packets(record))
+            if record[0] < _OPEN:
+                self.written += 1
+                flushed += len(record[4])
+        self._flushed += flushed
+        if batch:
+            self._file.write(b"".join(batch))
+            self._file.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._flush()
+        self._flush()
+
+    def close(self):
+        """Writes what's left, and closes the file.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._file.close()
+        STATS.incr("capture.written", self.written)
+        STATS.incr("capture.dropped", self.dropped)
+
+
+class ConnectionCapture:
+    """Records the chunks of one connection.
+    """
+
+    __slots__ = ("capture", "conn_id")
+
+    def __init__(self, capture, conn_id):
+        self.capture = capture
+        self.conn_id = conn_id
+
+    def received(self, direction, data):
+        self.capture.record(RECEIVED, self.conn_id, direction, data)
+
+    def released(self, direction, data):
+        self.capture.record(RELEASED, self.conn_id, direction, data)
+
+    def close(self):
+        self.capture._ring.append((_CLOSE, self.conn_id))
+
+
+def start_capture(path, snaplen=0, maxbytes=64 * 1024 * 1024):
+    stop_capture()
+    capture = Capture(path, snaplen=snaplen, maxbytes=maxbytes)
+    set_capture(capture)
+    return capture
+
+
+def stop_capture():
+    capture = get_capture()
+    if capture is not None:
+        capture.close()
+        set_capture(None)
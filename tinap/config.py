@@ -0,0 +1,255 @@
+# encoding: utf-8
+"""Declarative configuration file, in JSON or TOML (.toml files).
+
+Example::
+
+    [profiles.3g]
+    rtt = 300
+    inkbps = 1600
+    outkbps = 768
+
+    [groups.agent]
+    profile = "3g"
+
+    [groups.browsers]
+    profile = "3g"
+    per_client = true
+
+    [[mappings]]
+    listen = "127.0.0.1:8000-8099"
+    upstream = "127.0.0.1:9000-9099"
+    profile = "3g"
+
+    [[mappings]]
+    listen = "127.0.0.1:443"
+    upstream = "127.0.0.1:8443"
+    group = "agent"
+
+    [[mappings]]
+    listen = "127.0.0.1:443"
+    upstream = "127.0.0.1:8443"
+    group = "agent"
+    protocol = "udp"
+
+- **profiles**: named shaping profiles (rtt, inkbps, outkbps). The
+  command-line options provide the default values.
+- **groups**: shared links. All the connections of the mappings in a
+  group compete for the same bandwidth. With `per_client`, each client
+  address gets its own link in the group instead, dropped after
+  `idle_timeout` seconds without connections. With --coordinator,
+  groups of the same name share their bandwidth across instances.
+- **mappings**: port mappings. With --per-client, a mapping that's not
+  in a group gets one link per client address. `listen` and `upstream` accept port
+  ranges of the same length, or a single upstream port. `profile` is a
+  profile name or an inline table, and `group` a group name.
+  `protocol` is "tcp" (default), "udp" or "proxy". Proxy mappings serve
+  SOCKS5 and HTTP CONNECT clients, and take no `upstream`. `socket` is a
+  table of socket options (nodelay, buffer_size, notsent_lowat) that
+  override the command-line ones. `hooks` is a list of "module:factory"
+  hook factories (see tinap.hooks) replacing the --hook ones.
+"""
+import json
+
+from tinap.mapping import Mapping, PROTOCOLS
+from tinap.hooks import load_hooks
+from tinap.profile import Profile, LinkGroup, ClientLinks
+from tinap.sockopts import SocketOptions
+
+_PROFILE_KEYS = ("rtt", "inkbps", "outkbps")
+_SOCKET_KEYS = ("nodelay", "buffer_size", "notsent_lowat")
+_GROUP_KEYS = ("profile", "per_client", "idle_timeout")
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _loads_toml(data):
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ConfigError("TOML files need Python 3.11+ or 'pip install tomli'")
+    return tomllib.loads(data.decode("utf8"))
+
+
+def load_config(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        if path.endswith(".toml"):
+            config = _loads_toml(data)
+        else:
+            config = json.loads(data.decode("utf8"))
+    except ConfigError:
+        raise
+    except ValueError as e:
+        raise ConfigError("Could not read %s: %s" % (path, e))
+    if not isinstance(config, dict):
+        raise ConfigError("%s should contain a table" % path)
+    return config
+
+
+def parse_range(value):
+    """Parses host:port or host:start-end.
+
+    Returns the host and the list of ports.
+    """
+    try:
+        host, ports = value.strip().rsplit(":", 1)
+        if "-" in ports:
+            start, end = ports.split("-")
+            ports = list(range(int(start), int(end) + 1))
+        else:
+            ports = [int(ports)]
+    except ValueError:
+        raise ConfigError("Invalid address %r" % value)
+    if not ports:
+        raise ConfigError("Empty port range in %r" % value)
+    return host.strip("[]"), ports
+
+
+def _profile_options(value, profiles):
+    if value is None:
+        return {}
+    if isinstance(value, str):
+        try:
+            value = profiles[value]
+        except KeyError:
+            raise ConfigError("Unknown profile %r" % value)
+    if not isinstance(value, dict):
+        raise ConfigError("Invalid profile %r" % value)
+    unknown = set(value) - set(_PROFILE_KEYS)
+    if unknown:
+        raise ConfigError("Unknown profile options %s" % ", ".join(sorted(unknown)))
+    return value
+
+
+def _create_profile(args, options):
+    profile = Profile(args.rtt, args.inkbps, args.outkbps)
+    try:
+        profile.update(**options)
+    except ValueError as e:
+        raise ConfigError(str(e))
+    return profile
+
+
+def _create_sockopts(args, options):
+    sockopts = SocketOptions.from_args(args)
+    if options is None:
+        return sockopts
+    if not isinstance(options, dict):
+        raise ConfigError("Invalid socket options %r" % options)
+    unknown = set(options) - set(_SOCKET_KEYS)
+    if unknown:
+        raise ConfigError("Unknown socket options %s" % ", ".join(sorted(unknown)))
+    try:
+        sockopts.update(**options)
+    except (TypeError, ValueError) as e:
+        raise ConfigError(str(e))
+    return sockopts
+
+
+def create_mappings(config, args, connector=None, coordinator=None, client_links=None):
+    """Returns the list of Mapping described by *config*.
+
+    The links of the groups are shared with other instances when a
+    *coordinator* client is provided.
+
+    With --per-client, the mappings outside of a group that have the same
+    profile share a ClientLinks, so a client gets one link on all of
+    them. Those with the default profile use *client_links* when it's
+    provided, like the command-line mappings.
+    """
+    profiles = config.get("profiles", {})
+    groups = {}
+    # profile options -> ClientLinks of the mappings outside of a group
+    client_groups = {}
+    if client_links is not None:
+        client_groups[()] = client_links
+    for name, options in config.get("groups", {}).items():
+        unknown = set(options) - set(_GROUP_KEYS)
+        if unknown:
+            raise ConfigError("Unknown group options %s" % ", ".join(sorted(unknown)))
+        profile = _create_profile(
+            args, _profile_options(options.get("profile"), profiles)
+        )
+        if options.get("per_client", False):
+            idle_timeout = options.get("idle_timeout", args.client_idle_timeout)
+            groups[name] = ClientLinks(
+                name, profile, idle_timeout=idle_timeout, coordinator=coordinator
+            )
+        else:
+            groups[name] = LinkGroup(name, profile, coordinator=coordinator)
+
+    mappings = []
+    for item in config.get("mappings", []):
+        protocol = item.get("protocol", "tcp")
+        if protocol not in PROTOCOLS:
+            raise ConfigError("Unknown protocol %r" % protocol)
+        try:
+            host, ports = parse_range(item["listen"])
+            if protocol == "proxy":
+                upstream_host, upstream_ports = None, [None]
+            else:
+                upstream_host, upstream_ports = parse_range(item["upstream"])
+        except KeyError as e:
+            raise ConfigError("Missing %s in mapping %r" % (e, item))
+        if len(upstream_ports) == 1:
+            upstream_ports = upstream_ports * len(ports)
+        elif len(upstream_ports) != len(ports):
+            raise ConfigError("Port ranges of different sizes in %r" % item)
+
+        link = None
+        if "group" in item:
+            try:
+                link = groups[item["group"]]
+            except KeyError:
+                raise ConfigError("Unknown group %r" % item["group"])
+            if "profile" in item:
+                raise ConfigError("Mappings in a group use the group profile")
+        options = _profile_options(item.get("profile"), profiles)
+        sockopts = _create_sockopts(args, item.get("socket"))
+        hooks = None
+        if "hooks" in item:
+            try:
+                hooks = load_hooks(item["hooks"])
+            except (ImportError, AttributeError, ValueError) as e:
+                raise ConfigError("Invalid hooks in %r: %s" % (item, e))
+
+        if link is None and args.per_client:
+            key = tuple(sorted(options.items()))
+            link = client_groups.get(key)
+            if link is None:
+                name = "clients"
+                if key:
+                    name += "(%s)" % ",".join("%s=%s" % option for option in key)
+                link = client_groups[key] = ClientLinks(
+                    name,
+                    _create_profile(args, options),
+                    idle_timeout=args.client_idle_timeout,
+                    coordinator=coordinator,
+                )
+
+        for port, upstream_port in zip(ports, upstream_ports):
+            profile = None
+            if link is None:
+                profile = _create_profile(args, options)
+            mappings.append(
+                Mapping(
+                    host,
+                    port,
+                    upstream_host,
+                    upstream_port,
+                    args,
+                    profile=profile,
+                    connector=connector,
+                    link=link,
+                    protocol=protocol,
+                    sockopts=sockopts,
+                    hooks=hooks,
+                )
+            )
+    return mappings
@@ -0,0 +1,165 @@
+# encoding: utf-8
+"""Upstream connections.
+
+Addresses come from the shared Resolver cache, and are raced following
+the Happy Eyeballs algorithm (RFC 8305): attempts alternate between
+address families, and a new attempt starts every *attempt_delay* seconds
+or as soon as the previous one failed. The first socket connected wins.
+"""
+import asyncio
+import collections
+import itertools
+import socket
+
+from tinap.resolver import Resolver
+from tinap.stats import STATS
+
+
+def interleave(infos):
+    """Reorders addrinfos so address families alternate, starting with
+    the family of the first address (RFC 8305, section 4).
+    """
+    families = collections.OrderedDict()
+    seen = set()
+    for info in infos:
+        if info[4] in seen:
+            continue
+        seen.add(info[4])
+        families.setdefault(info[0], []).append(info)
+    res = []
+    for group in itertools.zip_longest(*families.values()):
+        res.extend(info for info in group if info is not None)
+    return res
+
+
+async def _connect_sock(loop, info):
+    family, type_, proto, __, address = info
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _discard(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+def _first_connected(done, errors):
+    winner = None
+    for task in done:
+        if task.exception() is not None:
+            errors.append(task.exception())
+        elif winner is None:
+            winner = task.result()
+        else:
+            task.result().close()
+    return winner
+
+
+async def happy_eyeballs(infos, attempt_delay=0.25):
+    """Returns a connected socket for the first address in *infos* that
+    answers.
+    """
+    loop = asyncio.get_event_loop()
+    pending = set()
+    errors = []
+
+    try:
+        for info in interleave(infos):
+            pending.add(asyncio.ensure_future(_connect_sock(loop, info)))
+            # the next attempt starts after the delay, or right away
+            # if an attempt failed
+            done, pending = await asyncio.wait(
+                pending, timeout=attempt_delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = _first_connected(done, errors)
+            if winner is not None:
+                return winner
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = _first_connected(done, errors)
+            if winner is not None:
+                return winner
+    finally:
+        # the sockets of the attempts we did not pick are closed
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_discard)
+
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError("Multiple exceptions: %s" % ", ".join(str(e) for e in errors))
+
+
+class Connector:
+    """Opens upstream connections.
+
+    Each try is limited to *timeout* seconds, and failed tries are
+    retried *retries* times, waiting *retry_delay* seconds before the
+    first retry and doubling that delay each time.
+    """
+
+    def __init__(
+        self,
+        timeout=5.0,
+        retries=0,
+        retry_delay=0.5,
+        attempt_delay=0.25,
+        resolver=None,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.attempt_delay = attempt_delay
+        if resolver is None:
+            resolver = Resolver()
+        self.resolver = resolver
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            timeout=args.connect_timeout,
+            retries=args.connect_retries,
+            retry_delay=args.connect_retry_delay / 1000.0,
+            attempt_delay=args.happy_eyeballs_delay / 1000.0,
+            resolver=Resolver(ttl=args.dns_ttl, maxsize=args.dns_cache_size),
+        )
+
+    async def _connect(self, protocol_factory, host, port):
+        loop = asyncio.get_event_loop()
+        infos = await self.resolver.getaddrinfo(host, port)
+        if not infos:
+            raise OSError("getaddrinfo() returned empty list")
+        if len(infos) == 1:
+            sock = await _connect_sock(loop, infos[0])
+        else:
+            sock = await happy_eyeballs(infos, self.attempt_delay)
+        try:
+            return await loop.create_connection(protocol_factory, sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def connect(self, protocol_factory, host, port):
+        """Returns a (transport, protocol) tuple, like
+        loop.create_connection().
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.wait_for(
+                    self._connect(protocol_factory, host, port), timeout=self.timeout
+                )
+            except (asyncio.TimeoutError, OSError):
+                if attempt == self.retries:
+                    raise
+            STATS.incr("connect.retries")
+            await asyncio.sleep(delay)
+            delay *= 2
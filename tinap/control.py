@@ -0,0 +1,227 @@
+# encoding: utf-8
+"""Control socket.
+
+Accepts one JSON command per line, and answers one JSON object per line.
+
+- {"command": "list"}
+- {"command": "set", "mapping": "127.0.0.1:80", "rtt": 100, "inkbps": 500}
+  (without "mapping", the profile of every mapping is updated)
+- {"command": "add", "mapping": "127.0.0.1:81/127.0.0.1:8081", "rtt": 50}
+- {"command": "remove", "mapping": "127.0.0.1:81"}
+- {"command": "diagnose"} (see tinap.diagnostics)
+
+"set", "add" and "remove" accept a "protocol" field, "tcp" (default),
+"udp" or "proxy". Proxy mappings are added without an upstream:
+{"command": "add", "mapping": "127.0.0.1:1080", "protocol": "proxy"}
+
+Each answer has a "status" field set to "ok" or "error". The commands
+of a connection are run one after the other, so the answers come back in
+the order of the commands.
+"""
+import asyncio
+import json
+import socket
+import sys
+
+from tinap.mapping import Mapping, parse_address
+from tinap.profile import Profile, ClientLinks
+from tinap.util import get_logger
+
+_PROFILE_KEYS = ("rtt", "inkbps", "outkbps")
+
+
+class ControlProtocol(asyncio.Protocol):
+    def __init__(
+        self,
+        mappings,
+        args,
+        connector=None,
+        coordinator=None,
+        diagnostics=None,
+        client_links=None,
+    ):
+        self.mappings = mappings
+        self.args = args
+        self.connector = connector
+        self.coordinator = coordinator
+        self.diagnostics = diagnostics
+        # with --per-client, the link of the mappings added with the
+        # default profile
+        self.client_links = client_links
+        self.transport = None
+        self.buffer = b""
+        self.logger = get_logger()
+        self._commands = asyncio.Queue()
+        self._runner = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._runner = asyncio.ensure_future(self._run())
+
+    def connection_lost(self, exc):
+        # the commands already received are still run
+        self._commands.put_nowait(None)
+
+    def data_received(self, data):
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            if line.strip():
+                self._commands.put_nowait(line)
+
+    async def _run(self):
+        while True:
+            line = await self._commands.get()
+            if line is None:
+                break
+            await self._handle(line)
+
+    async def _handle(self, line):
+        try:
+            command = json.loads(line.decode("utf8"))
+            handler = getattr(self, "do_%s" % command.get("command"), None)
+            if handler is None:
+                raise ValueError("Unknown command")
+            res = await handler(command)
+            res["status"] = "ok"
+        except Exception as e:
+            res = {"status": "error", "error": str(e)}
+        if not self.transport.is_closing():
+            self.transport.write(json.dumps(res).encode("utf8") + b"\n")
+
+    def _profile_options(self, command):
+        return dict((key, command[key]) for key in _PROFILE_KEYS if key in command)
+
+    def _key(self, command):
+        return parse_address(command["mapping"]) + (command.get("protocol", "tcp"),)
+
+    async def do_list(self, command):
+        return {"mappings": [mapping.as_dict() for mapping in self.mappings]}
+
+    async def do_set(self, command):
+        options = self._profile_options(command)
+        if "mapping" in command:
+            targets = [self.mappings.get(self._key(command))]
+        else:
+            targets = list(self.mappings)
+        for mapping in targets:
+            mapping.profile.update(**options)
+            self.logger.info("Updated Forwarder %s (%s)" % (mapping, mapping.profile))
+        return {"mappings": [mapping.as_dict() for mapping in targets]}
+
+    async def do_add(self, command):
+        protocol = command.get("protocol", "tcp")
+        if protocol == "proxy":
+            host, port = parse_address(command["mapping"])
+            upstream_host = upstream_port = None
+        else:
+            source, target = command["mapping"].split("/")
+            host, port = parse_address(source)
+            upstream_host, upstream_port = parse_address(target)
+        options = self._profile_options(command)
+        profile = Profile(self.args.rtt, self.args.inkbps, self.args.outkbps)
+        profile.update(**options)
+        link = None
+        if self.args.per_client:
+            if options:
+                # a link has a single profile
+                link = ClientLinks(
+                    "%s:%d" % (host, port),
+                    profile,
+                    idle_timeout=self.args.client_idle_timeout,
+                    coordinator=self.coordinator,
+                )
+            else:
+                link = self.client_links
+        mapping = Mapping(
+            host,
+            port,
+            upstream_host,
+            upstream_port,
+            self.args,
+            profile=profile,
+            connector=self.connector,
+            link=link,
+            protocol=protocol,
+        )
+        await self.mappings.add(mapping)
+        return {"mappings": [mapping.as_dict()]}
+
+    async def do_remove(self, command):
+        mapping = await self.mappings.remove(self._key(command))
+        return {"mappings": [mapping.as_dict()]}
+
+    async def do_diagnose(self, command):
+        if self.diagnostics is None:
+            raise ValueError("Diagnostics are not enabled")
+        return {"files": self.diagnostics.run()}
+
+
+async def start_control_server(
+    address,
+    mappings,
+    args,
+    connector=None,
+    coordinator=None,
+    diagnostics=None,
+    client_links=None,
+):
+    """Listens on *address*, a Unix socket path or a host:port.
+
+    With --per-client, the mappings added with the default profile share
+    *client_links*, or a ClientLinks created here.
+    """
+    loop = asyncio.get_event_loop()
+    if client_links is None and args.per_client:
+        client_links = ClientLinks(
+            "clients",
+            Profile(args.rtt, args.inkbps, args.outkbps),
+            idle_timeout=args.client_idle_timeout,
+            coordinator=coordinator,
+        )
+
+    def factory():
+        return ControlProtocol(
+            mappings,
+            args,
+            connector=connector,
+            coordinator=coordinator,
+            diagnostics=diagnostics,
+            client_links=client_links,
+        )
+
+    if ":" in address:
+        host, port = parse_address(address)
+        return await loop.create_server(factory, host, port)
+    return await loop.create_unix_server(factory, address)
+
+
+def send(address, command):
+    """Sends *command* to the control socket and returns the answer.
+    """
+    if ":" in address:
+        sock = socket.create_connection(parse_address(address))
+    else:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(address)
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps(command).encode("utf8") + b"\n")
+        f.flush()
+        return json.loads(f.readline().decode("utf8"))
+
+
+def main(argv=None):
+    """Usage: python -m tinap.control <address> '<json command>'
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 2:
+        print(main.__doc__.strip())
+        return 1
+    res = send(argv[0], json.loads(argv[1]))
+    print(json.dumps(res, indent=2))
+    return res["status"] != "ok"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+# encoding: utf-8
+"""Link coordinator.
+
+Each tinap instance enforces the bandwidth of its links on its own, so
+N instances behind a load balancer emulate a link N times wider. With
+a coordinator, the instances reserve the bandwidth of their link groups
+on a shared service instead.
+
+A lease reserves bytes on a (link, direction), the same way a
+BandwidthControl does locally: the coordinator answers with the delay
+after which the bytes can be sent. Instances lease about 100ms of
+bandwidth at once, so chunks don't wait for a round trip to the
+coordinator. When it can't be reached, the links fall back to local
+enforcement, and the coordinator is tried again a few seconds later.
+
+The protocol is one JSON object per line, over TCP or a Unix socket::
+
+    {"id": 1, "link": "agent", "direction": "in", "rate": 200000, "bytes": 20000}
+    {"id": 1, "delay": 0.05}
+
+Usage: python -m tinap.coordinator <address>
+"""
+import asyncio
+import itertools
+import json
+import sys
+import time
+
+from tinap.mapping import parse_address
+from tinap.stats import STATS
+from tinap.throttler import BandwidthControl
+from tinap.util import get_logger, set_logger
+
+# seconds of bandwidth leased at once
+LEASE_DURATION = 0.1
+MIN_LEASE = 16384
+# leased bytes that were not used after that many seconds are dropped
+TOKEN_TTL = 1.0
+# reservations that ended that long ago are forgotten
+_FORGET_AFTER = 60.0
+
+
+class CoordinatorUnavailable(Exception):
+    pass
+
+
+class Coordinator:
+    """Bandwidth reservations of the coordinated links.
+    """
+
+    def __init__(self):
+        # (link, direction) -> time at which the link is free
+        self.links = {}
+        self._last_sweep = 0.0
+
+    def lease(self, link, direction, rate, size, now=None):
+        """Reserves *size* bytes on *link* at *rate* bytes per second.
+
+        Returns the delay after which they can be sent.
+        """
+        if now is None:
+            now = time.monotonic()
+        if rate <= 0:
+            return 0.0
+        if now - self._last_sweep > _FORGET_AFTER:
+            self._sweep(now)
+        key = link, direction
+        start = max(now, self.links.get(key, now))
+        self.links[key] = start + size / float(rate)
+        return start - now
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for key, free in list(self.links.items()):
+            if now - free > _FORGET_AFTER:
+                del self.links[key]
+
+
+class CoordinatorProtocol(asyncio.Protocol):
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self.transport = None
+        self.buffer = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b"\n" not in self.buffer:
+            return
+        *lines, self.buffer = self.buffer.split(b"\n")
+        answers = []
+        for line in lines:
+            if line.strip():
+                answers.append(json.dumps(self._handle(line)).encode("utf8"))
+        self.transport.write(b"\n".join(answers) + b"\n")
+
+    def _handle(self, line):
+        request = {}
+        try:
+            request = json.loads(line.decode("utf8"))
+            delay = self.coordinator.lease(
+                request["link"],
+                request["direction"],
+                float(request["rate"]),
+                int(request["bytes"]),
+            )
+            return {"id": request["id"], "delay": delay}
+        except Exception as e:
+            return {"id": request.get("id"), "error": str(e)}
+
+
+async def start_coordinator(address, coordinator=None):
+    """Serves *coordinator* on *address*, a Unix socket path or a host:port.
+    """
+    if coordinator is None:
+        coordinator = Coordinator()
+    loop = asyncio.get_event_loop()
+
+    def factory():
+        return CoordinatorProtocol(coordinator)
+
+    if ":" in address:
+        host, port = parse_address(address)
+        return await loop.create_server(factory, host, port)
+    return await loop.create_unix_server(factory, address)
+
+
+class CoordinatorClient(asyncio.Protocol):
+    """Connection to the coordinator, shared by all the coordinated links.
+
+    Leases fail with CoordinatorUnavailable when the coordinator doesn't
+    answer within *timeout* seconds. It's not tried again for
+    *retry_delay* seconds.
+    """
+
+    def __init__(self, address, timeout=0.5, retry_delay=5.0):
+        self.address = address
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.transport = None
+        self.buffer = b""
+        self.logger = get_logger()
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._connecting = None
+        self._down_until = 0.0
+
+    async def _connect(self):
+        loop = asyncio.get_event_loop()
+        if ":" in self.address:
+            host, port = parse_address(self.address)
+            connect = loop.create_connection(lambda: self, host, port)
+        else:
+            connect = loop.create_unix_connection(lambda: self, self.address)
+        await asyncio.wait_for(connect, self.timeout)
+
+    def _connected(self, connecting):
+        self._connecting = None
+        if connecting.cancelled():
+            return
+        exc = connecting.exception()
+        if exc is not None:
+            self._down(exc)
+
+    def _down(self, exc):
+        if self._down_until == 0.0:
+            self.logger.warning(
+                "Coordinator %s unavailable, shaping locally: %s", self.address, exc
+            )
+        STATS.incr("coordinator.errors")
+        self._down_until = time.monotonic() + self.retry_delay
+        if self.transport is not None:
+            self.transport.close()
+
+    async def lease(self, link, direction, rate, size):
+        """Returns the delay after which *size* bytes can be sent on *link*.
+        """
+        if self.transport is None:
+            if time.monotonic() < self._down_until:
+                raise CoordinatorUnavailable(self.address)
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+                self._connecting.add_done_callback(self._connected)
+            try:
+                await asyncio.shield(self._connecting)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise CoordinatorUnavailable(str(e))
+        request_id = next(self._ids)
+        answer = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = answer
+        request = {
+            "id": request_id,
+            "link": link,
+            "direction": direction,
+            "rate": rate,
+            "bytes": size,
+        }
+        self.transport.write(json.dumps(request).encode("utf8") + b"\n")
+        try:
+            res = await asyncio.wait_for(answer, self.timeout)
+        except asyncio.TimeoutError as e:
+            self._down(e)
+            raise CoordinatorUnavailable("timeout")
+        finally:
+            self._pending.pop(request_id, None)
+        if "error" in res:
+            raise CoordinatorUnavailable(res["error"])
+        return res["delay"]
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._down_until > 0.0:
+            self.logger.info("Coordinator %s is back", self.address)
+        self._down_until = 0.0
+
+    def data_received(self, data):
+        self.buffer += data
+        if b"\n" not in self.buffer:
+            return
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            res = json.loads(line.decode("utf8"))
+            answer = self._pending.pop(res.get("id"), None)
+            if answer is not None and not answer.done():
+                answer.set_result(res)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.buffer = b""
+        pending, self._pending = self._pending, {}
+        for answer in pending.values():
+            if not answer.done():
+                answer.set_exception(CoordinatorUnavailable("connection lost"))
+        if self._down_until == 0.0:
+            self._down(exc or ConnectionResetError("connection closed"))
+
+    def controls(self, link):
+        """Returns the bandwidth controls of *link*, per direction.
+        """
+        return {
+            "in": CoordinatedControl(self, link, "in"),
+            "out": CoordinatedControl(self, link, "out"),
+        }
+
+    def close(self):
+        if self.transport is not None:
+            # not an outage
+            self._down_until = -1.0
+            self.transport.close()
+
+
+class CoordinatedControl(BandwidthControl):
+    """BandwidthControl of a link shared with other tinap instances.
+
+    Chunks need bytes leased from the coordinator before they are paced
+    locally. The Throttlers of the link share the leases. When the
+    coordinator can't be reached, only the local pacing applies.
+    """
+
+    __slots__ = ("client", "link", "direction", "tokens", "expires", "_lease")
+
+    def __init__(self, client, link, direction):
+        super(CoordinatedControl, self).__init__()
+        self.client = client
+        self.link = link
+        self.direction = direction
+        self.tokens = 0
+        self.expires = 0.0
+        self._lease = None
+
+    async def available(self, data, maxbps):
+        if maxbps == 0:
+            return
+        size = len(data)
+        while True:
+            if time.monotonic() > self.expires:
+                self.tokens = 0
+            if self.tokens >= size:
+                break
+            if self._lease is None:
+                batch = max(size, int(maxbps * LEASE_DURATION), MIN_LEASE)
+                self._lease = asyncio.ensure_future(self._renew(batch, maxbps))
+            # a cancelled chunk should not cancel the lease of the others
+            await asyncio.shield(self._lease)
+        self.tokens -= size
+        await super(CoordinatedControl, self).available(data, maxbps)
+
+    async def _renew(self, size, rate):
+        try:
+            try:
+                delay = await self.client.lease(self.link, self.direction, rate, size)
+                STATS.incr("coordinator.leases")
+            except CoordinatorUnavailable:
+                STATS.incr("coordinator.local")
+                delay = 0.0
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.tokens += size
+            self.expires = time.monotonic() + TOKEN_TTL
+        finally:
+            self._lease = None
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        print(__doc__.strip().splitlines()[-1])
+        return 1
+    logger = set_logger()
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(start_coordinator(argv[0]))
+    logger.info("Coordinator listening on %s" % argv[0])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# encoding: utf-8
+"""Diagnostics of a running instance.
+
+Nothing is tracked until a diagnosis is requested, with SIGUSR1 or the
+"diagnose" control command. Each one writes, in the diagnostics
+directory:
+
+- <name>.state.txt: the mappings, the queue depths of the Throttlers of
+  their connections, the asyncio tasks by coroutine, and the counters.
+- <name>.alloc.txt: the memory allocations that grew since the first
+  diagnosis, which starts tracemalloc and takes the baseline.
+- <name>.prof and <name>.prof.txt: the loop profiled with cProfile for
+  the next *duration* seconds, as pstats data and sorted by cumulative
+  time.
+"""
+import asyncio
+import collections
+import io
+import os
+import time
+
+from tinap.limits import get_admission
+from tinap.stats import STATS
+from tinap.util import get_logger
+
+
+class Diagnostics:
+    """Writes the diagnoses of the *mappings* in *directory* (the
+    temporary directory by default).
+    """
+
+    def __init__(self, mappings, directory=None, duration=10.0, top=30):
+        self.mappings = mappings
+        self.directory = directory
+        self.duration = duration
+        self.top = top
+        self.logger = get_logger()
+        self._count = 0
+        self._baseline = None
+        self._profiler = None
+        self._profile_path = None
+        self._profile_handle = None
+
+    def _path(self, suffix):
+        if self.directory is None:
+            import tempfile
+
+            self.directory = tempfile.gettempdir()
+        name = "tinap-%d-%d.%s" % (os.getpid(), self._count, suffix)
+        return os.path.join(self.directory, name)
+
+    def run(self):
+        """Writes the state and the allocations, and starts profiling.
+
+        Returns the paths of the files, by kind.
+        """
+        self._count += 1
+        paths = {"state": self._path("state.txt"), "alloc": self._path("alloc.txt")}
+        with open(paths["state"], "w") as f:
+            self._write_state(f)
+        with open(paths["alloc"], "w") as f:
+            self._write_allocations(f)
+        if self._profiler is None:
+            self._start_profile(self._path("prof"))
+        paths["profile"] = self._profile_path
+        self.logger.info(
+            "Diagnostics written to %s, profiling for %ss",
+            ", ".join(paths.values()),
+            self.duration,
+        )
+        return paths
+
+    def _write_state(self, f):
+        f.write("%s pid=%d\n\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), os.getpid()))
+        for mapping in self.mappings:
+            f.write("%s (%s)\n" % (mapping, mapping.profile))
+            for peer, throttler in mapping.throttlers():
+                backlog, queued, inflight, paused = throttler.queue_state()
+                f.write(
+                    "  %s %s queued=%dB/%d inflight=%d%s\n"
+                    % (
+                        peer and "%s:%d" % peer[:2] or "-",
+                        throttler.name,
+                        backlog,
+                        queued,
+                        inflight,
+                        paused and " paused" or "",
+                    )
+                )
+        admission = get_admission()
+        if admission is not None:
+            f.write(
+                "\nAdmission: %s, loop lag %.1fms, %d bytes queued, %d held\n"
+                % (
+                    admission.overloaded and "overloaded" or "normal",
+                    admission.lag * 1000,
+                    admission.queued,
+                    len(admission),
+                )
+            )
+        tasks = asyncio.all_tasks()
+        coros = collections.Counter(
+            getattr(task.get_coro(), "__qualname__", "?") for task in tasks
+        )
+        f.write("\nTasks: %d\n" % len(tasks))
+        for name, count in coros.most_common():
+            f.write("  %s: %d\n" % (name, count))
+        f.write("\n")
+        for line in STATS.report():
+            f.write(line + "\n")
+
+    def _write_allocations(self, f):
+        # the profiling modules are only needed once a diagnosis is asked
+        import tracemalloc
+
+        if self._baseline is None:
+            tracemalloc.start()
+            self._baseline = tracemalloc.take_snapshot()
+            f.write("Baseline taken, the next diagnosis shows the growth.\n")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        f.write("Traced: %d bytes, peak: %d bytes\n\n" % (current, peak))
+        for stat in snapshot.compare_to(self._baseline, "lineno")[: self.top]:
+            f.write("%s\n" % stat)
+
+    def _start_profile(self, path):
+        import cProfile
+
+        self._profile_path = path
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        self._profile_handle = asyncio.get_event_loop().call_later(
+            self.duration, self._stop_profile
+        )
+
+    def _stop_profile(self):
+        import pstats
+
+        self._profile_handle = None
+        profiler, self._profiler = self._profiler, None
+        profiler.disable()
+        profiler.dump_stats(self._profile_path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(
+            self.top * 2
+        )
+        with open(self._profile_path + ".txt", "w") as f:
+            f.write(out.getvalue())
+        self.logger.info("Profile written to %s", self._profile_path)
+
+    def close(self):
+        """Writes the running profile, and stops tracing the allocations.
+        """
+        if self._profile_handle is not None:
+            self._profile_handle.cancel()
+            self._stop_profile()
+        if self._baseline is not None:
+            import tracemalloc
+
+            self._baseline = None
+            tracemalloc.stop()
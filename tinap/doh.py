@@ -20,9 +20,13 @@ Read DNS.rst for more info
 """
 import asyncio
 import collections
+import logging
+import signal
+import socket
 import struct
+import sys
 import time
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import io
 import argparse
 import ssl
@@ -33,14 +37,18 @@ import base64
 import dns.message
 import dns.rcode
 import dns.entropy
-import dns.message
+import dns.exception
+import dns.flags
 
 from h2.config import H2Configuration
 from h2.connection import H2Connection
 from h2.events import ConnectionTerminated, DataReceived, RequestReceived, StreamEnded
 from h2.exceptions import ProtocolError
 
-from tinap.util import get_logger, set_logger
+from tinap.stats import STATS
+from tinap.tls import Passphrase, count_handshake, create_context
+from tinap.udp import drain
+from tinap.util import get_logger, set_logger, stop_logger, cancel_tasks
 
 
 DOH_URI = "/dns-query"
@@ -119,21 +127,28 @@ class DNSClient:
     async def query_udp(self, dnsq, clientip, timeout=DEFAULT_TIMEOUT):
         qid = dnsq.id
         fut = asyncio.Future()
-        await self.loop.create_datagram_endpoint(
-            lambda: DNSClientProtocolUDP(dnsq, fut, clientip, logger=self.logger),
-            remote_addr=(self.upstream_resolver, self.upstream_port),
-        )
-        return await self._try_query(fut, qid, timeout)
+        try:
+            await self.loop.create_datagram_endpoint(
+                lambda: DNSClientProtocolUDP(dnsq, fut, clientip, logger=self.logger),
+                remote_addr=(self.upstream_resolver, self.upstream_port),
+            )
+            return await self._try_query(fut, qid, timeout)
+        finally:
+            # sent upstream with a random id, the errors are built from it
+            dnsq.id = qid
 
     async def query_tcp(self, dnsq, clientip, timeout=DEFAULT_TIMEOUT):
         qid = dnsq.id
         fut = asyncio.Future()
-        await self.loop.create_connection(
-            lambda: DNSClientProtocolTCP(dnsq, fut, clientip, logger=self.logger),
-            self.upstream_resolver,
-            self.upstream_port,
-        )
-        return await self._try_query(fut, qid, timeout)
+        try:
+            await self.loop.create_connection(
+                lambda: DNSClientProtocolTCP(dnsq, fut, clientip, logger=self.logger),
+                self.upstream_resolver,
+                self.upstream_port,
+            )
+            return await self._try_query(fut, qid, timeout)
+        finally:
+            dnsq.id = qid
 
     async def _try_query(self, fut, qid, timeout):
         try:
@@ -177,20 +192,23 @@ class DNSClientProtocol(asyncio.Protocol):
     def send_helper(self, transport):
         self.transport = transport
         self.dnsq.id = dns.entropy.random_16()
-        self.logger.info("[DNS] {} {}".format(self.clientip, dnsquery2log(self.dnsq)))
+        # formatting queries is costly, only do it when it's logged
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("[DNS] %s %s", self.clientip, dnsquery2log(self.dnsq))
         self.time_stamp = time.time()
 
     def receive_helper(self, dnsr):
-        interval = int((time.time() - self.time_stamp) * 1000)
-        log_message = "[DNS] {} {} {}ms".format(
-            self.clientip, dnsans2log(dnsr), interval
-        )
-
-        if not self.fut.cancelled():
-            self.logger.info(log_message)
+        cancelled = self.fut.cancelled()
+        if not cancelled:
             self.fut.set_result(dnsr)
-        else:
-            self.logger.info(log_message + "(CANCELLED)")
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                "[DNS] %s %s %dms%s",
+                self.clientip,
+                dnsans2log(dnsr),
+                (time.time() - self.time_stamp) * 1000,
+                cancelled and "(CANCELLED)" or "",
+            )
 
 
 class DNSClientProtocolUDP(DNSClientProtocol):
@@ -238,6 +256,294 @@ class DNSClientProtocolTCP(DNSClientProtocol):
         self.transport.close()
 
 
+def question_key(msg: dns.message.Message) -> Optional[str]:
+    """ Helper function to return the cache key of the question of a message
+    """
+    if len(msg.question) != 1:
+        return None
+    q = msg.question[0]
+    return "{} {} {}".format(q.name.to_text().lower(), q.rdtype, q.rdclass)
+
+
+def answer_ttl(msg: dns.message.Message) -> int:
+    """ Helper function to return how long an answer can be cached, 0 if
+    it can't be.
+    """
+    if msg.flags & dns.flags.TC:
+        return 0
+    if msg.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        return 0
+    rrsets = msg.answer + msg.authority
+    if not rrsets:
+        return 0
+    return min(r.ttl for r in rrsets)
+
+
+class AnswerCache:
+    """DNS answers, kept until their TTL expires.
+
+    At most *maxsize* answers are kept, the least recently used ones are
+    evicted first. Answers are stored in wire format, and served with the
+    id of the query and their remaining TTL.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, dnsq: dns.message.Message) -> Optional[dns.message.Message]:
+        key = question_key(dnsq)
+        entry = key is not None and self._lookup(key) or None
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, wire = entry
+        dnsr = dns.message.from_wire(wire)
+        if question_key(dnsr) != key:
+            # hash collision in the shared table
+            self.misses += 1
+            return None
+        self.hits += 1
+        dnsr.id = dnsq.id
+        remaining = max(int(expires - time.time()), 0)
+        for section in (dnsr.answer, dnsr.authority, dnsr.additional):
+            for rrset in section:
+                rrset.ttl = min(rrset.ttl, remaining)
+        return dnsr
+
+    def put(self, dnsr: dns.message.Message):
+        key = question_key(dnsr)
+        ttl = answer_ttl(dnsr)
+        if key is None or ttl <= 0 or self.maxsize <= 0:
+            return
+        self._store(key, time.time() + ttl, dnsr.to_wire())
+
+    def _lookup(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def _store(self, key, expires, wire):
+        self._cache[key] = expires, wire
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
+# slot of the shared table: key digest, expiration, answer size, answer
+_SLOT = struct.Struct("<QdH")
+SLOT_SIZE = 1280
+
+
+class SharedAnswerCache(AnswerCache):
+    """AnswerCache shared by the processes forked after its creation.
+
+    The answers are kept in a table of *maxsize* slots, in an anonymous
+    shared memory mapping. A question always goes in the same slot, so a
+    newer answer replaces the one that was there. Answers that don't fit
+    in a slot are not cached.
+    """
+
+    def __init__(self, maxsize=1024):
+        # only imported with --shared-cache
+        import hashlib
+        import mmap
+        import multiprocessing
+
+        super().__init__(maxsize)
+        self.slots = max(maxsize, 1)
+        self._table = mmap.mmap(-1, self.slots * SLOT_SIZE)
+        self._lock = multiprocessing.Lock()
+        self._blake2b = hashlib.blake2b
+
+    def _offset(self, key):
+        digest = self._blake2b(key.encode("utf-8"), digest_size=8).digest()
+        digest = int.from_bytes(digest, "little")
+        return digest, (digest % self.slots) * SLOT_SIZE
+
+    def _lookup(self, key):
+        digest, offset = self._offset(key)
+        start = offset + _SLOT.size
+        with self._lock:
+            slot_digest, expires, size = _SLOT.unpack_from(self._table, offset)
+            if slot_digest != digest or size == 0 or expires <= time.time():
+                return None
+            return expires, self._table[start : start + size]
+
+    def _store(self, key, expires, wire):
+        if len(wire) > SLOT_SIZE - _SLOT.size:
+            return
+        digest, offset = self._offset(key)
+        start = offset + _SLOT.size
+        with self._lock:
+            _SLOT.pack_into(self._table, offset, digest, expires, len(wire))
+            self._table[start : start + len(wire)] = wire
+
+
+class Prefetcher:
+    """Refreshes the popular answers of *cache* before they expire.
+
+    Hits are counted per question, since its answer was stored. When an
+    answer that got at least *min_hits* hits is served with less than
+    *fraction* of its TTL left, it's queried again in the background. At
+    most *concurrency* refreshes run at once, the ones over the limit are
+    skipped, so the upstream resolver is never flooded.
+    """
+
+    def __init__(
+        self,
+        cache: AnswerCache,
+        upstream_resolver: str,
+        upstream_port: int,
+        fraction: float = 0.1,
+        min_hits: int = 3,
+        concurrency: int = 4,
+        logger=None,
+    ):
+        self.cache = cache
+        self.upstream_resolver = upstream_resolver
+        self.upstream_port = upstream_port
+        self.fraction = fraction
+        self.min_hits = min_hits
+        self.concurrency = concurrency
+        if logger is None:
+            logger = get_logger()
+        self.logger = logger
+        # question -> [ttl, hits, refreshed by a prefetch]
+        self._entries = collections.OrderedDict()
+        self._running = set()
+
+    def stored(self, dnsr: dns.message.Message, prefetched: bool = False):
+        key = question_key(dnsr)
+        ttl = answer_ttl(dnsr)
+        if key is None or ttl <= 0:
+            return
+        self._entries[key] = [ttl, 0, prefetched]
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(self.cache.maxsize, 1):
+            self._entries.popitem(last=False)
+
+    def missed(self, dnsq: dns.message.Message):
+        entry = self._entries.get(question_key(dnsq))
+        if entry is not None and entry[1] >= self.min_hits:
+            # a popular answer expired before it was refreshed
+            STATS.incr("doh.prefetch.misses")
+
+    def hit(self, dnsq: dns.message.Message, dnsr: dns.message.Message):
+        key = question_key(dnsq)
+        entry = self._entries.get(key)
+        if entry is None:
+            # stored by another worker, its remaining TTL will do
+            self.stored(dnsr)
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+        entry[1] += 1
+        if entry[2]:
+            STATS.incr("doh.prefetch.hits")
+        if entry[1] < self.min_hits or key in self._running:
+            return
+        if answer_ttl(dnsr) > entry[0] * self.fraction:
+            return
+        if len(self._running) >= self.concurrency:
+            STATS.incr("doh.prefetch.skipped")
+            return
+        self._running.add(key)
+        asyncio.ensure_future(self._refresh(key, dns.message.from_wire(dnsq.to_wire())))
+
+    async def _refresh(self, key: str, dnsq: dns.message.Message):
+        try:
+            dnsclient = DNSClient(
+                self.upstream_resolver, self.upstream_port, logger=self.logger
+            )
+            dnsr = await dnsclient.query(dnsq, "prefetch")
+        except OSError as e:
+            self.logger.debug("Prefetch of %s failed: %s", key, e)
+            dnsr = None
+        finally:
+            self._running.discard(key)
+        if dnsr is None:
+            STATS.incr("doh.prefetch.errors")
+            return
+        STATS.incr("doh.prefetch.refreshed")
+        self.cache.put(dnsr)
+        self.stored(dnsr, prefetched=True)
+
+
+class DNSResolver:
+    """Resolution path shared by the DoH and the plain DNS listeners:
+    the answer cache, its prefetcher, then the upstream resolver.
+    """
+
+    def __init__(
+        self,
+        upstream_resolver: str,
+        upstream_port: int,
+        cache: Optional[AnswerCache] = None,
+        prefetcher: Optional[Prefetcher] = None,
+        logger=None,
+        timeout: float = DNSClient.DEFAULT_TIMEOUT,
+    ):
+        self.upstream_resolver = upstream_resolver
+        self.upstream_port = upstream_port
+        self.cache = cache
+        self.prefetcher = prefetcher
+        self.timeout = timeout
+        if logger is None:
+            logger = get_logger()
+        self.logger = logger
+
+    def cached(self, dnsq: dns.message.Message) -> Optional[dns.message.Message]:
+        """ Returns the cached answer of *dnsq*, or None
+        """
+        if self.cache is None:
+            return None
+        dnsr = self.cache.get(dnsq)
+        if self.prefetcher is not None:
+            if dnsr is None:
+                self.prefetcher.missed(dnsq)
+            else:
+                self.prefetcher.hit(dnsq, dnsr)
+        return dnsr
+
+    async def query(self, dnsq, clientip) -> Optional[dns.message.Message]:
+        """ Asks the upstream resolver, and caches the answer
+        """
+        dnsclient = DNSClient(
+            self.upstream_resolver, self.upstream_port, logger=self.logger
+        )
+        dnsr = await dnsclient.query(dnsq, clientip, timeout=self.timeout)
+        if dnsr is not None and self.cache is not None:
+            self.cache.put(dnsr)
+            if self.prefetcher is not None:
+                self.prefetcher.stored(dnsr)
+        return dnsr
+
+    async def resolve(self, dnsq, clientip) -> Optional[dns.message.Message]:
+        dnsr = self.cached(dnsq)
+        if dnsr is None:
+            dnsr = await self.query(dnsq, clientip)
+        return dnsr
+
+
+def create_cache(options: argparse.Namespace) -> Optional[AnswerCache]:
+    """ Create the DNS answer cache of the proxies
+    :param options: where to find the cache size, and if it's shared
+    :return: An AnswerCache, or None when caching is disabled
+    """
+    if options.cache_size <= 0:
+        return None
+    if options.shared_cache:
+        return SharedAnswerCache(options.cache_size)
+    return AnswerCache(options.cache_size)
+
+
 RequestData = collections.namedtuple("RequestData", ["headers", "data"])
 
 
@@ -325,6 +631,9 @@ class H2Protocol(asyncio.Protocol):
         uri=None,
         logger=None,
         debug=False,
+        cache=None,
+        connections=None,
+        prefetcher=None,
     ):
         config = H2Configuration(client_side=False, header_encoding="utf-8")
         self.conn = H2Connection(config=config)
@@ -336,6 +645,14 @@ class H2Protocol(asyncio.Protocol):
         self.stream_data = {}
         self.upstream_resolver = upstream_resolver
         self.upstream_port = upstream_port
+        self.resolver = DNSResolver(
+            upstream_resolver,
+            upstream_port,
+            cache=cache,
+            prefetcher=prefetcher,
+            logger=self.logger,
+        )
+        self.connections = connections
         self.time_stamp = 0
         self.uri = DOH_URI if uri is None else uri
         assert upstream_resolver is not None, "An upstream resolver must be provided"
@@ -343,9 +660,23 @@ class H2Protocol(asyncio.Protocol):
 
     def connection_made(self, transport: asyncio.Transport):  # type: ignore
         self.transport = transport
+        count_handshake(transport)
+        if self.connections is not None:
+            self.connections.add(self)
         self.conn.initiate_connection()
         self.transport.write(self.conn.data_to_send())
 
+    def connection_lost(self, exc):
+        if self.connections is not None:
+            self.connections.discard(self)
+
+    def goaway(self):
+        """
+        Ask the client to send its next queries on a new connection.
+        """
+        self.conn.close_connection()
+        self.transport.write(self.conn.data_to_send())
+
     def data_received(self, data: bytes):
         try:
             events = self.conn.receive_data(data)
@@ -425,8 +756,9 @@ class H2Protocol(asyncio.Protocol):
             self.return_400(stream_id, body=e.body())
             return
 
-        clientip = self.transport.get_extra_info("peername")[0]
-        self.logger.info("[HTTPS] {} {}".format(clientip, dnsquery2log(dnsq)))
+        if self.logger.isEnabledFor(logging.INFO):
+            clientip = self.transport.get_extra_info("peername")[0]
+            self.logger.info("[HTTPS] %s %s", clientip, dnsquery2log(dnsq))
         self.time_stamp = time.time()
         asyncio.ensure_future(self.resolve(dnsq, stream_id))
 
@@ -443,17 +775,19 @@ class H2Protocol(asyncio.Protocol):
             ("server", "asyncio-h2"),
         ]
         if dnsr is None:
-            dnsr = dns.message.make_response(dnsq)
-            dnsr.set_rcode(dns.rcode.SERVFAIL)
+            dnsr = servfail(dnsq)
         elif len(dnsr.answer):
             ttl = min(r.ttl for r in dnsr.answer)
             response_headers.append(("cache-control", "max-age={}".format(ttl)))
 
-        clientip = self.transport.get_extra_info("peername")[0]
-        interval = int((time.time() - self.time_stamp) * 1000)
-        self.logger.info(
-            "[HTTPS] {} {} {}ms".format(clientip, dnsans2log(dnsr), interval)
-        )
+        if self.logger.isEnabledFor(logging.INFO):
+            clientip = self.transport.get_extra_info("peername")[0]
+            self.logger.info(
+                "[HTTPS] %s %s %dms",
+                clientip,
+                dnsans2log(dnsr),
+                (time.time() - self.time_stamp) * 1000,
+            )
         if request_data.headers[":method"] == "HEAD":
             body = b""
         else:
@@ -468,11 +802,7 @@ class H2Protocol(asyncio.Protocol):
         # XXX Todo add network throttling here when activated.
         # (same options than tinap's main script)
         clientip = self.transport.get_extra_info("peername")[0]
-        dnsclient = DNSClient(
-            self.upstream_resolver, self.upstream_port, logger=self.logger
-        )
-        dnsr = await dnsclient.query(dnsq, clientip)
-
+        dnsr = await self.resolver.resolve(dnsq, clientip)
         if dnsr is None:
             self.on_answer(stream_id, dnsq=dnsq)
         else:
@@ -541,21 +871,225 @@ class H2Protocol(asyncio.Protocol):
             stream_data.data.write(data)
 
 
+def servfail(dnsq: dns.message.Message) -> dns.message.Message:
+    """ Helper function to return the answer sent when resolving failed
+    """
+    dnsr = dns.message.make_response(dnsq)
+    dnsr.set_rcode(dns.rcode.SERVFAIL)
+    return dnsr
+
+
+def answer_wire(
+    dnsq: dns.message.Message, dnsr: Optional[dns.message.Message], max_size: int
+) -> bytes:
+    """ Helper function to return the wire format of an answer, truncated
+    (TC flag, no records) when it does not fit in *max_size* bytes.
+    """
+    if dnsr is None:
+        dnsr = servfail(dnsq)
+    try:
+        return dnsr.to_wire(max_size=max_size)
+    except dns.exception.TooBig:
+        truncated = dns.message.make_response(dnsq)
+        truncated.flags |= dns.flags.TC
+        return truncated.to_wire()
+
+
+def udp_max_size(dnsq: dns.message.Message) -> int:
+    """ Helper function to return the largest UDP answer a client takes
+    """
+    if dnsq.edns >= 0:
+        return max(dnsq.payload, 512)
+    return 512
+
+
+class DNSDatagramServer:
+    """Plain DNS over UDP.
+
+    The socket is read directly from the event loop, draining up to
+    BATCH_SIZE datagrams per wakeup. Cached answers are sent right away,
+    the other queries are resolved in a task.
+
+    It has the same close()/wait_closed() API as an asyncio Server.
+    """
+
+    def __init__(self, resolver: DNSResolver, logger=None):
+        self.resolver = resolver
+        if logger is None:
+            logger = get_logger()
+        self.logger = logger
+        self.loop = asyncio.get_event_loop()
+        self.sock = None
+        self.sockets = []
+
+    async def start(self, host: str, port: int, reuse_port: bool = False):
+        infos = await self.loop.getaddrinfo(
+            host, port, type=socket.SOCK_DGRAM, flags=socket.AI_PASSIVE
+        )
+        family, type_, proto, __, address = infos[0]
+        sock = socket.socket(family, type_, proto)
+        try:
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setblocking(False)
+            sock.bind(address)
+            self.loop.add_reader(sock.fileno(), drain, sock, self._received)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        self.sockets = [sock]
+
+    def _received(self, data, addr):
+        try:
+            dnsq = dns.message.from_wire(data)
+        except Exception:
+            STATS.incr("dns.errors")
+            return
+        STATS.incr("dns.udp.queries")
+        dnsr = self.resolver.cached(dnsq)
+        if dnsr is not None:
+            self._send(dnsq, dnsr, addr)
+        else:
+            asyncio.ensure_future(self._resolve(dnsq, addr))
+
+    async def _resolve(self, dnsq, addr):
+        try:
+            dnsr = await self.resolver.query(dnsq, addr[0])
+        except Exception as exc:
+            # answered with a SERVFAIL
+            dnsr = None
+            STATS.incr("dns.errors")
+            self.logger.warning("Error resolving %s: %r", msg2question(dnsq), exc)
+        if self.sock is not None:
+            self._send(dnsq, dnsr, addr)
+
+    def _send(self, dnsq, dnsr, addr):
+        try:
+            self.sock.sendto(answer_wire(dnsq, dnsr, udp_max_size(dnsq)), addr)
+        except OSError:
+            # including a full send buffer, the client will retry
+            STATS.incr("dns.errors")
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    async def wait_closed(self):
+        pass
+
+
+class DNSStreamProtocol(asyncio.Protocol):
+    """Plain DNS over TCP.
+
+    Clients can pipeline length-prefixed queries. Each one is answered as
+    soon as it's resolved, so answers can come out of order (RFC 7766).
+    """
+
+    def __init__(self, resolver: DNSResolver, connections=None, logger=None):
+        self.resolver = resolver
+        self.connections = connections
+        if logger is None:
+            logger = get_logger()
+        self.logger = logger
+        self.transport = None
+        self.clientip = None
+        self.buffer = bytearray()
+        self.pending = 0
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.clientip = transport.get_extra_info("peername")[0]
+        if self.connections is not None:
+            self.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.connections is not None:
+            self.connections.discard(self)
+
+    def goaway(self):
+        """
+        Closes the connection once the pending queries are answered.
+        """
+        self.closing = True
+        if self.pending == 0 and self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data: bytes):
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= 2 and not self.transport.is_closing():
+            if self.closing:
+                # a draining connection doesn't take new queries
+                break
+            size = struct.unpack_from("!H", buffer, offset)[0]
+            if len(buffer) - offset - 2 < size:
+                break
+            self._query(bytes(buffer[offset + 2 : offset + 2 + size]))
+            offset += 2 + size
+        del buffer[:offset]
+
+    def _query(self, data: bytes):
+        try:
+            dnsq = dns.message.from_wire(data)
+        except Exception:
+            STATS.incr("dns.errors")
+            self.transport.close()
+            return
+        STATS.incr("dns.tcp.queries")
+        dnsr = self.resolver.cached(dnsq)
+        if dnsr is not None:
+            self._send(dnsq, dnsr)
+        else:
+            self.pending += 1
+            asyncio.ensure_future(self._resolve(dnsq))
+
+    async def _resolve(self, dnsq):
+        try:
+            dnsr = await self.resolver.query(dnsq, self.clientip)
+        except Exception as exc:
+            # answered with a SERVFAIL
+            dnsr = None
+            STATS.incr("dns.errors")
+            self.logger.warning("Error resolving %s: %r", msg2question(dnsq), exc)
+        finally:
+            self.pending -= 1
+        if self.transport is None:
+            return
+        self._send(dnsq, dnsr)
+        if self.closing:
+            self.goaway()
+
+    def _send(self, dnsq, dnsr):
+        wire = answer_wire(dnsq, dnsr, 65535)
+        self.transport.write(struct.pack("!H", len(wire)) + wire)
+
+
 def create_ssl_context(
-    options: argparse.Namespace, http2: bool = False
+    options: argparse.Namespace, http2: bool = False, password=None
 ) -> ssl.SSLContext:
     """ Create SSL Context for the proxies
-    :param options: where to find the certile and the keyfile
+    :param options: where to find the certfiles and the keyfiles, and how
+    many session tickets to send
     :param http2: enable http2 into the context
+    :param password: passphrase of the keys, or a callable returning it
     :return: An instance of ssl.SSLContext to be used by the proxies
     """
-    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    ctx.load_cert_chain(options.certfile, keyfile=options.keyfile)
-    if http2:
-        ctx.set_alpn_protocols(["h2"])
-    ctx.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1 | ssl.OP_NO_COMPRESSION
-    ctx.set_ciphers(DOH_CIPHERS)
-    return ctx
+    certs = [(options.certfile, options.keyfile)]
+    if options.ecdsa_certfile is not None:
+        certs.append((options.ecdsa_certfile, options.ecdsa_keyfile))
+    return create_context(
+        certs,
+        password=password,
+        http2=http2,
+        tickets=options.tls_tickets,
+        ciphers=DOH_CIPHERS,
+    )
 
 
 def proxy_parser_base(*, port: int, secure: bool = True) -> argparse.ArgumentParser:
@@ -591,6 +1125,85 @@ def proxy_parser_base(*, port: int, secure: bool = True) -> argparse.ArgumentPar
     parser.add_argument(
         "--uri", default=DOH_URI, help="DNS API URI. Default [%(default)s]"
     )
+    parser.add_argument(
+        "--dns-port",
+        default=0,
+        type=int,
+        help="Also serve plain DNS, over UDP and TCP, on this port of the "
+        "listen addresses. 0 disables it. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes serving the listen addresses, with "
+        "SO_REUSEPORT. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=1024,
+        type=int,
+        help="DNS answers kept in the cache, 0 disables it. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--shared-cache",
+        action="store_true",
+        help="Share the DNS answer cache between the workers.",
+    )
+    parser.add_argument(
+        "--prefetch-fraction",
+        default=0.1,
+        type=float,
+        help="Refresh the popular answers when they're served with less "
+        "than this fraction of their TTL left. 0 disables prefetching. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--prefetch-min-hits",
+        default=3,
+        type=int,
+        help="Hits an answer needs to be refreshed. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--prefetch-concurrency",
+        default=4,
+        type=int,
+        help="Maximum refreshes running at once, per worker. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--ecdsa-certfile",
+        help="ECDSA cert file, used instead of --certfile with the "
+        "clients that support it. Its handshakes are cheaper.",
+    )
+    parser.add_argument("--ecdsa-keyfile", help="ECDSA key file.")
+    parser.add_argument(
+        "--tls-tickets",
+        default=2,
+        type=int,
+        help="TLS 1.3 session tickets sent to the clients, so they can "
+        "resume their session. 0 disables resumption. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--ticket-rotation",
+        default=0,
+        type=float,
+        help="Seconds between two rotations of the session ticket keys. "
+        "Python can't change the keys of a running SSL context, so each "
+        "rotation starts a new generation of workers (even with --workers 1) "
+        "and drains the previous one: the tickets issued before are not "
+        "accepted anymore, so every client does a full handshake, and the "
+        "answer cache starts empty unless --shared-cache is used. "
+        "0 keeps the same keys. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        default=5.0,
+        type=float,
+        help="Seconds given to the clients to move to a new connection "
+        "when a worker stops. Default: [%(default)s]",
+    )
     parser.add_argument("--level", default="DEBUG", help="log level [%(default)s]")
     parser.add_argument("--debug", action="store_true", help="Debugging messages...")
     parser.add_argument(
@@ -599,15 +1212,55 @@ def proxy_parser_base(*, port: int, secure: bool = True) -> argparse.ArgumentPar
     return parser
 
 
-def main(args=None):
-    if args is None:
-        parser = proxy_parser_base(port=443, secure=True)
-        args = parser.parse_args()
-
-    set_logger(args.level)
+def _terminate(*args):
+    raise KeyboardInterrupt()
+
+
+def serve(
+    args: argparse.Namespace,
+    ssl_ctx: ssl.SSLContext,
+    cache: Optional[AnswerCache] = None,
+    reuse_port: bool = False,
+    ready=None,
+):
+    """ Run the proxies on all the listen addresses, until Ctrl+C is pressed
+    :param args: the options of the proxies
+    :param ssl_ctx: the SSL context of the proxies
+    :param cache: the AnswerCache, or None
+    :param reuse_port: bind with SO_REUSEPORT, so other processes can
+    serve the same addresses
+    :param ready: Event set once all the addresses are listened on
+    """
+    if reuse_port:
+        # the logging thread of the parent did not survive the fork
+        set_logger(args.level)
+        # the parent stops the workers on Ctrl+C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
     logger = get_logger()
-    ssl_ctx = create_ssl_context(args, http2=True)
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if reuse_port:
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    connections = set()
+    prefetcher = None
+    if cache is not None and args.prefetch_fraction > 0:
+        prefetcher = Prefetcher(
+            cache,
+            args.upstream_resolver,
+            args.upstream_port,
+            fraction=args.prefetch_fraction,
+            min_hits=args.prefetch_min_hits,
+            concurrency=args.prefetch_concurrency,
+            logger=logger,
+        )
+    resolver = DNSResolver(
+        args.upstream_resolver,
+        args.upstream_port,
+        cache=cache,
+        prefetcher=prefetcher,
+        logger=logger,
+    )
+    servers = []
     for addr in args.listen_address:
         coro = loop.create_server(
             lambda: H2Protocol(
@@ -616,24 +1269,202 @@ def main(args=None):
                 uri=args.uri,
                 logger=logger,
                 debug=args.debug,
+                cache=cache,
+                connections=connections,
+                prefetcher=prefetcher,
             ),
             host=addr,
             port=args.port,
             ssl=ssl_ctx,
+            reuse_port=reuse_port,
         )
         server = loop.run_until_complete(coro)
-
-        # Serve requests until Ctrl+C is pressed
-        logger.info("Serving on {}".format(server))
+        servers.append(server)
+        logger.info("Serving on {}".format(server.sockets[0].getsockname()))
+        if args.dns_port > 0:
+            udp = DNSDatagramServer(resolver, logger=logger)
+            loop.run_until_complete(udp.start(addr, args.dns_port, reuse_port))
+            tcp = loop.run_until_complete(
+                loop.create_server(
+                    lambda: DNSStreamProtocol(
+                        resolver, connections=connections, logger=logger
+                    ),
+                    host=addr,
+                    port=args.dns_port,
+                    reuse_port=reuse_port,
+                )
+            )
+            servers += [udp, tcp]
+            logger.info(
+                "Serving plain DNS on {}".format(udp.sockets[0].getsockname())
+            )
+    if ready is not None:
+        ready.set()
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
-    # Close the server
-    server.close()
-    loop.run_until_complete(server.wait_closed())
+    # Close the servers, and give the clients some time to get their
+    # answers and to move to a new connection
+    for server in servers:
+        server.close()
+    for protocol in list(connections):
+        protocol.goaway()
+    deadline = loop.time() + args.drain_timeout
+    while connections and loop.time() < deadline:
+        loop.run_until_complete(asyncio.sleep(0.1))
+    for protocol in list(connections):
+        if protocol.transport is not None:
+            protocol.transport.close()
+    for server in servers:
+        loop.run_until_complete(server.wait_closed())
+    cancel_tasks(loop)
     loop.close()
+    if cache is not None:
+        logger.info("Cache hits: %d, misses: %d", cache.hits, cache.misses)
+    for line in STATS.report():
+        logger.info(line)
+    if reuse_port:
+        stop_logger()
+
+
+class Workers:
+    """Processes serving the listen addresses with SO_REUSEPORT.
+
+    The SSL context is created before the workers are forked, so they all
+    have the same session ticket keys, and a client can resume its
+    session on any of them. When *rotation* is set, a new generation of
+    workers is started every *rotation* seconds with a new context, hence
+    new keys, and the previous generation is drained and stopped once the
+    new one is listening.
+
+    The ssl module can't set the ticket keys, so the previous keys can't
+    be kept to decrypt the tickets already issued: after a rotation, the
+    clients can't resume their sessions. The workers also start with the
+    answer cache of the parent, which is empty unless it's shared, and
+    with new prefetchers.
+    """
+
+    # seconds a new generation has to bind its listeners
+    START_TIMEOUT = 10.0
+
+    def __init__(self, args, cache, password=None, logger=None):
+        self.args = args
+        self.cache = cache
+        self.password = password
+        self.logger = logger is None and get_logger() or logger
+        self.generation = 0
+        self.current = []
+        self.draining = []
+        # only imported with --workers or --ticket-rotation
+        import multiprocessing
+
+        self._context = multiprocessing.get_context("fork")
+
+    def start(self):
+        """Starts a new generation, and drains the current one once the new
+        workers are listening.
+
+        Returns False when the new workers could not start, in which case
+        the current generation keeps running.
+        """
+        ssl_ctx = create_ssl_context(self.args, http2=True, password=self.password)
+        self.generation += 1
+        workers = []
+        for i in range(max(self.args.workers, 1)):
+            ready = self._context.Event()
+            worker = self._context.Process(
+                target=serve,
+                args=(self.args, ssl_ctx, self.cache, True, ready),
+                name="doh-worker-%d-%d" % (self.generation, i),
+            )
+            worker.start()
+            workers.append((worker, ready))
+        if not self._wait_ready(workers):
+            self.logger.error(
+                "Generation %d could not start, keeping generation %d",
+                self.generation,
+                self.generation - 1,
+            )
+            for worker, __ in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            return False
+        self.logger.info(
+            "Started %d workers, generation %d", len(workers), self.generation
+        )
+        for worker in self.current:
+            worker.terminate()
+        self.draining.extend(self.current)
+        self.current = [worker for worker, __ in workers]
+        return True
+
+    def _wait_ready(self, workers):
+        deadline = time.monotonic() + self.START_TIMEOUT
+        for worker, ready in workers:
+            while not ready.wait(0.05):
+                if not worker.is_alive() or time.monotonic() > deadline:
+                    return False
+        return True
+
+    def run(self):
+        """Runs until all the workers are gone, or Ctrl+C is pressed.
+        """
+        import multiprocessing.connection
+
+        rotation = self.args.ticket_rotation
+        self.start()
+        next_rotation = time.monotonic() + rotation
+        while self.current:
+            timeout = rotation > 0 and max(next_rotation - time.monotonic(), 0) or None
+            workers = self.current + self.draining
+            multiprocessing.connection.wait([w.sentinel for w in workers], timeout)
+            for worker in self.current:
+                if not worker.is_alive():
+                    self.logger.error(
+                        "%s exited with code %s", worker.name, worker.exitcode
+                    )
+            self.current = [w for w in self.current if w.is_alive()]
+            self.draining = [w for w in self.draining if w.is_alive()]
+            if rotation > 0 and time.monotonic() >= next_rotation:
+                self.start()
+                next_rotation += rotation
+
+    def stop(self):
+        # the draining workers are already stopping
+        for worker in self.current:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.current + self.draining:
+            worker.join()
+
+
+def main(args=None):
+    if args is None:
+        parser = proxy_parser_base(port=443, secure=True)
+        args = parser.parse_args()
+
+    set_logger(args.level)
+    logger = get_logger()
+    cache = create_cache(args)
+    if args.workers <= 1 and args.ticket_rotation <= 0:
+        serve(args, create_ssl_context(args, http2=True), cache)
+        return
+
+    if sys.platform == "win32":
+        logger.error("--workers and --ticket-rotation need fork() and SO_REUSEPORT")
+        raise SystemExit(1)
+    # new contexts are created without asking for the passphrase again
+    workers = Workers(args, cache, password=Passphrase(), logger=logger)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        workers.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        workers.stop()
 
 
 if __name__ == "__main__":
@@ -1,39 +1,82 @@
 import asyncio
-from queue import Queue, Empty
+import collections
+import random
 
-from tinap.util import append_upstream, remove_upstream, get_logger
+from tinap.util import append_upstream, remove_upstream, get_logger, get_capture
 from tinap.throttler import Throttler
+from tinap.bottleneck import create_discipline
+from tinap.stats import STATS
+from tinap.connect import Connector
+from tinap.limits import REAPER, ACCEPTED, WAITING, get_admission
+from tinap.profile import Profile
+from tinap.sockopts import SocketOptions
+from tinap.replay import ReplayUpstream, get_archive
+from tinap.hooks import connection_hooks
 
 
 class UpstreamConnection(asyncio.Protocol):
+    __slots__ = ("downstream", "offline_data", "transport", "logger", "_paused")
+
     def __init__(self, downstream):
         self.downstream = downstream
-        self.offline_data = Queue()
+        # data written before we're connected, created on demand
+        self.offline_data = None
         self.transport = None
-        self.logger = get_logger()
+        self.logger = downstream.logger
+        self._paused = False
 
     def connection_made(self, transport):
         self.logger.debug("Connection made")
         self.transport = transport
+        downstream = self.downstream
+        downstream.sockopts.apply(transport, downstream.profile, "in", "out")
         append_upstream(self)
-        # Dequeuing offline data if any...
-        # XXX move this to asyncio.Queue
-        while True:
-            try:
-                data = self.offline_data.get_nowait()
-            except Empty:
-                break
-            self.transport.write(data)
+        if self._paused:
+            transport.pause_reading()
+        if self.offline_data is not None:
+            while self.offline_data:
+                transport.write(self.offline_data.popleft())
+            self.offline_data = None
 
     def data_received(self, data):
         self.downstream.forward_data(data)
 
+    def pause_writing(self):
+        self.downstream.data_in.pause_writing()
+
+    def resume_writing(self):
+        self.downstream.data_in.resume_writing()
+
     def write(self, data):
         if self.transport is None:
-            self.offline_data.put_nowait(data)
+            if self.offline_data is None:
+                self.offline_data = collections.deque()
+            self.offline_data.append(data)
         else:
             self.transport.write(data)
 
+    def pause_reading(self):
+        self._paused = True
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        self._paused = False
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write_eof()
+
+    def eof_received(self):
+        self.downstream.upstream_eof()
+        # keep the connection half-open
+        return True
+
     def connection_lost(self, *args):
         remove_upstream(self)
         self.downstream.close()
@@ -45,53 +88,334 @@ class UpstreamConnection(asyncio.Protocol):
             return
         self.transport.close()
 
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
+
 
 class Forwarder(asyncio.Protocol):
-    def __init__(self, host, port, upstream_host, upstream_port, args):
+    # one per connection, so no __dict__
+    __slots__ = (
+        "downstream_host",
+        "downstream_port",
+        "host",
+        "port",
+        "upstream",
+        "loop",
+        "profile",
+        "link",
+        "client_link",
+        "data_in",
+        "data_out",
+        "transport",
+        "args",
+        "pool",
+        "connector",
+        "limit",
+        "_limit_acquired",
+        "sockopts",
+        "logger",
+        "handshake_delay",
+        "idle_timeout",
+        "max_lifetime",
+        "created",
+        "last_activity",
+        "closed",
+        "_accepted",
+        "bytes_in",
+        "bytes_out",
+        "access_log",
+        "capture",
+        "_eof_in",
+        "_eof_out",
+        "connections",
+        "recorder",
+        "hook_factories",
+        "hooks",
+        "admission",
+    )
+
+    def __init__(
+        self,
+        host,
+        port,
+        upstream_host,
+        upstream_port,
+        args,
+        profile=None,
+        pool=None,
+        connector=None,
+        limit=None,
+        link=None,
+        sockopts=None,
+        connections=None,
+        hooks=(),
+    ):
         self.downstream_host = host
         self.downstream_port = port
         self.host = upstream_host
         self.port = upstream_port
         self.upstream = None
         self.loop = asyncio.get_event_loop()
-        self.latency = args.rtt
+        if link is not None:
+            profile = link.profile
+        elif profile is None:
+            profile = Profile(args.rtt, args.inkbps, args.outkbps)
+        self.profile = profile
+        self.link = link
+        self.client_link = None
         self.data_in = None
         self.data_out = None
-        self.outkbps = args.outkbps
-        self.inkbps = args.inkbps
         self.transport = None
         self.args = args
+        self.pool = pool
+        if connector is None:
+            connector = Connector()
+        self.connector = connector
+        self.limit = limit
+        # held or rejected while overloaded, the slot was never taken
+        self._limit_acquired = False
+        if sockopts is None:
+            sockopts = SocketOptions.from_args(args)
+        self.sockopts = sockopts
         self.logger = get_logger()
+        self.handshake_delay = 0.0
+        self.idle_timeout = args.idle_timeout
+        self.max_lifetime = args.max_lifetime
+        self.created = self.last_activity = self.loop.time()
+        self.closed = False
+        self._accepted = 0.0
+        self.bytes_in = self.bytes_out = 0
+        # a sample of the connections get an access log line when closed
+        rate = args.access_log
+        self.access_log = rate > 0 and (rate >= 1 or random.random() < rate)
+        self.capture = None
+        self._eof_in = self._eof_out = False
+        # the open connections of the mapping
+        self.connections = connections
+        self.recorder = None
+        # see tinap.hooks, resolved when the connection starts
+        self.hook_factories = hooks
+        self.hooks = None
+        self.admission = None
 
     async def _sconnect(self):
+        if self.handshake_delay > 0:
+            self._accepted = self.loop.time()
+            await asyncio.sleep(self.handshake_delay)
+            if self.closed:
+                return
+        if isinstance(self.upstream, ReplayUpstream):
+            self._connected()
+            self.upstream.start()
+            return
+        if self.pool is not None and self.pool.acquire(self.upstream) is not None:
+            self._connected()
+            return
         try:
-            await asyncio.wait_for(
-                self.loop.create_connection(
-                    lambda: self.upstream, self.host, self.port
-                ),
-                timeout=5,
-            )
-        except (asyncio.TimeoutError, OSError):
-            print("Timeout or error connecting to %s:%d" % (self.host, self.port))
-            self.close()
+            await self.connector.connect(lambda: self.upstream, self.host, self.port)
+        except (asyncio.TimeoutError, OSError) as e:
+            self._connect_failed(e)
+            return
+        self._connected()
+
+    def _connect_failed(self, exc):
+        self.logger.warning(
+            "Timeout or error connecting to %s:%s: %s", self.host, self.port, exc
+        )
+        self.close()
+
+    def _connected(self):
+        if self.closed:
+            self.upstream.close()
             return
+        if self.handshake_delay > 0:
+            elapsed = self.loop.time() - self._accepted
+            STATS.timing("shaping.handshake", elapsed)
+            STATS.timing("shaping.handshake_lateness", elapsed - self.handshake_delay)
+            self.transport.resume_reading()
         self.data_in.start()
         self.data_out.start()
 
     def connection_made(self, transport):
         self.transport = transport
-        self.upstream = UpstreamConnection(self)
-        self.data_in = Throttler("up", self.upstream, self.latency, self.inkbps)
-        self.data_out = Throttler("down", self.transport, self.latency, self.outkbps)
+        if self.connections is not None:
+            self.connections.add(self)
+        self.sockopts.apply(transport, self.profile, "out", "in")
+        admission = get_admission()
+        if admission is not None and admission.overloaded:
+            self.admission = admission
+            if admission.acquire(self) == WAITING:
+                # we'll be admitted when the load drops
+                transport.pause_reading()
+                return
+            self.logger.debug(
+                "Overloaded, closing a connection on %s:%d",
+                self.downstream_host,
+                self.downstream_port,
+            )
+            transport.close()
+            return
+        self.admit()
+
+    def admit(self):
+        if self.limit is not None:
+            state = self.limit.acquire(self)
+            self._limit_acquired = state in (ACCEPTED, WAITING)
+            if state == WAITING:
+                # we'll start when a slot is freed
+                self.transport.pause_reading()
+                return
+            if state != ACCEPTED:
+                self.logger.debug(
+                    "Too many connections on %s:%d",
+                    self.downstream_host,
+                    self.downstream_port,
+                )
+                self.limit = None
+                self.transport.close()
+                return
+        self.start()
+
+    def start(self):
+        if self.idle_timeout > 0 or self.max_lifetime > 0:
+            self.created = self.last_activity = self.loop.time()
+            REAPER.add(self)
+        transport = self.transport
+        peername = transport.get_extra_info("peername")
+        if self.link is not None:
+            self.client_link = self.link.acquire(peername and peername[0])
+        capture = get_capture()
+        # the client may be gone already
+        if capture is not None and peername:
+            self.capture = capture.connection(
+                peername, transport.get_extra_info("sockname")
+            )
+        archive = get_archive()
+        if archive is not None and archive.replay:
+            self.upstream = archive.upstream(self, "%s:%s" % (self.host, self.port))
+        else:
+            self.upstream = UpstreamConnection(self)
+            if archive is not None:
+                self.recorder = archive.connection("%s:%s" % (self.host, self.port))
+        if self.hook_factories:
+            self.hooks = connection_hooks(self.hook_factories, self)
+        # connection setup costs that many round trips on the emulated link
+        self.handshake_delay = self.args.handshake_rtts * self.profile.rtt / 1000.0
+        self.data_in = Throttler(
+            "up",
+            self.upstream,
+            self.profile,
+            "in",
+            discipline=self._create_discipline(),
+            source=self.transport,
+            bandwidth_control=self._bandwidth_control("in"),
+            capture=self.capture,
+            hooks=self.hooks,
+        )
+        self.data_out = Throttler(
+            "down",
+            self.transport,
+            self.profile,
+            "out",
+            discipline=self._create_discipline(),
+            source=self.upstream,
+            bandwidth_control=self._bandwidth_control("out"),
+            capture=self.capture,
+            hooks=self.hooks,
+        )
+        if self.handshake_delay > 0:
+            # the client can't send anything until the handshake is over
+            transport.pause_reading()
+        else:
+            transport.resume_reading()
         asyncio.ensure_future(self._sconnect())
 
+    def _bandwidth_control(self, direction):
+        if self.client_link is None:
+            return None
+        return self.client_link.controls[direction]
+
+    def _create_discipline(self):
+        return create_discipline(
+            self.args.queue_discipline,
+            self.args.queue_limit,
+            self.args.codel_target,
+            self.args.codel_interval,
+        )
+
+    def expired(self, now):
+        if self.max_lifetime > 0 and now - self.created > self.max_lifetime:
+            return "lifetime"
+        if self.idle_timeout > 0 and now - self.last_activity > self.idle_timeout:
+            if not self.data_in.busy() and not self.data_out.busy():
+                return "idle"
+        return None
+
+    def pause_writing(self):
+        if self.data_out is not None:
+            self.data_out.pause_writing()
+
+    def resume_writing(self):
+        if self.data_out is not None:
+            self.data_out.resume_writing()
+
+    def eof_received(self):
+        # the client won't send anything else
+        self._eof_in = True
+        if self.data_in is not None:
+            self.data_in.put_eof()
+        if self._eof_out:
+            self.close()
+        return True
+
+    def upstream_eof(self):
+        if self.recorder is not None:
+            self.recorder.eof()
+        self._eof_out = True
+        self.data_out.put_eof()
+        if self._eof_in:
+            self.close()
+
     def connection_lost(self, exc):
         if exc is not None:
-            print(exc)
+            self.logger.debug("Connection lost: %s", exc)
+        if self.access_log:
+            self._log_access()
+        self.closed = True
+        if self.connections is not None:
+            self.connections.discard(self)
+        if self.admission is not None:
+            self.admission.release(self)
+            self.admission = None
+        if self._limit_acquired:
+            self.limit.release(self)
+            self._limit_acquired = False
+        REAPER.discard(self)
+        if self.client_link is not None:
+            self.link.release(self.client_link)
+            self.client_link = None
+        # the client is gone, whatever is left won't be written
+        if self.data_in is not None:
+            self.data_in.abort()
+        if self.data_out is not None:
+            self.data_out.abort()
         if self.upstream is not None:
             self.upstream.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.hooks is not None:
+            self.hooks.closed()
+            self.hooks = None
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
         async def _drain():
             if self.data_in is not None:
                 await self.data_in.stop()
@@ -105,22 +429,51 @@ class Forwarder(asyncio.Protocol):
 
         asyncio.ensure_future(_drain())
 
-    def forward_data(self, data):
-        self.logger.debug(
-            "%s:%d => %s:%s",
+    def abort(self):
+        """Closes both sides right away, dropping the data in flight.
+        """
+        self.closed = True
+        if self.upstream is not None:
+            self.upstream.abort()
+        if self.transport is not None:
+            self.transport.abort()
+
+    def _log_access(self):
+        peer = self.transport.get_extra_info("peername")
+        self.logger.info(
+            "%s => %s:%d => %s:%s in=%d out=%d %dms",
+            peer and "%s:%d" % peer[:2] or "-",
             self.downstream_host,
             self.downstream_port,
             self.host,
             self.port,
+            self.bytes_in,
+            self.bytes_out,
+            (self.loop.time() - self.created) * 1000,
         )
+
+    def forward_data(self, data):
+        self.last_activity = self.loop.time()
+        self.bytes_out += len(data)
+        if self.capture is not None:
+            self.capture.received("out", data)
+        if self.hooks is not None:
+            data = self.hooks.received("out", memoryview(data))
+            if not data:
+                return
+        if self.recorder is not None:
+            self.recorder.response(data)
         self.data_out.put(data)
 
     def data_received(self, data):
-        self.logger.debug(
-            "%s:%d <= %s:%s",
-            self.downstream_host,
-            self.downstream_port,
-            self.host,
-            self.port,
-        )
+        self.last_activity = self.loop.time()
+        self.bytes_in += len(data)
+        if self.capture is not None:
+            self.capture.received("in", data)
+        if self.hooks is not None:
+            data = self.hooks.received("in", memoryview(data))
+            if not data:
+                return
+        if self.recorder is not None:
+            self.recorder.request(data)
         self.data_in.put(data)
@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""Data-path hooks.
+
+Custom per-chunk processing (counting, rewriting, logging...) without
+changing the forwarder. A hook factory is a callable that gets each new
+connection (a tinap.forwarder.Forwarder) once it's accepted, and returns
+a Hook for it, or None to leave it alone. Subclasses of Hook can be used
+as factories::
+
+    class Counter(Hook):
+        def __init__(self, connection):
+            super(Counter, self).__init__(connection)
+            self.size = 0
+
+        def received(self, direction, data):
+            self.size += len(data)
+            return data
+
+The hooks of a connection are resolved once, when it's accepted, so
+connections without hooks don't pay anything per chunk. The chunks are
+passed as memoryviews of the data read from the sockets: slicing them
+doesn't copy, but they must be copied to be kept after the call.
+
+Hooks are given to tinap.Proxy(hooks=...), to a mapping of the
+configuration file (hooks = ["module:factory"]), or to every mapping
+with --hook module:factory.
+"""
+import importlib
+
+
+class Hook:
+    """Hook of one connection. "in" is the direction of the data sent by
+    the client, "out" the one of the data sent by the upstream.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def received(self, direction, data):
+        """Called when a chunk is read, before it's shaped.
+
+        Returns the data to forward: *data*, a slice of it, or new bytes.
+        Nothing is forwarded when it's empty.
+        """
+        return data
+
+    def released(self, direction, data):
+        """Called when a shaped chunk is written.
+        """
+
+    def closed(self):
+        """Called when the client connection is lost.
+        """
+
+
+class HookChain:
+    """Calls several hooks, in order.
+    """
+
+    __slots__ = ("hooks",)
+
+    def __init__(self, hooks):
+        self.hooks = hooks
+
+    def received(self, direction, data):
+        for hook in self.hooks:
+            data = hook.received(direction, data)
+            if not data:
+                break
+        return data
+
+    def released(self, direction, data):
+        for hook in self.hooks:
+            hook.released(direction, data)
+
+    def closed(self):
+        for hook in self.hooks:
+            hook.closed()
+
+
+def connection_hooks(factories, connection):
+    """Returns the hooks of *connection*, or None when there are none.
+    """
+    hooks = []
+    for factory in factories:
+        hook = factory(connection)
+        if hook is not None:
+            hooks.append(hook)
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+    return HookChain(hooks)
+
+
+def load_hook(path):
+    """Imports a "module:factory" hook factory.
+    """
+    module, sep, name = path.partition(":")
+    if not sep or not name:
+        raise ValueError("Invalid hook %r, expected module:factory" % path)
+    factory = importlib.import_module(module)
+    for attr in name.split("."):
+        factory = getattr(factory, attr)
+    return factory
+
+
+def load_hooks(paths):
+    if not paths:
+        return ()
+    return tuple(load_hook(path) for path in paths)
@@ -0,0 +1,236 @@
+# encoding: utf-8
+"""Bounds on the number and the lifetime of proxied connections, so
+fds, tasks and memory don't keep growing during long runs, and on the
+load tinap takes before the shaping gets inaccurate.
+"""
+import asyncio
+import collections
+
+from tinap.stats import STATS
+from tinap.util import get_logger
+
+ACCEPTED = "accepted"
+WAITING = "waiting"
+REJECTED = "rejected"
+
+
+class ConnectionLimit:
+    """Caps the number of active connections of a port mapping.
+
+    Connections accepted above *maxconn* are held, without reading from
+    them or connecting upstream, until a slot is freed. Up to *backlog*
+    connections can wait like this; the next ones are closed right away.
+    """
+
+    def __init__(self, maxconn, backlog=None):
+        self.maxconn = maxconn
+        self.backlog = maxconn if backlog is None else backlog
+        self.active = 0
+        self._waiting = collections.OrderedDict()
+
+    def __len__(self):
+        return self.active
+
+    def acquire(self, conn):
+        if self.active < self.maxconn:
+            self.active += 1
+            return ACCEPTED
+        if len(self._waiting) < self.backlog:
+            STATS.incr("limits.waiting")
+            self._waiting[conn] = None
+            return WAITING
+        STATS.incr("limits.rejected")
+        return REJECTED
+
+    def release(self, conn):
+        """Frees the slot of *conn*, and starts the next waiting
+        connection if any.
+        """
+        if conn in self._waiting:
+            del self._waiting[conn]
+            return
+        self.active -= 1
+        if self._waiting:
+            conn, __ = self._waiting.popitem(last=False)
+            self.active += 1
+            conn.start()
+
+
+class Reaper:
+    """Closes expired connections.
+
+    A single periodic sweep covers all the registered connections,
+    instead of one timer per connection. Each connection has an
+    `expired(now)` method that returns the reason why it should be
+    closed, or None.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._conns = set()
+        self._handle = None
+
+    def __len__(self):
+        return len(self._conns)
+
+    def add(self, conn):
+        self._conns.add(conn)
+        if self._handle is None:
+            loop = asyncio.get_event_loop()
+            self._handle = loop.call_later(self.interval, self._sweep)
+
+    def discard(self, conn):
+        self._conns.discard(conn)
+        if not self._conns and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _sweep(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        for conn in list(self._conns):
+            reason = conn.expired(now)
+            if reason is None:
+                continue
+            STATS.incr("limits.%s" % reason)
+            self._conns.discard(conn)
+            conn.close()
+        if self._conns:
+            self._handle = loop.call_later(self.interval, self._sweep)
+        else:
+            self._handle = None
+
+
+REAPER = Reaper()
+
+
+class AdmissionControl:
+    """Holds new connections while tinap is overloaded, so the
+    connections being shaped keep accurate timings instead of all of them
+    degrading together.
+
+    The load is sampled every *interval* seconds: the lag of the event
+    loop (how late a timer fires, smoothed), and the bytes queued in the
+    Throttlers of the *mappings*. tinap is overloaded when the lag goes
+    above *max_lag* seconds, or the queued bytes above *max_queued*
+    (0 disables either), and recovers when both are back under half of
+    their limit.
+
+    While it's overloaded, up to *backlog* new connections are held
+    without reading from them, and admitted a few at a time once it has
+    recovered. The next ones are closed right away.
+    """
+
+    # connections admitted per sample
+    BATCH = 16
+
+    def __init__(self, mappings, max_lag=0.0, max_queued=0, backlog=128, interval=0.1):
+        self.mappings = mappings
+        self.max_lag = max_lag
+        self.max_queued = max_queued
+        self.backlog = backlog
+        self.interval = interval
+        self.overloaded = False
+        self.lag = 0.0
+        self.queued = 0
+        self.logger = get_logger()
+        self._waiting = collections.OrderedDict()
+        self._expected = 0.0
+        self._handle = None
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self._expected = loop.time() + self.interval
+        self._handle = loop.call_at(self._expected, self._sample)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def acquire(self, conn):
+        """Called for new connections while overloaded.
+        """
+        if len(self._waiting) < self.backlog:
+            STATS.incr("admission.waiting")
+            self._waiting[conn] = None
+            return WAITING
+        STATS.incr("admission.rejected")
+        return REJECTED
+
+    def release(self, conn):
+        self._waiting.pop(conn, None)
+
+    def queued_bytes(self):
+        return sum(
+            throttler.backlog
+            for mapping in self.mappings
+            for __, throttler in mapping.throttlers()
+        )
+
+    def _under(self, fraction):
+        if self.max_lag > 0 and self.lag > self.max_lag * fraction:
+            return False
+        if self.max_queued > 0 and self.queued > self.max_queued * fraction:
+            return False
+        return True
+
+    def _sample(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        lag = now - self._expected
+        STATS.timing("admission.lag", lag)
+        # a single slow callback is not an overload
+        self.lag = self.lag * 0.7 + lag * 0.3
+        if self.max_queued > 0:
+            self.queued = self.queued_bytes()
+        if self.overloaded:
+            if self._under(0.5):
+                self.overloaded = False
+                self.logger.info(
+                    "Load is back to normal, admitting %d held connections",
+                    len(self._waiting),
+                )
+        elif not self._under(1.0):
+            self.overloaded = True
+            STATS.incr("admission.overloads")
+            self.logger.warning(
+                "Overloaded (loop lag %dms, %d bytes queued), holding new connections",
+                self.lag * 1000,
+                self.queued,
+            )
+        if not self.overloaded:
+            for __ in range(min(self.BATCH, len(self._waiting))):
+                conn, __ = self._waiting.popitem(last=False)
+                conn.admit()
+        self._expected = now + self.interval
+        self._handle = loop.call_at(self._expected, self._sample)
+
+
+_ADMISSION = None
+
+
+def start_admission(mappings, **options):
+    """Starts an AdmissionControl of *mappings*, see its options.
+    """
+    global _ADMISSION
+    stop_admission()
+    _ADMISSION = AdmissionControl(mappings, **options)
+    _ADMISSION.start()
+    return _ADMISSION
+
+
+def stop_admission():
+    global _ADMISSION
+    if _ADMISSION is not None:
+        _ADMISSION.close()
+        _ADMISSION = None
+
+
+def get_admission():
+    """Returns the running AdmissionControl, or None.
+    """
+    return _ADMISSION
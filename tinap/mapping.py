@@ -0,0 +1,319 @@
+# encoding: utf-8
+import asyncio
+import collections
+
+from tinap.forwarder import Forwarder
+from tinap.connect import Connector
+from tinap.replay import get_archive
+from tinap.limits import ConnectionLimit
+from tinap.profile import Profile
+from tinap.sockopts import SocketOptions
+from tinap.hooks import load_hooks
+from tinap.util import get_logger, UPSTREAMS
+
+PROTOCOLS = ("tcp", "udp", "proxy")
+
+
+def parse_address(address):
+    """Parses host:port, where IPv6 hosts can be bracketed.
+    """
+    host, port = address.strip().rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+def parse_port_mapping(value):
+    """Parses a comma-separated list of
+    <source_host>:<source_port>/<target_host>:<target_port> rules.
+
+    Returns a dict of (source_host, source_port) => (target_host, target_port)
+    """
+    port_mapping = collections.OrderedDict()
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        source, target = item.split("/")
+        port_mapping[parse_address(source)] = parse_address(target)
+    return port_mapping
+
+
+class Mapping:
+    """A listener forwarding to an upstream, with its own shaping profile,
+    upstream pool and connection limit.
+
+    *protocol* is "tcp", "udp" or "proxy". Proxy mappings serve SOCKS5 and
+    HTTP CONNECT clients, and have no upstream. *hooks* are the hook
+    factories of the TCP connections, see tinap.hooks.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        upstream_host,
+        upstream_port,
+        args,
+        profile=None,
+        connector=None,
+        link=None,
+        protocol="tcp",
+        sockopts=None,
+        hooks=None,
+    ):
+        if protocol not in PROTOCOLS:
+            raise ValueError("Unknown protocol %r" % protocol)
+        self.host = host
+        self.port = port
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.args = args
+        if link is not None:
+            profile = link.profile
+        elif profile is None:
+            profile = Profile(args.rtt, args.inkbps, args.outkbps)
+        self.profile = profile
+        self.link = link
+        self.protocol = protocol
+        if sockopts is None:
+            sockopts = SocketOptions.from_args(args)
+        self.sockopts = sockopts
+        if hooks is None:
+            hooks = load_hooks(args.hook)
+        self.hooks = tuple(hooks)
+        if connector is None:
+            # shared by all the connections, along with its DNS cache
+            connector = Connector()
+        self.connector = connector
+        self.pool = None
+        self.limit = None
+        self.server = None
+        self.connections = set()
+
+    @property
+    def key(self):
+        return self.host, self.port, self.protocol
+
+    @property
+    def upstream(self):
+        if self.protocol == "proxy":
+            return "*"
+        return "%s:%d" % (self.upstream_host, self.upstream_port)
+
+    def __str__(self):
+        res = "%s:%d => %s" % (self.host, self.port, self.upstream)
+        if self.protocol != "tcp":
+            res += " (%s)" % self.protocol
+        return res
+
+    def as_dict(self):
+        res = {
+            "listen": "%s:%d" % (self.host, self.port),
+            "upstream": self.upstream,
+            "protocol": self.protocol,
+        }
+        if self.link is not None:
+            res["group"] = self.link.name
+        res.update(self.profile.as_dict())
+        return res
+
+    def throttlers(self):
+        """Yields (peer, throttler) for the live connections.
+        """
+        if self.protocol == "udp":
+            flows = self.server is not None and self.server.flows or {}
+            for addr, flow in list(flows.items()):
+                yield addr, flow.data_in
+                yield addr, flow.data_out
+            return
+        for connection in list(self.connections):
+            peer = connection.transport.get_extra_info("peername")
+            for throttler in (connection.data_in, connection.data_out):
+                if throttler is not None:
+                    yield peer, throttler
+
+    def _create_protocol(self):
+        if self.protocol == "proxy":
+            # like the UDP forwarder and the pool, only imported when used
+            from tinap.socks import ProxyForwarder
+
+            return ProxyForwarder(
+                self.host,
+                self.port,
+                self.args,
+                profile=self.profile,
+                connector=self.connector,
+                limit=self.limit,
+                link=self.link,
+                sockopts=self.sockopts,
+                connections=self.connections,
+                hooks=self.hooks,
+            )
+        return Forwarder(
+            self.host,
+            self.port,
+            self.upstream_host,
+            self.upstream_port,
+            self.args,
+            profile=self.profile,
+            pool=self.pool,
+            connector=self.connector,
+            limit=self.limit,
+            link=self.link,
+            sockopts=self.sockopts,
+            connections=self.connections,
+            hooks=self.hooks,
+        )
+
+    async def _start_udp(self):
+        from tinap.udp import UDPForwarder
+
+        self.server = UDPForwarder(
+            self.host,
+            self.port,
+            self.upstream_host,
+            self.upstream_port,
+            self.args,
+            self.profile,
+            link=self.link,
+            resolver=self.connector.resolver,
+        )
+        await self.server.start()
+
+    async def start(self):
+        if self.protocol == "udp":
+            await self._start_udp()
+        else:
+            await self._start_tcp()
+        if self.port == 0:
+            # the system picked one
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _start_tcp(self):
+        args = self.args
+        archive = get_archive()
+        replay = archive is not None and archive.replay
+        pooled = args.pool_max > 0 or args.pool_min > 0
+        if self.protocol == "tcp" and pooled and not replay:
+            from tinap.pool import UpstreamPool
+
+            self.pool = UpstreamPool(
+                self.upstream_host,
+                self.upstream_port,
+                minsize=args.pool_min,
+                maxsize=args.pool_max,
+                idle_timeout=args.pool_idle_timeout,
+                connector=self.connector,
+            )
+            self.pool.start()
+        if args.max_connections > 0:
+            self.limit = ConnectionLimit(args.max_connections)
+        loop = asyncio.get_event_loop()
+        try:
+            self.server = await loop.create_server(
+                self._create_protocol, self.host, self.port
+            )
+        except BaseException:
+            if self.pool is not None:
+                self.pool.close()
+            raise
+
+    def close(self):
+        """Stops listening. The connections already opened stay alive.
+        """
+        if self.server is not None:
+            self.server.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    async def wait_closed(self):
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    async def close_connections(self):
+        """Aborts the open connections, and returns once they're closed.
+        """
+        connections = list(self.connections)
+        for connection in connections:
+            connection.abort()
+        upstreams = [c.upstream for c in connections if c.upstream is not None]
+        # connection_lost() is called on the next loop iteration
+        while self.connections or any(u in UPSTREAMS for u in upstreams):
+            await asyncio.sleep(0)
+
+
+class Mappings:
+    """All the mappings tinap is serving, by (host, port, protocol).
+    """
+
+    def __init__(self):
+        self._mappings = collections.OrderedDict()
+        self._stopped = None
+        self.logger = get_logger()
+
+    def __len__(self):
+        return len(self._mappings)
+
+    def __iter__(self):
+        return iter(list(self._mappings.values()))
+
+    def __contains__(self, key):
+        return key in self._mappings
+
+    def get(self, key):
+        return self._mappings[key]
+
+    async def add(self, mapping):
+        await self.add_all([mapping])
+        return mapping
+
+    async def add_all(self, mappings):
+        """Binds all the *mappings* concurrently.
+
+        If any of them fails, none is added.
+        """
+        keys = set(self._mappings)
+        for mapping in mappings:
+            if mapping.port != 0 and mapping.key in keys:
+                raise ValueError("%s:%d/%s is already mapped" % mapping.key)
+            keys.add(mapping.key)
+
+        res = await asyncio.gather(
+            *[mapping.start() for mapping in mappings], return_exceptions=True
+        )
+        errors = [error for error in res if isinstance(error, BaseException)]
+        if errors:
+            for mapping in mappings:
+                mapping.close()
+            raise errors[0]
+
+        # with large sets, the details are only useful in verbose mode
+        log = self.logger.info if len(mappings) <= 10 else self.logger.debug
+        for mapping in mappings:
+            self._mappings[mapping.key] = mapping
+            log("Starting Forwarder %s (%s)" % (mapping, mapping.profile))
+        if len(mappings) > 10:
+            self.logger.info("Started %d Forwarders" % len(mappings))
+
+    async def remove(self, key):
+        mapping = self._mappings.pop(key)
+        mapping.close()
+        await mapping.wait_closed()
+        self.logger.info("Stopped Forwarder %s" % mapping)
+        return mapping
+
+    def close(self):
+        for mapping in self:
+            mapping.close()
+        self._get_stopped().set()
+
+    def _get_stopped(self):
+        if self._stopped is None:
+            self._stopped = asyncio.Event()
+        return self._stopped
+
+    async def wait_closed(self):
+        """Returns once close() was called and all listeners are closed.
+        """
+        await self._get_stopped().wait()
+        for mapping in self:
+            await mapping.wait_closed()
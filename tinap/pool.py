@@ -0,0 +1,174 @@
+# encoding: utf-8
+"""Pool of pre-established upstream connections.
+
+Each port mapping can keep a few idle connections to its upstream, so a
+new downstream connection can be plugged right away instead of waiting
+for a connect.
+"""
+import asyncio
+import collections
+
+from tinap.util import append_upstream, remove_upstream, get_logger
+from tinap.stats import STATS
+from tinap.connect import Connector
+
+
+class PooledConnection(asyncio.Protocol):
+    """An idle upstream connection, waiting in the pool.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+        self.connect_time = 0.0
+        self.idle_since = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        # nothing was sent yet, so the upstream is in a weird state.
+        STATS.incr("pool.unhealthy")
+        self.close()
+
+    def eof_received(self):
+        STATS.incr("pool.unhealthy")
+        return False
+
+    def connection_lost(self, exc):
+        if self.pool is not None:
+            self.pool.discard(self)
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.close()
+
+
+class UpstreamPool:
+    """Keeps between *minsize* and *maxsize* idle connections to
+    *host*:*port*.
+
+    The pool is refilled up to *minsize* every time a connection is taken,
+    and grows towards *maxsize* when it runs dry. Idle connections older
+    than *idle_timeout* seconds are replaced by fresh ones, since
+    upstreams tend to close idle sockets on their own.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        minsize=1,
+        maxsize=10,
+        idle_timeout=30.0,
+        check_interval=1.0,
+        connector=None,
+    ):
+        self.host = host
+        self.port = port
+        self.minsize = minsize
+        self.maxsize = max(minsize, maxsize)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        if connector is None:
+            connector = Connector()
+        self.connector = connector
+        self.loop = asyncio.get_event_loop()
+        self.logger = get_logger()
+        self._idle = collections.deque()
+        self._connecting = set()
+        self._check_handle = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._idle)
+
+    def start(self):
+        append_upstream(self)
+        self._fill(self.minsize)
+        self._check_handle = self.loop.call_later(self.check_interval, self._check)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        remove_upstream(self)
+        if self._check_handle is not None:
+            self._check_handle.cancel()
+        while self._idle:
+            conn = self._idle.pop()
+            conn.pool = None
+            conn.close()
+        for task in self._connecting:
+            task.cancel()
+
+    def _fill(self, size):
+        if self._closed:
+            return
+        size = min(size, self.maxsize)
+        for i in range(size - len(self._idle) - len(self._connecting)):
+            task = asyncio.ensure_future(self._connect())
+            self._connecting.add(task)
+            task.add_done_callback(self._connecting.discard)
+
+    async def _connect(self):
+        start = self.loop.time()
+        try:
+            __, conn = await self.connector.connect(
+                lambda: PooledConnection(self), self.host, self.port
+            )
+        except (asyncio.TimeoutError, OSError):
+            self.logger.debug(
+                "Pool could not connect to %s:%d" % (self.host, self.port)
+            )
+            return
+        conn.connect_time = self.loop.time() - start
+        conn.idle_since = self.loop.time()
+        STATS.timing("pool.connect", conn.connect_time)
+        if self._closed:
+            conn.pool = None
+            conn.close()
+            return
+        self._idle.append(conn)
+
+    def discard(self, conn):
+        try:
+            self._idle.remove(conn)
+        except ValueError:
+            pass
+
+    def acquire(self, protocol):
+        """Hands an idle connection over to *protocol*.
+
+        Returns the transport, or None if no connection was ready.
+        """
+        while self._idle:
+            # the most recent connection is the least likely to be stale
+            conn = self._idle.pop()
+            if conn.transport.is_closing():
+                continue
+            conn.pool = None
+            transport = conn.transport
+            transport.set_protocol(protocol)
+            protocol.connection_made(transport)
+            STATS.incr("pool.hits")
+            # that's the connect latency we did not have to wait for
+            STATS.timing("pool.saved", conn.connect_time)
+            self._fill(self.minsize)
+            return transport
+        STATS.incr("pool.misses")
+        self._fill(max(self.minsize, len(self._connecting) + 1))
+        return None
+
+    def _check(self):
+        now = self.loop.time()
+        for conn in list(self._idle):
+            if conn.transport.is_closing():
+                self.discard(conn)
+            elif now - conn.idle_since > self.idle_timeout:
+                STATS.incr("pool.expired")
+                self.discard(conn)
+                conn.pool = None
+                conn.close()
+        self._fill(self.minsize)
+        self._check_handle = self.loop.call_later(self.check_interval, self._check)
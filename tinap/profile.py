@@ -0,0 +1,147 @@
+# encoding: utf-8
+import collections
+import time
+
+from tinap.stats import STATS
+from tinap.throttler import BandwidthControl
+
+
+# TCP overhead (value taken from tsproxy)
+REMOVE_TCP_OVERHEAD = 1460.0 / 1500.0
+
+
+class Profile:
+    """Shaping parameters of a port mapping.
+
+    - rtt: Round Trip Time Latency (in ms)
+    - inkbps: Download Bandwidth (in 1000 bits/s - Kbps)
+    - outkbps: Upload Bandwidth (in 1000 bits/s - Kbps)
+
+    Throttlers read the profile at each scheduling decision, so updating
+    it applies right away to the live connections.
+    """
+
+    def __init__(self, rtt=0.0, inkbps=0.0, outkbps=0.0):
+        self.rtt = self.inkbps = self.outkbps = 0.0
+        # the latency is in seconds, and divided by two for each direction.
+        self.latency = 0.0
+        # bytes per second, per direction
+        self.bandwidth = {"in": 0.0, "out": 0.0}
+        self.update(rtt=rtt, inkbps=inkbps, outkbps=outkbps)
+
+    def update(self, rtt=None, inkbps=None, outkbps=None):
+        for name, value in (("rtt", rtt), ("inkbps", inkbps), ("outkbps", outkbps)):
+            if value is not None and value < 0:
+                raise ValueError("%s can't be negative" % name)
+        if rtt is not None:
+            self.rtt = float(rtt)
+            self.latency = self.rtt / 2000.0
+        if inkbps is not None:
+            self.inkbps = float(inkbps)
+            self.bandwidth["in"] = self.inkbps * REMOVE_TCP_OVERHEAD * 1000.0 / 8.0
+        if outkbps is not None:
+            self.outkbps = float(outkbps)
+            self.bandwidth["out"] = self.outkbps * REMOVE_TCP_OVERHEAD * 1000.0 / 8.0
+
+    def as_dict(self):
+        return {"rtt": self.rtt, "inkbps": self.inkbps, "outkbps": self.outkbps}
+
+    def __str__(self):
+        return "rtt=%d, inkbps=%s, outkbps=%s" % (self.rtt, self.inkbps, self.outkbps)
+
+
+class LinkGroup:
+    """An emulated link shared by several port mappings.
+
+    All their connections follow the same profile and compete for the
+    same bandwidth in each direction.
+
+    With a *coordinator* (see tinap.coordinator), the bandwidth is also
+    shared with the links of other tinap instances that have the same
+    *key*, which defaults to the name.
+    """
+
+    __slots__ = ("name", "profile", "controls")
+
+    def __init__(self, name, profile, coordinator=None, key=None):
+        self.name = name
+        self.profile = profile
+        if coordinator is None:
+            self.controls = {"in": BandwidthControl(), "out": BandwidthControl()}
+        else:
+            self.controls = coordinator.controls(key or name)
+
+    def acquire(self, host):
+        """Returns the link used by a connection from *host*.
+        """
+        return self
+
+    def release(self, link):
+        """Called when a connection that acquired *link* is closed.
+        """
+
+
+class ClientLinks(LinkGroup):
+    """One emulated link per client address.
+
+    Each client gets its own LinkGroup, shared by all its connections to
+    the port mappings using this ClientLinks. All the links follow the
+    same profile.
+
+    A link is created on the first connection of its client, and dropped
+    once the client had no connection for *idle_timeout* seconds. Idle
+    links are kept in the order they became idle, so evicting them is
+    done when a connection is acquired, without any timer.
+
+    With a *coordinator*, the link of a client is shared with the other
+    instances as "<name>/<client address>".
+    """
+
+    __slots__ = ("idle_timeout", "coordinator", "_links", "_users", "_idle")
+
+    def __init__(self, name, profile, idle_timeout=60.0, coordinator=None):
+        super(ClientLinks, self).__init__(name, profile)
+        self.idle_timeout = idle_timeout
+        self.coordinator = coordinator
+        self._links = {}
+        self._users = collections.Counter()
+        # host -> time it became idle, oldest first
+        self._idle = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._links)
+
+    def acquire(self, host):
+        self._evict(time.monotonic())
+        link = self._links.get(host)
+        if link is None:
+            link = self._links[host] = LinkGroup(
+                host,
+                self.profile,
+                coordinator=self.coordinator,
+                key="%s/%s" % (self.name, host),
+            )
+            STATS.incr("clients.links")
+        elif host in self._idle:
+            del self._idle[host]
+        self._users[host] += 1
+        return link
+
+    def release(self, link):
+        host = link.name
+        if self._links.get(host) is not link:
+            return
+        self._users[host] -= 1
+        if self._users[host] <= 0:
+            del self._users[host]
+            self._idle[host] = time.monotonic()
+
+    def _evict(self, now):
+        idle = self._idle
+        while idle:
+            host, since = next(iter(idle.items()))
+            if now - since < self.idle_timeout:
+                return
+            del idle[host]
+            del self._links[host]
+            STATS.incr("clients.evicted")
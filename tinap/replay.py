@@ -0,0 +1,237 @@
+# encoding: utf-8
+"""Record and replay of the upstream responses.
+
+A connection is seen as a sequence of exchanges: the bytes the client
+sends, then the bytes the upstream answers until the client sends again.
+With --record, each exchange is appended to an archive, under a digest
+of the upstream address and of the request bytes. With --replay, the
+upstream is never contacted: once the bytes a client sent match an
+exchange, its response goes through the same shaping as if the upstream
+had sent it.
+
+The archive is an append-only file. After an 8-bytes magic, each record
+is a header (digest, flags, length) followed by the response. In replay
+mode the file is memory-mapped and the index, digest -> record, is built
+by walking the headers. Responses are sent as memoryview slices of the
+map, so they're not copied before reaching the transports. When an
+exchange is recorded several times, the last one wins.
+"""
+import struct
+
+from tinap.stats import STATS
+
+MAGIC = b"tinaprr1"
+_HEADER = struct.Struct("<16sIQ")
+# the upstream closed its side after that response
+FLAG_EOF = 1
+# size of the chunks handed to the Throttler
+CHUNK_SIZE = 65536
+
+
+def _hasher(key):
+    # only imported when an archive is used
+    import hashlib
+
+    return hashlib.blake2b(key.encode("utf8") + b"\x00", digest_size=16)
+
+
+class Archive:
+    """Archive at *path*, opened to record exchanges or to replay them.
+    """
+
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self.index = {}
+        self._file = self._map = self._view = None
+        if replay:
+            self._load()
+        else:
+            self._file = open(path, "ab")
+            if self._file.tell() == 0:
+                self._file.write(MAGIC)
+
+    def _load(self):
+        import mmap
+
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a tinap archive" % self.path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        offset, size = len(MAGIC), len(self._map)
+        while offset + _HEADER.size <= size:
+            digest, flags, length = _HEADER.unpack_from(self._map, offset)
+            offset += _HEADER.size
+            if offset + length > size:
+                # truncated by a crash while recording
+                break
+            self.index[digest] = offset, length, flags
+            offset += length
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, digest, response, flags=0):
+        self._file.write(_HEADER.pack(digest, flags, len(response)))
+        self._file.write(response)
+        STATS.incr("archive.recorded")
+
+    def get(self, digest):
+        """Returns the response and the flags of an exchange, or None.
+        """
+        try:
+            offset, length, flags = self.index[digest]
+        except KeyError:
+            return None
+        return self._view[offset : offset + length], flags
+
+    def connection(self, key):
+        """Returns the recorder of a connection to the *key* upstream.
+        """
+        return ConnectionRecorder(self, key)
+
+    def upstream(self, downstream, key):
+        """Returns the replayed upstream of *downstream*, a Forwarder
+        connected to the *key* upstream.
+        """
+        return ReplayUpstream(self, downstream, key)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._map is not None:
+            try:
+                self._view.release()
+                self._map.close()
+            except BufferError:
+                # slices are still queued somewhere, the map is closed
+                # once they are collected
+                pass
+            self._map = self._view = None
+
+
+class ConnectionRecorder:
+    """Records the exchanges of one connection.
+    """
+
+    __slots__ = ("archive", "key", "_request", "_response", "_eof")
+
+    def __init__(self, archive, key):
+        self.archive = archive
+        self.key = key
+        self._request = _hasher(key)
+        self._response = []
+        self._eof = False
+
+    def request(self, data):
+        if self._response:
+            # the client talks again, that's a new exchange
+            self._flush()
+        self._request.update(data)
+
+    def response(self, data):
+        self._response.append(bytes(data))
+
+    def eof(self):
+        self._eof = True
+
+    def _flush(self):
+        self.archive.append(
+            self._request.digest(),
+            b"".join(self._response),
+            flags=self._eof and FLAG_EOF or 0,
+        )
+        self._request = _hasher(self.key)
+        self._response = []
+
+    def close(self):
+        if self._response or self._eof:
+            self._flush()
+
+
+class ReplayUpstream:
+    """Stands for the upstream connection of a Forwarder in replay mode.
+
+    The requests written by the Forwarder are hashed as they come, and
+    once they match an exchange its response is forwarded to the client.
+    """
+
+    __slots__ = ("archive", "downstream", "key", "transport", "_request", "_pending")
+
+    def __init__(self, archive, downstream, key):
+        self.archive = archive
+        self.downstream = downstream
+        self.key = key
+        self.transport = None
+        self._request = _hasher(key)
+        self._pending = 0
+
+    def start(self):
+        """Called instead of connecting. Sends what the upstream sent
+        before the client said anything.
+        """
+        self._match()
+
+    def _match(self):
+        found = self.archive.get(self._request.digest())
+        if found is None:
+            return False
+        STATS.incr("archive.hits")
+        response, flags = found
+        self._request = _hasher(self.key)
+        self._pending = 0
+        for offset in range(0, len(response), CHUNK_SIZE):
+            self.downstream.forward_data(response[offset : offset + CHUNK_SIZE])
+        if flags & FLAG_EOF:
+            self.downstream.upstream_eof()
+        return True
+
+    def write(self, data):
+        self._request.update(data)
+        self._pending += len(data)
+        self._match()
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        if self._pending:
+            STATS.incr("archive.misses")
+            self._pending = 0
+
+    def abort(self):
+        self.close()
+
+
+_ARCHIVE = None
+
+
+def open_archive(path, replay=False):
+    global _ARCHIVE
+    close_archive()
+    _ARCHIVE = Archive(path, replay=replay)
+    return _ARCHIVE
+
+
+def close_archive():
+    global _ARCHIVE
+    if _ARCHIVE is not None:
+        _ARCHIVE.close()
+        _ARCHIVE = None
+
+
+def get_archive():
+    """Returns the open Archive, or None.
+    """
+    return _ARCHIVE
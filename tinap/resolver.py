@@ -0,0 +1,74 @@
+# encoding: utf-8
+"""Asynchronous name resolution cache.
+
+One Resolver is shared by all the port mappings, so each upstream name
+is looked up once per TTL instead of once per connection.
+"""
+import asyncio
+import collections
+import functools
+import socket
+
+from tinap.stats import STATS
+
+
+class Resolver:
+    """Caches getaddrinfo() results for *ttl* seconds, and keeps at most
+    *maxsize* entries (least recently used ones are evicted first).
+
+    Concurrent lookups of the same name share a single query.
+    """
+
+    def __init__(self, ttl=60.0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+    async def getaddrinfo(self, host, port, family=0, type=socket.SOCK_STREAM):
+        loop = asyncio.get_event_loop()
+        key = host, port, family, type
+        entry = self._cache.get(key)
+        if entry is not None:
+            expires, infos = entry
+            if expires > loop.time():
+                self._cache.move_to_end(key)
+                STATS.incr("dns.hits")
+                return infos
+            del self._cache[key]
+
+        query = self._pending.get(key)
+        if query is None:
+            STATS.incr("dns.misses")
+            query = asyncio.ensure_future(
+                loop.getaddrinfo(host, port, family=family, type=type)
+            )
+            query.add_done_callback(functools.partial(self._store, key))
+            self._pending[key] = query
+        # a cancelled caller should not cancel the query for everyone
+        return await asyncio.shield(query)
+
+    def _store(self, key, query):
+        del self._pending[key]
+        if query.cancelled() or query.exception() is not None:
+            return
+        infos = query.result()
+        if not infos or self.ttl <= 0 or self.maxsize <= 0:
+            return
+        expires = asyncio.get_event_loop().time() + self.ttl
+        self._cache[key] = expires, infos
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def resolve(self, host, port=80):
+        """Returns the first address *host* resolves to.
+        """
+        infos = await self.getaddrinfo(host, port)
+        return infos[0][4][0]
@@ -0,0 +1,107 @@
+# encoding: utf-8
+"""TCP socket options.
+
+Small shaped writes should leave right away (TCP_NODELAY), and data
+should not pile up in kernel buffers where the shaper can't see it. The
+send and receive buffers are sized from the bandwidth-delay product of
+the profile, and TCP_NOTSENT_LOWAT limits the unsent bytes in the send
+buffer.
+"""
+import socket
+import sys
+
+from tinap.util import get_logger
+
+# not exposed by the socket module on all Python versions
+TCP_NOTSENT_LOWAT = getattr(
+    socket, "TCP_NOTSENT_LOWAT", {"linux": 25, "darwin": 0x201}.get(sys.platform)
+)
+
+# buffers are never made smaller than this
+MIN_BUFFER = 16384
+
+
+def bdp(profile, direction):
+    """Returns the bandwidth-delay product of the *direction* of
+    *profile*, in bytes, or 0 if the bandwidth is unlimited.
+    """
+    return int(profile.bandwidth[direction] * profile.rtt / 1000.0)
+
+
+class SocketOptions:
+    """Socket options of the connections of a port mapping.
+
+    - nodelay: disables Nagle's algorithm.
+    - buffer_size: SO_SNDBUF/SO_RCVBUF, in bytes. None sizes them from the
+      bandwidth-delay product of the profile, 0 keeps the system defaults.
+    - notsent_lowat: TCP_NOTSENT_LOWAT, in bytes. 0 keeps the system
+      default.
+
+    The write buffer limits of the transports are set to the send buffer
+    size.
+    """
+
+    def __init__(self, nodelay=True, buffer_size=None, notsent_lowat=16384):
+        self.nodelay = nodelay
+        self.buffer_size = buffer_size
+        self.notsent_lowat = notsent_lowat
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            nodelay=args.tcp_nodelay,
+            buffer_size=args.socket_buffer,
+            notsent_lowat=args.notsent_lowat,
+        )
+
+    def update(self, nodelay=None, buffer_size=None, notsent_lowat=None):
+        if nodelay is not None:
+            self.nodelay = bool(nodelay)
+        if buffer_size is not None:
+            if buffer_size < 0:
+                raise ValueError("buffer_size can't be negative")
+            self.buffer_size = buffer_size
+        if notsent_lowat is not None:
+            if notsent_lowat < 0:
+                raise ValueError("notsent_lowat can't be negative")
+            self.notsent_lowat = notsent_lowat
+
+    def copy(self):
+        return SocketOptions(self.nodelay, self.buffer_size, self.notsent_lowat)
+
+    def buffer_sizes(self, profile, send, receive):
+        """Returns the send and receive buffer sizes of a socket sending
+        the *send* direction of *profile*, and receiving the *receive*
+        one. 0 means the system default.
+        """
+        if self.buffer_size is not None:
+            return self.buffer_size, self.buffer_size
+        sizes = []
+        for direction in (send, receive):
+            if profile.bandwidth[direction] > 0:
+                sizes.append(max(bdp(profile, direction), MIN_BUFFER))
+            else:
+                sizes.append(0)
+        return tuple(sizes)
+
+    def apply(self, transport, profile, send, receive):
+        sock = transport.get_extra_info("socket")
+        if sock is None or sock.type != socket.SOCK_STREAM:
+            return
+        sndbuf, rcvbuf = self.buffer_sizes(profile, send, receive)
+        options = []
+        if self.nodelay and sock.family in (socket.AF_INET, socket.AF_INET6):
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if sndbuf > 0:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf))
+        if rcvbuf > 0:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf))
+        if self.notsent_lowat > 0 and TCP_NOTSENT_LOWAT is not None:
+            options.append((socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, self.notsent_lowat))
+        for level, option, value in options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                get_logger().debug("Could not set socket option %s: %s" % (option, e))
+        if sndbuf > 0:
+            transport.set_write_buffer_limits(high=sndbuf)
@@ -0,0 +1,238 @@
+# encoding: utf-8
+"""Dynamic proxy mode: SOCKS5 and HTTP CONNECT.
+
+A single listener serves any upstream. The first byte of a connection
+tells the protocol (0x05 for SOCKS5, an HTTP request line otherwise).
+Once the client has sent its target, the connection is resolved through
+the shared DNS cache and shaped like a port mapping.
+
+Handshakes are parsed in place: the bytes are only copied when a
+handshake is split across several reads.
+"""
+import asyncio
+import socket
+
+from tinap.forwarder import Forwarder
+from tinap.stats import STATS
+
+MAX_HANDSHAKE = 8192
+
+# SOCKS5 (RFC 1928) reply codes
+SUCCEEDED = 0
+GENERAL_FAILURE = 1
+HOST_UNREACHABLE = 4
+CONNECTION_REFUSED = 5
+COMMAND_NOT_SUPPORTED = 7
+ADDRESS_NOT_SUPPORTED = 8
+
+_NO_AUTH = b"\x05\x00"
+_NO_ACCEPTABLE_METHODS = b"\x05\xff"
+
+
+def socks_reply(code):
+    # the bound address is not meaningful for us, so it's 0.0.0.0:0
+    return b"\x05" + bytes((code,)) + b"\x00\x01\x00\x00\x00\x00\x00\x00"
+
+
+def http_reply(status, reason):
+    return ("HTTP/1.1 %d %s\r\n\r\n" % (status, reason)).encode("ascii")
+
+
+class HandshakeError(Exception):
+    """The handshake is invalid. *reply* is sent back to the client.
+    """
+
+    def __init__(self, reply):
+        super(HandshakeError, self).__init__(reply)
+        self.reply = reply
+
+
+def parse_socks_greeting(data):
+    """Returns the size of the greeting, or 0 if it's incomplete.
+    """
+    if len(data) < 2:
+        return 0
+    size = 2 + data[1]
+    if len(data) < size:
+        return 0
+    if data.find(0, 2, size) < 0:
+        # we only support "no authentication"
+        raise HandshakeError(_NO_ACCEPTABLE_METHODS)
+    return size
+
+
+def parse_socks_request(data, offset=0):
+    """Parses the SOCKS5 request starting at *offset*.
+
+    Returns (host, port, end), or None if the request is incomplete.
+    """
+    if len(data) < offset + 5:
+        return None
+    if data[offset] != 5:
+        raise HandshakeError(socks_reply(GENERAL_FAILURE))
+    start = offset + 4
+    atyp = data[offset + 3]
+    if atyp == 1:
+        end = start + 4
+    elif atyp == 3:
+        end = start + 1 + data[start]
+    elif atyp == 4:
+        end = start + 16
+    else:
+        raise HandshakeError(socks_reply(ADDRESS_NOT_SUPPORTED))
+    if len(data) < end + 2:
+        return None
+    if data[offset + 1] != 1:
+        # only CONNECT
+        raise HandshakeError(socks_reply(COMMAND_NOT_SUPPORTED))
+    if atyp == 1:
+        host = socket.inet_ntop(socket.AF_INET, data[start:end])
+    elif atyp == 4:
+        host = socket.inet_ntop(socket.AF_INET6, data[start:end])
+    else:
+        try:
+            host = data[start + 1 : end].decode("ascii")
+        except UnicodeDecodeError:
+            raise HandshakeError(socks_reply(GENERAL_FAILURE))
+    port = data[end] << 8 | data[end + 1]
+    return host, port, end + 2
+
+
+def parse_http_connect(data):
+    """Parses a "CONNECT host:port HTTP/1.1" request and its headers.
+
+    Returns (host, port, end), or None if the request is incomplete.
+    """
+    end = data.find(b"\r\n\r\n")
+    if end < 0:
+        return None
+    parts = data[: data.find(b"\r\n")].split()
+    if len(parts) != 3 or not parts[2].startswith(b"HTTP/"):
+        raise HandshakeError(http_reply(400, "Bad Request"))
+    if parts[0] != b"CONNECT":
+        raise HandshakeError(http_reply(405, "Method Not Allowed"))
+    try:
+        host, port = parts[1].decode("ascii").rsplit(":", 1)
+        port = int(port)
+    except (UnicodeDecodeError, ValueError):
+        raise HandshakeError(http_reply(400, "Bad Request"))
+    return host.strip("[]"), port, end + 4
+
+
+class ProxyForwarder(Forwarder):
+    """Forwarder that gets its upstream from a SOCKS5 or an HTTP CONNECT
+    handshake.
+    """
+
+    __slots__ = (
+        "handshaking",
+        "proxy_protocol",
+        "_buffer",
+        "_greeted",
+        "_handshake_timeout",
+    )
+
+    def __init__(self, host, port, args, **kw):
+        super(ProxyForwarder, self).__init__(host, port, None, None, args, **kw)
+        self.handshaking = True
+        self.proxy_protocol = None
+        self._buffer = None
+        self._greeted = False
+        self._handshake_timeout = None
+
+    def start(self):
+        # the upstream is only known once the client has sent its request
+        self.transport.resume_reading()
+        self._handshake_timeout = self.loop.call_later(
+            self.connector.timeout, self._abort_handshake
+        )
+
+    def _abort_handshake(self):
+        self._handshake_timeout = None
+        if self.handshaking:
+            STATS.incr("proxy.errors")
+            self.transport.close()
+
+    def _parse(self, data):
+        if data[0] == 5:
+            self.proxy_protocol = "socks"
+            size = parse_socks_greeting(data)
+            if size == 0:
+                return None
+            if not self._greeted:
+                self._greeted = True
+                self.transport.write(_NO_AUTH)
+            return parse_socks_request(data, size)
+        self.proxy_protocol = "http"
+        return parse_http_connect(data)
+
+    def _handshake_received(self, data):
+        if self._buffer is not None:
+            data = self._buffer + data
+        try:
+            res = self._parse(data)
+            if res is None and len(data) > MAX_HANDSHAKE:
+                raise HandshakeError(self._reply(GENERAL_FAILURE, 431))
+        except HandshakeError as e:
+            STATS.incr("proxy.errors")
+            self.handshaking = False
+            self.transport.write(e.reply)
+            self.transport.close()
+            return
+        if res is None:
+            self._buffer = data
+            return
+
+        self.host, self.port, end = res
+        self._buffer = None
+        self.handshaking = False
+        if self._handshake_timeout is not None:
+            self._handshake_timeout.cancel()
+            self._handshake_timeout = None
+        STATS.incr("proxy.%s" % self.proxy_protocol)
+        super(ProxyForwarder, self).start()
+        if end < len(data):
+            # the client did not wait for our answer
+            super(ProxyForwarder, self).data_received(data[end:])
+
+    def _reply(self, socks_code, http_status):
+        if self.proxy_protocol == "socks":
+            return socks_reply(socks_code)
+        if http_status == 200:
+            return http_reply(200, "Connection Established")
+        if http_status == 504:
+            return http_reply(504, "Gateway Timeout")
+        if http_status == 431:
+            return http_reply(431, "Request Header Fields Too Large")
+        return http_reply(502, "Bad Gateway")
+
+    def _connected(self):
+        if not self.closed:
+            # shaped like the rest of the downstream data, ahead of it
+            self.data_out.put(self._reply(SUCCEEDED, 200))
+        super(ProxyForwarder, self)._connected()
+
+    def _connect_failed(self, exc):
+        if isinstance(exc, asyncio.TimeoutError):
+            reply = self._reply(HOST_UNREACHABLE, 504)
+        elif isinstance(exc, ConnectionRefusedError):
+            reply = self._reply(CONNECTION_REFUSED, 502)
+        elif isinstance(exc, socket.gaierror):
+            reply = self._reply(HOST_UNREACHABLE, 502)
+        else:
+            reply = self._reply(GENERAL_FAILURE, 502)
+        if not self.transport.is_closing():
+            self.transport.write(reply)
+        super(ProxyForwarder, self)._connect_failed(exc)
+
+    def connection_lost(self, exc):
+        if self._handshake_timeout is not None:
+            self._handshake_timeout.cancel()
+            self._handshake_timeout = None
+        super(ProxyForwarder, self).connection_lost(exc)
+
+    def data_received(self, data):
+        if self.handshaking:
+            self._handshake_received(data)
+        else:
+            super(ProxyForwarder, self).data_received(data)
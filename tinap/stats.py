@@ -0,0 +1,70 @@
+# encoding: utf-8
+"""Process-wide counters and timings.
+
+Everything is kept in memory and reported when tinap exits, so we can
+check how accurately the shaping was applied during a run.
+"""
+import collections
+
+
+class Timing:
+    """Accumulates durations (in seconds).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class Stats:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(Timing)
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def timing(self, name, value):
+        self.timings[name].add(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+
+    def report(self):
+        """Returns a list of human-readable lines.
+        """
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append("%s: %d" % (name, value))
+        for name, timing in sorted(self.timings.items()):
+            lines.append(
+                "%s: count=%d mean=%.2fms min=%.2fms max=%.2fms"
+                % (
+                    name,
+                    timing.count,
+                    timing.mean * 1000,
+                    (timing.min or 0.0) * 1000,
+                    timing.max * 1000,
+                )
+            )
+        return lines
+
+
+STATS = Stats()
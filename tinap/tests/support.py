@@ -1,5 +1,6 @@
 """ Tests Utilities
 """
+import asyncio
 import sys
 import signal
 import os
@@ -9,11 +10,104 @@ from contextlib import contextmanager
 import http.server
 from http.client import HTTPConnection
 import socketserver
+import socket
+import subprocess
+import unittest
+
+from tinap.api import default_args
+from tinap.util import cancel_tasks
 
 
 HERE = os.path.dirname(__file__)
 
 
+def make_args(**kw):
+    """Returns the options tinap's main() would get, with defaults.
+
+    The defaults come from the command-line parser, and the durations are
+    converted like main() does.
+    """
+    return default_args(**kw)
+
+
+class LoopTestCase(unittest.TestCase):
+    """Runs each test with a new event loop, self.loop. The tasks still
+    running after the test are cancelled.
+    """
+
+    def setUp(self):
+        self.old_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        cancel_tasks(self.loop)
+        self.loop.close()
+        asyncio.set_event_loop(self.old_loop)
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def echo_server(host="127.0.0.1", port=0):
+    """Starts a TCP server that sends back what it reads, until the client
+    closes its side. Returns the asyncio Server, to be awaited.
+    """
+    return asyncio.start_server(_echo, host, port)
+
+
+def make_certificate(directory):
+    """Creates a self-signed ECDSA certificate with the openssl command.
+
+    Returns the paths of the certificate and of its key.
+    """
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=tinap",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def free_port():
+    """Returns a port that's free for both TCP and UDP on 127.0.0.1.
+    """
+    while True:
+        with socket.socket() as tcp:
+            tcp.bind(("127.0.0.1", 0))
+            port = tcp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+                try:
+                    udp.bind(("127.0.0.1", port))
+                except OSError:
+                    continue
+        return port
+
+
 class Handler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         self.send_response(200)
@@ -22,14 +116,15 @@ class Handler(http.server.SimpleHTTPRequestHandler):
 
 def _run(port):
     os.chdir(HERE)
-    socketserver.TCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer.daemon_threads = True
     attempts = 0
     httpd = None
     error = None
 
     while attempts < 3:
         try:
-            httpd = socketserver.TCPServer(("", port), Handler)
+            httpd = socketserver.ThreadingTCPServer(("", port), Handler)
             break
         except Exception as e:
             error = e
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from tinap import Proxy
+from tinap.profile import Profile
+from tinap.util import UPSTREAMS
+from tinap.tests.support import LoopTestCase, echo_server
+
+
+class TestProxy(LoopTestCase):
+    def _run(self, test):
+        async def _go():
+            echo = await echo_server()
+            try:
+                await test("127.0.0.1:%d" % echo.sockets[0].getsockname()[1])
+            finally:
+                echo.close()
+                await echo.wait_closed()
+
+        self.loop.run_until_complete(_go())
+
+    def test_shaped(self):
+        async def _test(upstream):
+            async with Proxy([upstream, upstream], Profile(rtt=200)) as proxy:
+                self.assertEqual(len(proxy.addresses), 2)
+                for host, port in proxy.addresses:
+                    self.assertNotEqual(port, 0)
+                reader, writer = await asyncio.open_connection(*proxy.addresses[1])
+                start = time.perf_counter()
+                writer.write(b"ping")
+                self.assertEqual(await reader.read(4), b"ping")
+                self.assertGreater(time.perf_counter() - start, 0.19)
+
+                # applies to the live connections
+                proxy.profile.update(rtt=0)
+                start = time.perf_counter()
+                writer.write(b"ping")
+                self.assertEqual(await reader.read(4), b"ping")
+                self.assertLess(time.perf_counter() - start, 0.1)
+
+        self._run(_test)
+
+    def test_close(self):
+        async def _test(upstream):
+            proxy = Proxy([upstream], {"rtt": 100})
+            await proxy.start()
+            address = proxy.addresses[0]
+            reader, writer = await asyncio.open_connection(*address)
+            writer.write(b"ping")
+            self.assertEqual(await reader.read(4), b"ping")
+            await proxy.close()
+            # nothing is left once close() returns
+            self.assertEqual(len(proxy.mappings.get(address + ("tcp",)).connections), 0)
+            self.assertEqual(len(UPSTREAMS), 0)
+            self.assertEqual(await reader.read(4), b"")
+            with self.assertRaises(OSError):
+                await asyncio.open_connection(*address)
+            writer.close()
+
+        self._run(_test)
+
+    def test_options(self):
+        with self.assertRaises(TypeError):
+            Proxy(["127.0.0.1:80"], rttt=100)
+
+        async def _test(upstream):
+            profile = Profile(rtt=100)
+            async with Proxy([upstream], profile, handshake_rtts=2) as proxy:
+                start = time.perf_counter()
+                reader, writer = await asyncio.open_connection(*proxy.addresses[0])
+                writer.write(b"ping")
+                self.assertEqual(await reader.read(4), b"ping")
+                # two round trips for the handshake, one for the data
+                self.assertGreater(time.perf_counter() - start, 0.29)
+
+        self._run(_test)
+
+    def test_many(self):
+        async def _test(upstream):
+            for i in range(100):
+                async with Proxy([upstream]) as proxy:
+                    reader, writer = await asyncio.open_connection(
+                        *proxy.addresses[0]
+                    )
+                    writer.write(b"ping")
+                    self.assertEqual(await reader.read(4), b"ping")
+            self.assertEqual(len(UPSTREAMS), 0)
+
+        self._run(_test)
@@ -0,0 +1,90 @@
+import unittest
+
+from tinap.bottleneck import DropTail, CoDel, create_discipline
+from tinap.throttler import Throttler
+from tinap.profile import Profile
+from tinap.tests.support import LoopTestCase
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.paused = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+class TestDisciplines(unittest.TestCase):
+    def test_unbounded(self):
+        self.assertIsNone(create_discipline("droptail", 0))
+        self.assertRaises(ValueError, create_discipline, "red", 10)
+
+    def test_droptail(self):
+        queue = DropTail(1000)
+        self.assertFalse(queue.enqueue(0, 999))
+        self.assertTrue(queue.enqueue(0, 1000))
+        # hysteresis: stays congested until half of the limit
+        self.assertTrue(queue.dequeue(0, 0, 600))
+        self.assertFalse(queue.dequeue(0, 0, 500))
+        self.assertEqual(queue.drops, 1)
+
+    def test_codel(self):
+        queue = CoDel(target=0.005, interval=0.1)
+        # a standing queue above target
+        self.assertFalse(queue.dequeue(0.0, 0.01, 10000))
+        self.assertFalse(queue.dequeue(0.05, 0.01, 10000))
+        self.assertTrue(queue.dequeue(0.11, 0.01, 10000))
+        self.assertEqual(queue.drops, 1)
+        # the control law kicks in while the delay stays high
+        self.assertTrue(queue.dequeue(0.22, 0.01, 10000))
+        self.assertEqual(queue.drops, 2)
+        # back under target
+        self.assertFalse(queue.dequeue(0.23, 0.001, 10000))
+
+
+class TestThrottler(LoopTestCase):
+    def test_pipelined_latency(self):
+        async def _run():
+            transport = FakeTransport()
+            throttler = Throttler("test", transport, Profile(rtt=400), "in")
+            throttler.start()
+            start = self.loop.time()
+            for i in range(5):
+                throttler.put(b"x" * 10)
+            await throttler.stop()
+            return transport, self.loop.time() - start
+
+        transport, duration = self.loop.run_until_complete(_run())
+        self.assertEqual(len(transport.written), 5)
+        # latencies are not added up
+        self.assertTrue(0.2 <= duration < 0.4, duration)
+
+    def test_pause_sender(self):
+        async def _run():
+            transport = FakeTransport()
+            source = FakeTransport()
+            throttler = Throttler(
+                "test",
+                transport,
+                Profile(inkbps=100),
+                "in",
+                discipline=DropTail(2000),
+                source=source,
+            )
+            throttler.put(b"x" * 2000)
+            paused = source.paused
+            throttler.start()
+            await throttler.stop()
+            return paused, source.paused, throttler.backlog
+
+        paused, after, backlog = self.loop.run_until_complete(_run())
+        self.assertTrue(paused)
+        self.assertFalse(after)
+        self.assertEqual(backlog, 0)
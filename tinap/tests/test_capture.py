@@ -0,0 +1,118 @@
+import asyncio
+import os
+import struct
+import tempfile
+
+from tinap.capture import Capture, start_capture, stop_capture, RECEIVED, RELEASED
+from tinap.mapping import Mapping
+from tinap.util import set_logger, UPSTREAMS
+from tinap.tests.support import make_args, LoopTestCase, echo_server
+
+
+def read_blocks(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        block_type, length = struct.unpack("<II", data[offset : offset + 8])
+        yield block_type, data[offset + 8 : offset + length - 4]
+        offset += length
+
+
+def read_packets(path):
+    """Returns (interface, timestamp, src port, payload) for each packet.
+    """
+    res = []
+    for block_type, body in read_blocks(path):
+        if block_type != 6:
+            continue
+        interface, high, low, caplen, __ = struct.unpack("<IIIII", body[:20])
+        packet = body[20 : 20 + caplen]
+        # IPv4 header, then TCP
+        src_port = struct.unpack("!H", packet[20:22])[0]
+        res.append(((high << 32 | low) / 1e6, interface, src_port, packet[40:]))
+    return res
+
+
+class TestCapture(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        super(TestCapture, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "tinap.pcapng")
+
+    def tearDown(self):
+        stop_capture()
+        super(TestCapture, self).tearDown()
+        self.tmpdir.cleanup()
+
+    def test_capture(self):
+        start_capture(self.path)
+
+        async def _go():
+            echo = await echo_server()
+            echo_port = echo.sockets[0].getsockname()[1]
+            mapping = Mapping(
+                "127.0.0.1", 0, "127.0.0.1", echo_port, make_args(rtt=100)
+            )
+            await mapping.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", mapping.port)
+                writer.write(b"ping")
+                await reader.readexactly(4)
+                writer.close()
+            finally:
+                mapping.close()
+                echo.close()
+            # the upstream connection has to be gone before the loop closes
+            for i in range(100):
+                if not UPSTREAMS:
+                    break
+                await asyncio.sleep(0.01)
+            return mapping.port
+
+        port = self.loop.run_until_complete(_go())
+        stop_capture()
+
+        blocks = [block_type for block_type, __ in read_blocks(self.path)]
+        self.assertEqual(blocks[:3], [0x0A0D0D0A, 1, 1])
+        packets = sorted(read_packets(self.path))
+        self.assertEqual(
+            [(interface, payload) for __, interface, __, payload in packets],
+            [
+                (RECEIVED, b"ping"),
+                (RELEASED, b"ping"),
+                (RECEIVED, b"ping"),
+                (RELEASED, b"ping"),
+            ],
+        )
+        # the answer comes from the port the client connected to
+        self.assertEqual(packets[2][2], port)
+        # released after half of the RTT
+        self.assertTrue(packets[1][0] - packets[0][0] >= 0.045)
+
+    def test_drops(self):
+        capture = Capture(self.path, maxbytes=8, interval=60)
+        conn = capture.connection(("127.0.0.1", 1), ("127.0.0.1", 2))
+        conn.received("in", b"one")
+        # bounded by the bytes, not by the records
+        conn.received("in", b"twotwo")
+        conn.received("in", b"three")
+        capture.close()
+        self.assertEqual(capture.dropped, 1)
+        packets = read_packets(self.path)
+        self.assertEqual([payload for __, __, __, payload in packets], [b"one", b"three"])
+
+    def test_snaplen(self):
+        capture = Capture(self.path, snaplen=4, maxbytes=4, interval=60)
+        conn = capture.connection(("127.0.0.1", 1), ("127.0.0.1", 2))
+        # only the kept bytes count
+        conn.received("in", b"1234567890")
+        capture.close()
+        self.assertEqual(capture.dropped, 0)
+        blocks = list(read_blocks(self.path))
+        # the interfaces take the headers of the packets
+        snaplen = struct.unpack("<HHI", blocks[1][1][:8])[2]
+        self.assertEqual(snaplen, 4 + 60)
+        packets = read_packets(self.path)
+        self.assertEqual([payload for __, __, __, payload in packets], [b"1234"])
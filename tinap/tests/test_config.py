@@ -0,0 +1,153 @@
+import unittest
+import json
+import os
+import tempfile
+
+from tinap.hooks import Hook, HookChain
+from tinap.config import load_config, create_mappings, parse_range, ConfigError
+from tinap.profile import ClientLinks, Profile
+from tinap.util import set_logger
+from tinap.tests.support import make_args
+
+
+_TOML = """
+[profiles.3g]
+rtt = 300
+inkbps = 1600
+
+[groups.agent]
+profile = "3g"
+
+[[mappings]]
+listen = "127.0.0.1:8000-8002"
+upstream = "127.0.0.1:9000-9002"
+profile = {rtt = 50}
+
+[[mappings]]
+listen = "127.0.0.1:443"
+upstream = "localhost:8443"
+group = "agent"
+
+[[mappings]]
+listen = "127.0.0.1:80"
+upstream = "localhost:8080"
+group = "agent"
+"""
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        set_logger()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            f.write(data)
+        return path
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("[::1]:80-82"), ("::1", [80, 81, 82]))
+        self.assertEqual(parse_range("localhost:80"), ("localhost", [80]))
+        self.assertRaises(ConfigError, parse_range, "localhost:82-80")
+        self.assertRaises(ConfigError, parse_range, "localhost")
+
+    def test_toml(self):
+        try:
+            config = load_config(self._write("tinap.toml", _TOML))
+        except ConfigError:
+            raise unittest.SkipTest("No TOML parser")
+        mappings = create_mappings(config, make_args(outkbps=100))
+        self.assertEqual(len(mappings), 5)
+        self.assertEqual(
+            [str(mapping) for mapping in mappings[:3]],
+            [
+                "127.0.0.1:8000 => 127.0.0.1:9000",
+                "127.0.0.1:8001 => 127.0.0.1:9001",
+                "127.0.0.1:8002 => 127.0.0.1:9002",
+            ],
+        )
+        # inline profiles get the defaults from the command line
+        self.assertEqual(
+            mappings[0].profile.as_dict(), {"rtt": 50, "inkbps": 0, "outkbps": 100}
+        )
+        self.assertIsNot(mappings[0].profile, mappings[1].profile)
+        # mappings in a group share their link
+        self.assertIs(mappings[3].link, mappings[4].link)
+        self.assertIs(mappings[3].profile, mappings[4].profile)
+        self.assertEqual(mappings[3].profile.rtt, 300)
+
+    def test_per_client(self):
+        config = {
+            "groups": {"agent": {"per_client": True, "idle_timeout": 5}},
+            "mappings": [
+                {"listen": "127.0.0.1:80", "upstream": "localhost:8080"},
+                {"listen": "127.0.0.1:8000-8001", "upstream": "localhost:9000"},
+                {"listen": "127.0.0.1:53", "upstream": "::1:53", "group": "agent"},
+                {
+                    "listen": "127.0.0.1:81",
+                    "upstream": "localhost:8081",
+                    "profile": {"rtt": 300},
+                },
+            ],
+        }
+        links = ClientLinks("clients", Profile())
+        mappings = create_mappings(
+            config, make_args(per_client=True), client_links=links
+        )
+        # outside of a group, a client has one link on all the ports
+        self.assertIs(mappings[0].link, links)
+        self.assertIs(mappings[1].link, links)
+        self.assertIs(mappings[2].link, links)
+        self.assertIs(
+            mappings[0].link.acquire("10.0.0.1"), mappings[2].link.acquire("10.0.0.1")
+        )
+        self.assertEqual(mappings[3].link.name, "agent")
+        self.assertEqual(mappings[3].link.idle_timeout, 5)
+        # a link has a single profile
+        self.assertIsInstance(mappings[4].link, ClientLinks)
+        self.assertIsNot(mappings[4].link, links)
+        self.assertEqual(mappings[4].profile.rtt, 300)
+
+        # created when not given
+        mappings = create_mappings(config, make_args(per_client=True))
+        self.assertIs(mappings[0].link, mappings[2].link)
+        self.assertEqual(mappings[0].link.name, "clients")
+
+    def test_hooks(self):
+        config = {
+            "mappings": [
+                {"listen": "127.0.0.1:80", "upstream": "localhost:8080"},
+                {
+                    "listen": "127.0.0.1:443",
+                    "upstream": "localhost:8443",
+                    "hooks": ["tinap.hooks:Hook"],
+                },
+            ]
+        }
+        mappings = create_mappings(config, make_args(hook=["tinap.hooks:HookChain"]))
+        self.assertEqual(mappings[0].hooks, (HookChain,))
+        self.assertEqual(mappings[1].hooks, (Hook,))
+
+    def test_errors(self):
+        def _check(config):
+            path = self._write("tinap.json", json.dumps(config))
+            self.assertRaises(
+                ConfigError, create_mappings, load_config(path), make_args()
+            )
+
+        mapping = {"listen": "127.0.0.1:80-81", "upstream": "127.0.0.1:8080"}
+        _check({"mappings": [dict(mapping, profile="nope")]})
+        _check({"mappings": [dict(mapping, group="nope")]})
+        _check({"mappings": [dict(mapping, profile={"rtt": -1})]})
+        _check({"mappings": [dict(mapping, profile={"latency": 1})]})
+        _check({"mappings": [dict(mapping, upstream="127.0.0.1:8080-8082")]})
+        _check({"mappings": [dict(mapping, socket={"nagle": True})]})
+        _check({"mappings": [dict(mapping, protocol="sctp")]})
+        _check({"mappings": [dict(mapping, hooks=["tinap.hooks:Nope"])]})
+        _check({"groups": {"agent": {"per_clients": True}}})
+        _check({"mappings": [{"listen": "127.0.0.1:80"}]})
+        self.assertRaises(ConfigError, load_config, self._write("bad.json", "[1"))
@@ -0,0 +1,82 @@
+import asyncio
+import socket
+
+from tinap.resolver import Resolver
+from tinap.connect import Connector, interleave
+from tinap.stats import STATS
+from tinap.tests.support import LoopTestCase
+
+
+def _info(family, host):
+    return family, socket.SOCK_STREAM, 6, "", (host, 80)
+
+
+class TestConnect(LoopTestCase):
+    def setUp(self):
+        STATS.reset()
+        super(TestConnect, self).setUp()
+
+    def test_interleave(self):
+        infos = [
+            _info(socket.AF_INET6, "::1"),
+            _info(socket.AF_INET6, "::2"),
+            _info(socket.AF_INET6, "::1"),
+            _info(socket.AF_INET, "1.1.1.1"),
+        ]
+        hosts = [info[4][0] for info in interleave(infos)]
+        self.assertEqual(hosts, ["::1", "1.1.1.1", "::2"])
+
+    def test_resolver(self):
+        resolver = Resolver(ttl=60, maxsize=1)
+
+        async def _run():
+            res = await asyncio.gather(
+                resolver.resolve("127.0.0.1"), resolver.resolve("127.0.0.1")
+            )
+            res.append(await resolver.resolve("127.0.0.1"))
+            await resolver.resolve("127.0.0.2")
+            return res
+
+        self.assertEqual(self.loop.run_until_complete(_run()), ["127.0.0.1"] * 3)
+        # one query shared by the first two calls, then the lru kicks in
+        self.assertEqual(STATS.counters["dns.misses"], 2)
+        self.assertEqual(STATS.counters["dns.hits"], 1)
+        self.assertEqual(len(resolver), 1)
+
+    def test_happy_eyeballs(self):
+        async def _run():
+            server = await self.loop.create_server(asyncio.Protocol, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            resolver = Resolver()
+
+            async def getaddrinfo(host, port, **kw):
+                # the first address refuses connections
+                return [
+                    (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 1)),
+                    (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port)),
+                ]
+
+            resolver.getaddrinfo = getaddrinfo
+            connector = Connector(timeout=2, attempt_delay=0.05, resolver=resolver)
+            try:
+                transport, __ = await connector.connect(
+                    asyncio.Protocol, "example.com", port
+                )
+                peer = transport.get_extra_info("peername")
+                transport.close()
+                return peer
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        peer = self.loop.run_until_complete(_run())
+        self.assertNotEqual(peer[1], 1)
+
+    def test_retries(self):
+        connector = Connector(timeout=1, retries=2, retry_delay=0.01)
+        self.assertRaises(
+            OSError,
+            self.loop.run_until_complete,
+            connector.connect(asyncio.Protocol, "127.0.0.1", 1),
+        )
+        self.assertEqual(STATS.counters["connect.retries"], 2)
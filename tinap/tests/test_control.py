@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import tempfile
+
+from tinap.control import start_control_server
+from tinap.mapping import Mapping, Mappings, parse_port_mapping
+from tinap.util import set_logger
+from tinap.tests.support import make_args, LoopTestCase
+
+
+class TestControl(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        super(TestControl, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super(TestControl, self).tearDown()
+        self.tmpdir.cleanup()
+
+    def test_parse_port_mapping(self):
+        res = parse_port_mapping("localhost:80/127.0.0.1:8080, [::1]:443/::1:8282,")
+        self.assertEqual(
+            list(res.items()),
+            [
+                (("localhost", 80), ("127.0.0.1", 8080)),
+                (("::1", 443), ("::1", 8282)),
+            ],
+        )
+
+    def test_commands(self):
+        path = os.path.join(self.tmpdir.name, "tinap.sock")
+        args = make_args(rtt=100)
+
+        async def _run():
+            mappings = Mappings()
+            mapping = Mapping("127.0.0.1", 0, "127.0.0.1", 8080, args)
+            await mappings.add(mapping)
+            control = await start_control_server(path, mappings, args)
+            reader, writer = await asyncio.open_unix_connection(path)
+
+            async def _call(**command):
+                writer.write(json.dumps(command).encode("utf8") + b"\n")
+                return json.loads((await reader.readline()).decode("utf8"))
+
+            try:
+                res = [
+                    await _call(command="set", rtt=300, inkbps=500),
+                    await _call(command="add", mapping="127.0.0.1:0/127.0.0.1:1"),
+                ]
+                listen = res[-1]["mappings"][0]["listen"]
+                res += [
+                    await _call(command="remove", mapping=listen),
+                    await _call(command="list"),
+                    await _call(command="remove", mapping=listen),
+                    await _call(command="boom"),
+                ]
+            finally:
+                writer.close()
+                control.close()
+                mappings.close()
+                await mappings.wait_closed()
+            return mapping, res
+
+        mapping, res = self.loop.run_until_complete(_run())
+        set_, add, remove, list_, remove_again, boom = res
+        self.assertEqual(set_["status"], "ok")
+        # the live profile was changed in place
+        self.assertEqual(mapping.profile.rtt, 300)
+        self.assertEqual(mapping.profile.latency, 0.15)
+        self.assertEqual(mapping.profile.inkbps, 500)
+        self.assertEqual(add["status"], "ok")
+        # new mappings inherit the default profile
+        self.assertEqual(add["mappings"][0]["rtt"], 100)
+        self.assertEqual(remove["status"], "ok")
+        self.assertEqual(len(list_["mappings"]), 1)
+        self.assertEqual(remove_again["status"], "error")
+        self.assertEqual(boom["status"], "error")
+
+    def test_pipelined(self):
+        path = os.path.join(self.tmpdir.name, "tinap.sock")
+        args = make_args()
+
+        class SlowMappings(Mappings):
+            async def add(self, mapping):
+                await asyncio.sleep(0.05)
+                await super(SlowMappings, self).add(mapping)
+
+        async def _run():
+            mappings = SlowMappings()
+            control = await start_control_server(path, mappings, args)
+            reader, writer = await asyncio.open_unix_connection(path)
+            commands = [
+                {"command": "add", "mapping": "127.0.0.1:0/127.0.0.1:1"},
+                {"command": "list"},
+            ]
+            try:
+                # in one write, the list has to wait for the add
+                writer.write(
+                    b"".join(json.dumps(c).encode("utf8") + b"\n" for c in commands)
+                )
+                res = [json.loads(await reader.readline()) for c in commands]
+            finally:
+                writer.close()
+                control.close()
+                mappings.close()
+                await mappings.wait_closed()
+            return res
+
+        add, list_ = self.loop.run_until_complete(_run())
+        self.assertEqual(len(add["mappings"]), 1)
+        self.assertEqual(list_["mappings"], add["mappings"])
+
+    def test_per_client(self):
+        path = os.path.join(self.tmpdir.name, "tinap.sock")
+        args = make_args(per_client=True)
+
+        async def _run():
+            mappings = Mappings()
+            control = await start_control_server(path, mappings, args)
+            reader, writer = await asyncio.open_unix_connection(path)
+
+            async def _add(**command):
+                command.update(command="add", mapping="127.0.0.1:0/127.0.0.1:1")
+                writer.write(json.dumps(command).encode("utf8") + b"\n")
+                await reader.readline()
+
+            try:
+                await _add()
+                await _add()
+                await _add(rtt=300)
+                return list(mappings)
+            finally:
+                writer.close()
+                control.close()
+                mappings.close()
+                await mappings.wait_closed()
+
+        first, second, third = self.loop.run_until_complete(_run())
+        # a client gets the same link on both ports
+        self.assertIs(first.link, second.link)
+        self.assertEqual(first.link.name, "clients")
+        self.assertIsNot(third.link, first.link)
+        self.assertEqual(third.profile.rtt, 300)
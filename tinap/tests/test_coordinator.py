@@ -0,0 +1,91 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from tinap.coordinator import (
+    Coordinator,
+    CoordinatorClient,
+    CoordinatorUnavailable,
+    start_coordinator,
+)
+from tinap.profile import ClientLinks, LinkGroup, Profile
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import LoopTestCase
+
+
+class TestCoordinator(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestCoordinator, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super(TestCoordinator, self).tearDown()
+        self.tmpdir.cleanup()
+        STATS.reset()
+
+    def test_lease(self):
+        coordinator = Coordinator()
+        self.assertEqual(coordinator.lease("agent", "in", 1000, 500, now=10.0), 0.0)
+        self.assertEqual(coordinator.lease("agent", "in", 1000, 500, now=10.0), 0.5)
+        # the other direction and the other links are free
+        self.assertEqual(coordinator.lease("agent", "out", 1000, 500, now=10.0), 0.0)
+        self.assertEqual(coordinator.lease("other", "in", 1000, 500, now=10.0), 0.0)
+        # the link was free again at 11.0
+        self.assertEqual(coordinator.lease("agent", "in", 1000, 500, now=12.0), 0.0)
+        coordinator.lease("agent", "in", 1000, 500, now=100.0)
+        self.assertEqual(list(coordinator.links), [("agent", "in")])
+
+    def test_shared(self):
+        address = os.path.join(self.tmpdir.name, "coordinator.sock")
+        rate = 1000000
+        data = b"x" * 20000
+
+        async def _send(control):
+            for i in range(10):
+                await control.available(data, rate)
+
+        async def _go():
+            server = await start_coordinator(address)
+            # two instances of the same link group
+            clients = [CoordinatorClient(address), CoordinatorClient(address)]
+            links = [LinkGroup("agent", Profile(), coordinator=c) for c in clients]
+            try:
+                start = time.perf_counter()
+                await asyncio.gather(*[_send(link.controls["in"]) for link in links])
+                return time.perf_counter() - start
+            finally:
+                for client in clients:
+                    client.close()
+                server.close()
+                await server.wait_closed()
+
+        duration = self.loop.run_until_complete(_go())
+        # 400KB at 1MB/s, minus the first lease of 100KB, instead of 0.2s
+        # for each link on its own
+        self.assertGreater(duration, 0.28)
+        self.assertEqual(STATS.counters["coordinator.leases"], 4)
+        self.assertEqual(STATS.counters["coordinator.local"], 0)
+
+    def test_fallback(self):
+        address = os.path.join(self.tmpdir.name, "missing.sock")
+        client = CoordinatorClient(address, retry_delay=60.0)
+        links = ClientLinks("clients", Profile(), coordinator=client)
+        control = links.acquire("10.0.0.1").controls["out"]
+        self.assertEqual(control.link, "clients/10.0.0.1")
+
+        async def _go():
+            for i in range(3):
+                await control.available(b"x" * 20000, 1000000)
+            with self.assertRaises(CoordinatorUnavailable):
+                await client.lease("clients/10.0.0.1", "out", 1000000, 1000)
+
+        start = time.perf_counter()
+        self.loop.run_until_complete(_go())
+        # shaped locally
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(STATS.counters["coordinator.local"], 1)
+        self.assertEqual(STATS.counters["coordinator.errors"], 1)
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import tempfile
+
+from tinap import Proxy
+from tinap.diagnostics import Diagnostics
+from tinap.profile import Profile
+from tinap.stats import STATS
+from tinap.tests.support import LoopTestCase, echo_server
+
+
+class TestDiagnostics(LoopTestCase):
+    def setUp(self):
+        STATS.reset()
+        super(TestDiagnostics, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super(TestDiagnostics, self).tearDown()
+        self.tmpdir.cleanup()
+        STATS.reset()
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_run(self):
+        async def _go():
+            server = await echo_server()
+            upstream = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            proxy = Proxy([upstream], Profile(rtt=200))
+            diagnostics = Diagnostics(
+                proxy.mappings, directory=self.tmpdir.name, duration=0.05
+            )
+            try:
+                async with proxy:
+                    reader, writer = await asyncio.open_connection(
+                        *proxy.addresses[0]
+                    )
+                    writer.write(b"hello")
+                    # the data is in the delay line
+                    await asyncio.sleep(0.05)
+                    first = diagnostics.run()
+                    await asyncio.sleep(0.1)
+                    second = diagnostics.run()
+                    self.assertEqual(await reader.read(5), b"hello")
+                    writer.close()
+                return first, second
+            finally:
+                diagnostics.close()
+                server.close()
+                await server.wait_closed()
+
+        first, second = self.loop.run_until_complete(_go())
+        state = self._read(first["state"])
+        self.assertIn("inflight=1", state)
+        self.assertIn("Tasks:", state)
+        self.assertIn("Baseline", self._read(first["alloc"]))
+        self.assertIn("Traced:", self._read(second["alloc"]))
+
+        # the first window was over, and the second one was written on close
+        for paths in (first, second):
+            self.assertTrue(os.path.exists(paths["profile"]))
+            self.assertIn("cumulative", self._read(paths["profile"] + ".txt"))
+        self.assertNotEqual(first["profile"], second["profile"])
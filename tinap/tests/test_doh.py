@@ -0,0 +1,553 @@
+import unittest
+import asyncio
+import multiprocessing
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import dns.message
+    import dns.rcode
+    import dns.rrset
+    from tinap.doh import (
+        AnswerCache,
+        DNSDatagramServer,
+        DNSResolver,
+        DNSStreamProtocol,
+        Prefetcher,
+        SharedAnswerCache,
+        Workers,
+        answer_wire,
+        create_cache,
+        proxy_parser_base,
+    )
+except ImportError:
+    dns = None
+
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import free_port, make_certificate, LoopTestCase
+
+
+def answer(name, ttl=60):
+    query = dns.message.make_query(name, "A")
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text(name, ttl, "IN", "A", "10.0.0.1"))
+    return query, response
+
+
+def _put(cache, name):
+    cache.put(answer(name)[1])
+
+
+@unittest.skipIf(dns is None, "dnspython and h2 are needed")
+class TestAnswerCache(unittest.TestCase):
+    def test_cache(self):
+        cache = AnswerCache(maxsize=1)
+        query, response = answer("example.com.")
+        self.assertIsNone(cache.get(query))
+        cache.put(response)
+
+        # new query id
+        query = dns.message.make_query("EXAMPLE.com.", "A")
+        cached = cache.get(query)
+        self.assertEqual(cached.id, query.id)
+        self.assertEqual(cached.answer, response.answer)
+        self.assertTrue(cached.answer[0].ttl <= 60)
+        self.assertIsNone(cache.get(dns.message.make_query("example.com.", "AAAA")))
+
+        # the least recently used answer is evicted
+        cache.put(answer("example.org.")[1])
+        self.assertIsNone(cache.get(query))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_not_cached(self):
+        cache = AnswerCache()
+        query, response = answer("example.com.", ttl=0)
+        cache.put(response)
+        query, response = answer("example.org.")
+        response.set_rcode(dns.rcode.SERVFAIL)
+        cache.put(response)
+        self.assertEqual(len(cache._cache), 0)
+
+    def test_shared(self):
+        cache = SharedAnswerCache(maxsize=16)
+        context = multiprocessing.get_context("fork")
+        worker = context.Process(target=_put, args=(cache, "example.com."))
+        worker.start()
+        worker.join()
+        query, response = answer("example.com.")
+        self.assertEqual(cache.get(query).answer, response.answer)
+
+        # answers bigger than a slot are not shared
+        for i in range(100):
+            response.answer[0].add(dns.rdata.from_text("IN", "A", "10.0.1.%d" % i))
+        cache.put(response)
+        self.assertEqual(len(cache.get(query).answer[0]), 1)
+
+
+class Resolver(asyncio.DatagramProtocol):
+    """Answers all the A queries with a TTL of 1s.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dns.message.from_wire(data)
+        self.queries.append(query)
+        name = query.question[0].name.to_text()
+        response = answer(name, ttl=1)[1]
+        response.id = query.id
+        self.transport.sendto(response.to_wire(), addr)
+
+
+@unittest.skipIf(dns is None, "dnspython and h2 are needed")
+class TestPrefetcher(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestPrefetcher, self).setUp()
+
+    def tearDown(self):
+        super(TestPrefetcher, self).tearDown()
+        STATS.reset()
+
+    def _run(self, test, **kw):
+        async def _go():
+            transport, resolver = await self.loop.create_datagram_endpoint(
+                Resolver, local_addr=("127.0.0.1", 0)
+            )
+            port = transport.get_extra_info("sockname")[1]
+            cache = AnswerCache()
+            prefetcher = Prefetcher(cache, "127.0.0.1", port, **kw)
+            try:
+                await test(cache, prefetcher, resolver)
+            finally:
+                transport.close()
+
+        self.loop.run_until_complete(_go())
+
+    def _hit(self, cache, prefetcher, name):
+        query = dns.message.make_query(name, "A")
+        dnsr = cache.get(query)
+        prefetcher.hit(query, dnsr)
+        return dnsr
+
+    def _store(self, cache, prefetcher, name):
+        response = answer(name, ttl=1)[1]
+        cache.put(response)
+        prefetcher.stored(response)
+
+    def test_refresh(self):
+        async def _test(cache, prefetcher, resolver):
+            self._store(cache, prefetcher, "example.com.")
+            # less than a second left, but not popular yet
+            self._hit(cache, prefetcher, "example.com.")
+            await asyncio.sleep(0.05)
+            self.assertEqual(resolver.queries, [])
+
+            self._hit(cache, prefetcher, "example.com.")
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(resolver.queries), 1)
+            self.assertEqual(STATS.counters["doh.prefetch.refreshed"], 1)
+            self._hit(cache, prefetcher, "example.com.")
+            self.assertEqual(STATS.counters["doh.prefetch.hits"], 1)
+
+        self._run(_test, fraction=0.5, min_hits=2)
+
+    def test_concurrency(self):
+        async def _test(cache, prefetcher, resolver):
+            names = ["a.example.com.", "b.example.com.", "c.example.com."]
+            for name in names:
+                self._store(cache, prefetcher, name)
+                self._hit(cache, prefetcher, name)
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(resolver.queries), 2)
+            self.assertEqual(STATS.counters["doh.prefetch.skipped"], 1)
+
+            # expired before it was refreshed
+            cache._cache.clear()
+            prefetcher.missed(dns.message.make_query(names[2], "A"))
+            self.assertEqual(STATS.counters["doh.prefetch.misses"], 1)
+
+        self._run(_test, fraction=0.5, min_hits=1, concurrency=2)
+
+
+@unittest.skipIf(dns is None, "dnspython and h2 are needed")
+class TestPlainDNS(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestPlainDNS, self).setUp()
+
+    def tearDown(self):
+        super(TestPlainDNS, self).tearDown()
+        STATS.reset()
+
+    def _run(self, test):
+        async def _go():
+            transport, upstream = await self.loop.create_datagram_endpoint(
+                Resolver, local_addr=("127.0.0.1", 0)
+            )
+            port = transport.get_extra_info("sockname")[1]
+            resolver = DNSResolver("127.0.0.1", port, cache=AnswerCache())
+            try:
+                await test(resolver, upstream)
+            finally:
+                transport.close()
+
+        self.loop.run_until_complete(_go())
+
+    def test_udp(self):
+        async def _test(resolver, upstream):
+            server = DNSDatagramServer(resolver)
+            await server.start("127.0.0.1", 0)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.setblocking(False)
+            try:
+                client.connect(server.sockets[0].getsockname())
+                queries = [dns.message.make_query("example.com.", "A") for i in range(3)]
+                for query in queries:
+                    client.send(query.to_wire())
+                    data = await self.loop.sock_recv(client, 65535)
+                    response = dns.message.from_wire(data)
+                    self.assertEqual(response.id, query.id)
+                    self.assertEqual(response.answer[0].name.to_text(), "example.com.")
+            finally:
+                client.close()
+                server.close()
+            # the other ones were cached
+            self.assertEqual(len(upstream.queries), 1)
+            self.assertEqual(STATS.counters["dns.udp.queries"], 3)
+
+        self._run(_test)
+
+    def test_tcp(self):
+        async def _test(resolver, upstream):
+            server = await self.loop.create_server(
+                lambda: DNSStreamProtocol(resolver), "127.0.0.1", 0
+            )
+            reader, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()
+            )
+            try:
+                names = ["a.example.com.", "b.example.com."]
+                queries = [dns.message.make_query(name, "A") for name in names]
+                # pipelined, in one segment
+                writer.write(
+                    b"".join(
+                        struct.pack("!H", len(wire)) + wire
+                        for wire in (query.to_wire() for query in queries)
+                    )
+                )
+                answers = {}
+                for i in range(2):
+                    size = struct.unpack("!H", await reader.readexactly(2))[0]
+                    response = dns.message.from_wire(await reader.readexactly(size))
+                    answers[response.id] = response.answer[0].name.to_text()
+                self.assertEqual(answers, {q.id: n for q, n in zip(queries, names)})
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+            self.assertEqual(STATS.counters["dns.tcp.queries"], 2)
+
+        self._run(_test)
+
+    def _tcp_server(self, resolver, connections=None):
+        return self.loop.create_server(
+            lambda: DNSStreamProtocol(resolver, connections), "127.0.0.1", 0
+        )
+
+    async def _tcp_answer(self, reader):
+        size = struct.unpack("!H", await reader.readexactly(2))[0]
+        return dns.message.from_wire(await reader.readexactly(size))
+
+    def test_errors(self):
+        class Failing(DNSResolver):
+            async def query(self, dnsq, clientip):
+                raise ValueError("boom")
+
+        resolver = Failing("127.0.0.1", 53)
+
+        async def _test():
+            server = DNSDatagramServer(resolver)
+            await server.start("127.0.0.1", 0)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.setblocking(False)
+            tcp = await self._tcp_server(resolver)
+            reader, writer = await asyncio.open_connection(
+                *tcp.sockets[0].getsockname()
+            )
+            try:
+                client.connect(server.sockets[0].getsockname())
+                query = dns.message.make_query("example.com.", "A")
+                client.send(query.to_wire())
+                data = await self.loop.sock_recv(client, 65535)
+                self.assertEqual(dns.message.from_wire(data).rcode(), dns.rcode.SERVFAIL)
+                wire = query.to_wire()
+                writer.write(struct.pack("!H", len(wire)) + wire)
+                response = await self._tcp_answer(reader)
+                self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+            finally:
+                client.close()
+                server.close()
+                writer.close()
+                tcp.close()
+                await tcp.wait_closed()
+            self.assertEqual(STATS.counters["dns.errors"], 2)
+
+        self.loop.run_until_complete(_test())
+
+    def test_upstream_timeout(self):
+        async def _test():
+            # never answers
+            silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            silent.bind(("127.0.0.1", 0))
+            resolver = DNSResolver(
+                "127.0.0.1", silent.getsockname()[1], timeout=0.05
+            )
+            server = DNSDatagramServer(resolver)
+            await server.start("127.0.0.1", 0)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.setblocking(False)
+            try:
+                client.connect(server.sockets[0].getsockname())
+                query = dns.message.make_query("example.com.", "A")
+                client.send(query.to_wire())
+                data = await asyncio.wait_for(self.loop.sock_recv(client, 65535), 5)
+            finally:
+                client.close()
+                server.close()
+                silent.close()
+            response = dns.message.from_wire(data)
+            self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+            # the client would discard an answer to another query
+            self.assertEqual(response.id, query.id)
+
+        self.loop.run_until_complete(_test())
+
+    def test_goaway(self):
+        class Slow(DNSResolver):
+            async def query(self, dnsq, clientip):
+                await released.wait()
+                return answer(dnsq.question[0].name.to_text())[1]
+
+        released = asyncio.Event()
+        connections = set()
+
+        async def _test():
+            server = await self._tcp_server(Slow("127.0.0.1", 53), connections)
+            reader, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()
+            )
+            try:
+
+                def _send(name):
+                    wire = dns.message.make_query(name, "A").to_wire()
+                    writer.write(struct.pack("!H", len(wire)) + wire)
+
+                _send("a.example.com.")
+                await asyncio.sleep(0.05)
+                for protocol in connections:
+                    protocol.goaway()
+                # ignored, the connection is draining
+                _send("b.example.com.")
+                await asyncio.sleep(0.05)
+                released.set()
+                response = await self._tcp_answer(reader)
+                self.assertEqual(response.answer[0].name.to_text(), "a.example.com.")
+                self.assertEqual(await asyncio.wait_for(reader.read(), 1), b"")
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+            self.assertEqual(STATS.counters["dns.tcp.queries"], 1)
+
+        self.loop.run_until_complete(_test())
+
+    def test_truncated(self):
+        query, response = answer("example.com.")
+        for i in range(100):
+            response.answer[0].add(dns.rdata.from_text("IN", "A", "10.0.1.%d" % i))
+        self.assertTrue(len(answer_wire(query, response, 65535)) > 512)
+        truncated = dns.message.from_wire(answer_wire(query, response, 512))
+        self.assertTrue(truncated.flags & dns.flags.TC)
+        self.assertEqual(truncated.answer, [])
+        failed = dns.message.from_wire(answer_wire(query, None, 512))
+        self.assertEqual(failed.rcode(), dns.rcode.SERVFAIL)
+
+
+class ThreadedResolver(threading.Thread):
+    """Answers all the A queries with a TTL of 60s, from a thread, so the
+    workers can use it while the test waits for them.
+    """
+
+    def __init__(self):
+        super(ThreadedResolver, self).__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.05)
+        self.port = self.sock.getsockname()[1]
+        self.queries = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            query = dns.message.from_wire(data)
+            response = answer(query.question[0].name.to_text())[1]
+            response.id = query.id
+            self.sock.sendto(response.to_wire(), addr)
+
+    def close(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+
+def udp_query(port, name):
+    query = dns.message.make_query(name, "A")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.sendto(query.to_wire(), ("127.0.0.1", port))
+        return dns.message.from_wire(sock.recv(65535))
+
+
+def tcp_query(port, name):
+    wire = dns.message.make_query(name, "A").to_wire()
+    with socket.create_connection(("127.0.0.1", port), timeout=2) as sock:
+        sock.sendall(struct.pack("!H", len(wire)) + wire)
+        data = b""
+        while len(data) < 2 or len(data) < 2 + struct.unpack("!H", data[:2])[0]:
+            chunk = sock.recv(65535)
+            if not chunk:
+                raise ConnectionResetError("closed before the answer")
+            data += chunk
+        return dns.message.from_wire(data[2:])
+
+
+@unittest.skipIf(dns is None, "dnspython and h2 are needed")
+@unittest.skipIf(shutil.which("openssl") is None, "needs the openssl command")
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        set_logger()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        cert, key = make_certificate(self.tmpdir.name)
+        self.upstream = ThreadedResolver()
+        self.upstream.start()
+        self.dns_port = free_port()
+        self.args = proxy_parser_base(port=443, secure=True).parse_args(
+            [
+                "--listen-address",
+                "127.0.0.1",
+                "--port",
+                str(free_port()),
+                "--certfile",
+                cert,
+                "--keyfile",
+                key,
+                "--upstream-resolver",
+                "127.0.0.1",
+                "--upstream-port",
+                str(self.upstream.port),
+                "--dns-port",
+                str(self.dns_port),
+                "--workers",
+                "2",
+                "--shared-cache",
+                "--drain-timeout",
+                "0.2",
+                "--level",
+                "WARNING",
+            ]
+        )
+        self.workers = Workers(self.args, create_cache(self.args))
+
+    def tearDown(self):
+        self.workers.stop()
+        self.upstream.close()
+        self.tmpdir.cleanup()
+
+    def test_workers(self):
+        self.assertTrue(self.workers.start())
+        self.assertEqual(len(self.workers.current), 2)
+        self.assertEqual(
+            udp_query(self.dns_port, "example.com.").answer[0].name.to_text(),
+            "example.com.",
+        )
+        # from different source ports, spread over the workers, which all
+        # get the answer from the shared cache
+        for i in range(20):
+            self.assertEqual(len(udp_query(self.dns_port, "example.com.").answer), 1)
+            self.assertEqual(len(tcp_query(self.dns_port, "example.com.").answer), 1)
+        self.assertEqual(self.upstream.queries, 1)
+
+        workers = list(self.workers.current)
+        self.workers.stop()
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+            self.assertIsNotNone(worker.exitcode)
+        self.assertEqual(
+            [p for p in multiprocessing.active_children() if p in workers], []
+        )
+
+    def _keep_querying(self, results, stop):
+        while not stop.is_set():
+            # like DNS clients, retry once when the connection is reset:
+            # the old workers reset the connections they didn't accept yet
+            for attempt in range(2):
+                try:
+                    tcp_query(self.dns_port, "example.com.")
+                    results["answered"] += 1
+                    break
+                except ConnectionRefusedError:
+                    results["refused"] += 1
+                    break
+                except OSError:
+                    results["errors"] += attempt
+
+    def test_rotation(self):
+        self.assertTrue(self.workers.start())
+        old = list(self.workers.current)
+        results = {"answered": 0, "refused": 0, "errors": 0}
+        stop = threading.Event()
+        client = threading.Thread(target=self._keep_querying, args=(results, stop))
+        client.start()
+        try:
+            time.sleep(0.2)
+            self.assertTrue(self.workers.start())
+            for worker in old:
+                worker.join(5)
+            time.sleep(0.2)
+        finally:
+            stop.set()
+            client.join()
+        self.assertFalse(any(worker.is_alive() for worker in old))
+        self.assertEqual(results["refused"], 0, results)
+        self.assertEqual(results["errors"], 0, results)
+        self.assertGreater(results["answered"], 0)
+
+    def test_failed_rotation(self):
+        self.assertTrue(self.workers.start())
+        old = list(self.workers.current)
+        # the new generation can't bind its plain DNS listener
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            sock.listen()
+            self.args.dns_port = sock.getsockname()[1]
+            self.assertFalse(self.workers.start())
+        self.assertEqual(self.workers.current, old)
+        self.assertTrue(all(worker.is_alive() for worker in old))
+        self.assertEqual(len(tcp_query(self.dns_port, "example.com.").answer), 1)
@@ -9,16 +9,21 @@ import sys
 import requests
 
 from tinap.tests.support import coserver
-from tinap import main
+from tinap import main, get_parser
 
 
-class FakeArgs:
-    port_mapping = "localhost:8887/localhost:8888"
-    rtt = 0.0
-    inkbps = 0.0
-    outkbps = 0.0
-    desthost = None
-    verbose = True
+def fake_args(**kw):
+    """Returns the raw command-line options, as main() parses them.
+    """
+    args = get_parser().parse_args([])
+    args.port_mapping = "localhost:8887/localhost:8888"
+    args.access_log = 1.0
+    args.verbose = True
+    for k, v in kw.items():
+        if not hasattr(args, k):
+            raise TypeError("Unknown option %r" % k)
+        setattr(args, k, v)
+    return args
 
 
 def ping(pid, queue):
@@ -38,9 +43,7 @@ class TestTinap(unittest.TestCase):
         old_loop = asyncio.get_event_loop()
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        args = FakeArgs()
-        for k, v in kw.items():
-            setattr(args, k, v)
+        args = fake_args(**kw)
 
         queue = multiprocessing.Queue()
         pinger = multiprocessing.Process(target=ping, args=(os.getpid(), queue))
@@ -72,6 +75,26 @@ class TestTinap(unittest.TestCase):
         # make sure we're getting the directory listing through tinap
         self.assertTrue("Directory listing" in resp.text)
 
+    @coserver()
+    def test_handshake(self):
+        duration, resp = self._run_test(rtt=500, handshake_rtts=2)
+        # two round trips for the handshake, one for the request
+        self.assertTrue(duration > 1.5, duration)
+        self.assertTrue(duration < 2.5, duration)
+        self.assertTrue("Directory listing" in resp.text)
+
+    @coserver()
+    def test_pool(self):
+        duration, resp = self._run_test(pool_min=2, pool_max=4)
+        self.assertTrue("Directory listing" in resp.text)
+
+    @coserver()
+    def test_limits(self):
+        duration, resp = self._run_test(
+            idle_timeout=10.0, max_lifetime=30.0, max_connections=1
+        )
+        self.assertTrue("Directory listing" in resp.text)
+
     @coserver()
     def test_kpbs(self):
         # this should be slow, but work
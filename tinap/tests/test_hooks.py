@@ -0,0 +1,117 @@
+import asyncio
+
+from tinap import Proxy
+from tinap.hooks import Hook, HookChain, connection_hooks, load_hook
+from tinap.profile import Profile
+from tinap.stats import STATS
+from tinap.tests.support import LoopTestCase, echo_server
+
+
+class Recorder(Hook):
+    hooks = []
+
+    def __init__(self, connection):
+        super(Recorder, self).__init__(connection)
+        self.received_chunks = []
+        self.released_chunks = []
+        self.closed_count = 0
+        self.hooks.append(self)
+
+    def received(self, direction, data):
+        self.received_chunks.append((direction, type(data), bytes(data)))
+        return data
+
+    def released(self, direction, data):
+        self.released_chunks.append((direction, bytes(data)))
+
+    def closed(self):
+        self.closed_count += 1
+
+
+class Upper(Hook):
+    def received(self, direction, data):
+        if direction == "in":
+            return bytes(data).upper()
+        return data
+
+
+class Drop(Hook):
+    def received(self, direction, data):
+        # the client's data is swallowed
+        if direction == "in":
+            return data[:0]
+        return data
+
+
+class TestHooks(LoopTestCase):
+    def setUp(self):
+        STATS.reset()
+        Recorder.hooks = []
+        super(TestHooks, self).setUp()
+
+    def tearDown(self):
+        super(TestHooks, self).tearDown()
+        STATS.reset()
+
+    def _exchange(self, data, **kw):
+        async def _go():
+            server = await echo_server()
+            upstream = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            try:
+                async with Proxy([upstream], **kw) as proxy:
+                    reader, writer = await asyncio.open_connection(
+                        *proxy.addresses[0]
+                    )
+                    writer.write(data)
+                    try:
+                        return await asyncio.wait_for(reader.read(1024), 0.3)
+                    except asyncio.TimeoutError:
+                        return None
+                    finally:
+                        writer.close()
+                        # the connection is lost on both sides
+                        await asyncio.sleep(0.05)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        return self.loop.run_until_complete(_go())
+
+    def test_hooks(self):
+        res = self._exchange(b"hello", hooks=[Upper, Recorder], profile=Profile(rtt=20))
+        self.assertEqual(res, b"HELLO")
+        hook = Recorder.hooks[0]
+        self.assertEqual(
+            hook.received_chunks,
+            [("in", bytes, b"HELLO"), ("out", memoryview, b"HELLO")],
+        )
+        self.assertEqual(hook.released_chunks, [("in", b"HELLO"), ("out", b"HELLO")])
+        self.assertEqual(hook.closed_count, 1)
+
+    def test_drop(self):
+        self.assertIsNone(self._exchange(b"hello", hooks=[Drop, Recorder]))
+        # the chain stops at the hook that dropped the data
+        self.assertEqual(Recorder.hooks[0].received_chunks, [])
+
+    def test_resolved_once(self):
+        def factory(connection):
+            if connection.port == 1:
+                return Hook(connection)
+            return None
+
+        class Connection:
+            port = 2
+
+        self.assertIsNone(connection_hooks((factory,), Connection()))
+        Connection.port = 1
+        self.assertIsInstance(connection_hooks((factory,), Connection()), Hook)
+        chain = connection_hooks((factory, Recorder), Connection())
+        self.assertIsInstance(chain, HookChain)
+
+    def test_load(self):
+        self.assertIs(load_hook("tinap.tests.test_hooks:Recorder"), Recorder)
+        self.assertIs(load_hook("tinap.hooks:Hook.received"), Hook.received)
+        with self.assertRaises(ValueError):
+            load_hook("tinap.hooks")
+        with self.assertRaises(AttributeError):
+            load_hook("tinap.hooks:Nope")
@@ -0,0 +1,230 @@
+import asyncio
+import time
+
+from tinap.forwarder import Forwarder
+from tinap.limits import (
+    AdmissionControl,
+    ConnectionLimit,
+    Reaper,
+    ACCEPTED,
+    WAITING,
+    REJECTED,
+    start_admission,
+    stop_admission,
+)
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import make_args, LoopTestCase
+
+
+class FakeConn:
+    def __init__(self, expired=None):
+        self.started = self.closed = False
+        self._expired = expired
+
+    def start(self):
+        self.started = True
+
+    admit = start
+
+    def expired(self, now):
+        return self._expired
+
+    def close(self):
+        self.closed = True
+
+
+class FakeThrottler:
+    backlog = 0
+
+
+class FakeMapping:
+    def __init__(self):
+        self.throttler = FakeThrottler()
+
+    def throttlers(self):
+        yield None, self.throttler
+
+
+class HalfClose(asyncio.Protocol):
+    """Answers once the client has half-closed.
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.data = b""
+
+    def data_received(self, data):
+        self.data += data
+
+    def eof_received(self):
+        self.transport.write(self.data.upper())
+        self.transport.close()
+
+
+class TestLimits(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        super(TestLimits, self).setUp()
+
+    def tearDown(self):
+        stop_admission()
+        super(TestLimits, self).tearDown()
+        STATS.reset()
+
+    def test_connection_limit(self):
+        limit = ConnectionLimit(1, backlog=1)
+        first, second, third = FakeConn(), FakeConn(), FakeConn()
+        self.assertEqual(limit.acquire(first), ACCEPTED)
+        self.assertEqual(limit.acquire(second), WAITING)
+        self.assertEqual(limit.acquire(third), REJECTED)
+        limit.release(first)
+        self.assertTrue(second.started)
+        self.assertEqual(len(limit), 1)
+        limit.release(second)
+        self.assertEqual(len(limit), 0)
+
+    def test_reaper(self):
+        reaper = Reaper(interval=0.01)
+        alive, idle = FakeConn(), FakeConn("idle")
+
+        async def _run():
+            reaper.add(alive)
+            reaper.add(idle)
+            await asyncio.sleep(0.05)
+            reaper.discard(alive)
+
+        self.loop.run_until_complete(_run())
+        self.assertTrue(idle.closed)
+        self.assertFalse(alive.closed)
+        self.assertEqual(len(reaper), 0)
+
+    def test_admission_lag(self):
+        admission = AdmissionControl([], max_lag=0.02, backlog=1, interval=0.01)
+        first, second = FakeConn(), FakeConn()
+
+        async def _run():
+            admission.start()
+            await asyncio.sleep(0.02)
+            self.assertFalse(admission.overloaded)
+            # the loop is blocked
+            time.sleep(0.2)
+            await asyncio.sleep(0.015)
+            self.assertTrue(admission.overloaded)
+            self.assertEqual(admission.acquire(first), WAITING)
+            self.assertEqual(admission.acquire(second), REJECTED)
+            await asyncio.sleep(0.2)
+            self.assertFalse(admission.overloaded)
+            admission.close()
+
+        self.loop.run_until_complete(_run())
+        self.assertTrue(first.started)
+        self.assertFalse(second.started)
+        self.assertEqual(len(admission), 0)
+        self.assertEqual(STATS.counters["admission.overloads"], 1)
+        self.assertEqual(STATS.counters["admission.rejected"], 1)
+
+    def test_admission_queued(self):
+        mapping = FakeMapping()
+        mapping.throttler.backlog = 2000
+        admission = start_admission([mapping], max_queued=1000, interval=0.01)
+
+        async def _run():
+            upstream = await self.loop.create_server(HalfClose, "127.0.0.1", 0)
+            uport = upstream.sockets[0].getsockname()[1]
+            server = await self.loop.create_server(
+                lambda: Forwarder("127.0.0.1", 0, "127.0.0.1", uport, make_args()),
+                "127.0.0.1",
+                0,
+            )
+            port = server.sockets[0].getsockname()[1]
+            try:
+                await asyncio.sleep(0.02)
+                self.assertTrue(admission.overloaded)
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"hello")
+                writer.write_eof()
+                read = asyncio.ensure_future(reader.read())
+                await asyncio.sleep(0.05)
+                self.assertFalse(read.done())
+                self.assertEqual(len(admission), 1)
+                # still above half of the limit
+                mapping.throttler.backlog = 600
+                await asyncio.sleep(0.03)
+                self.assertTrue(admission.overloaded)
+                mapping.throttler.backlog = 0
+                data = await asyncio.wait_for(read, 5)
+                writer.close()
+            finally:
+                server.close()
+                upstream.close()
+            return data
+
+        self.assertEqual(self.loop.run_until_complete(_run()), b"HELLO")
+        self.assertEqual(STATS.counters["admission.waiting"], 1)
+
+    def test_admission_rejected(self):
+        mapping = FakeMapping()
+        mapping.throttler.backlog = 2000
+        admission = start_admission(
+            [mapping], max_queued=1000, backlog=0, interval=0.01
+        )
+        limit = ConnectionLimit(1)
+
+        async def _run():
+            server = await self.loop.create_server(
+                lambda: Forwarder(
+                    "127.0.0.1", 0, "127.0.0.1", 1, make_args(), limit=limit
+                ),
+                "127.0.0.1",
+                0,
+            )
+            port = server.sockets[0].getsockname()[1]
+            try:
+                await asyncio.sleep(0.02)
+                self.assertTrue(admission.overloaded)
+                for i in range(3):
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+                    writer.close()
+                await asyncio.sleep(0.05)
+            finally:
+                server.close()
+
+        self.loop.run_until_complete(_run())
+        self.assertEqual(STATS.counters["admission.rejected"], 3)
+        # the rejected connections didn't free slots they never took
+        self.assertEqual(limit.active, 0)
+
+    def _forward(self, **kw):
+        async def _run():
+            upstream = await self.loop.create_server(HalfClose, "127.0.0.1", 0)
+            uport = upstream.sockets[0].getsockname()[1]
+            server = await self.loop.create_server(
+                lambda: Forwarder(
+                    "127.0.0.1", 0, "127.0.0.1", uport, make_args(**kw)
+                ),
+                "127.0.0.1",
+                0,
+            )
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"hello")
+                writer.write_eof()
+                data = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+            finally:
+                server.close()
+                upstream.close()
+            # every throttler task is gone
+            await asyncio.sleep(0.1)
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            return data, tasks
+
+        return self.loop.run_until_complete(_run())
+
+    def test_half_close(self):
+        data, tasks = self._forward(rtt=20)
+        self.assertEqual(data, b"HELLO")
+        self.assertEqual(tasks, [])
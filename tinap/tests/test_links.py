@@ -0,0 +1,81 @@
+import asyncio
+
+from tinap.mapping import Mapping
+from tinap.profile import ClientLinks, Profile
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import make_args, LoopTestCase, echo_server
+
+
+class TestClientLinks(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestClientLinks, self).setUp()
+
+    def tearDown(self):
+        super(TestClientLinks, self).tearDown()
+        STATS.reset()
+
+    def test_acquire(self):
+        links = ClientLinks("clients", Profile(rtt=100), idle_timeout=0.0)
+        first = links.acquire("10.0.0.1")
+        self.assertIs(links.acquire("10.0.0.1"), first)
+        self.assertIs(first.profile, links.profile)
+        second = links.acquire("10.0.0.2")
+        self.assertIsNot(second, first)
+        self.assertEqual(len(links), 2)
+
+        # still used by a connection
+        links.release(first)
+        links.release(second)
+        links.acquire("10.0.0.3")
+        self.assertEqual(len(links), 2)
+        links.release(first)
+        links.acquire("10.0.0.3")
+        self.assertEqual(len(links), 1)
+        self.assertEqual(STATS.counters["clients.evicted"], 2)
+
+    def test_idle(self):
+        links = ClientLinks("clients", Profile(), idle_timeout=60.0)
+        link = links.acquire("10.0.0.1")
+        links.release(link)
+        # back before the idle timeout
+        self.assertIs(links.acquire("10.0.0.1"), link)
+        links.release(link)
+        links.acquire("10.0.0.2")
+        self.assertEqual(len(links), 2)
+
+    def test_mapping(self):
+        links = ClientLinks("clients", Profile(), idle_timeout=0.0)
+
+        async def _go():
+            echo = await echo_server()
+            echo_port = echo.sockets[0].getsockname()[1]
+            mapping = Mapping(
+                "127.0.0.1", 0, "127.0.0.1", echo_port, make_args(), link=links
+            )
+            await mapping.start()
+            clients = []
+            try:
+                for host in ("127.0.0.1", "127.0.0.1", "127.0.0.2"):
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1", mapping.port, local_addr=(host, 0)
+                    )
+                    writer.write(b"ping")
+                    self.assertEqual(await reader.read(4), b"ping")
+                    clients.append(writer)
+                # one link per client address
+                self.assertEqual(len(links), 2)
+                self.assertEqual(STATS.counters["clients.links"], 2)
+                for writer in clients:
+                    writer.close()
+                    await writer.wait_closed()
+                await asyncio.sleep(0.1)
+            finally:
+                mapping.close()
+                echo.close()
+
+        self.loop.run_until_complete(_go())
+        links.acquire("10.0.0.1")
+        self.assertEqual(len(links), 1)
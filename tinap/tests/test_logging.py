@@ -0,0 +1,79 @@
+import asyncio
+import io
+import logging.handlers
+import threading
+
+from tinap.mapping import Mapping
+from tinap.util import set_logger, stop_logger
+from tinap.tests.support import make_args, LoopTestCase, echo_server
+
+
+class ThreadStream(io.StringIO):
+    """Remembers the threads writing into it.
+    """
+
+    def __init__(self):
+        super(ThreadStream, self).__init__()
+        self.threads = set()
+
+    def write(self, data):
+        self.threads.add(threading.current_thread())
+        return super(ThreadStream, self).write(data)
+
+
+class TestLogging(LoopTestCase):
+    def tearDown(self):
+        super(TestLogging, self).tearDown()
+        set_logger()
+
+    def test_background_thread(self):
+        set_logger()
+        stream = ThreadStream()
+        # configuring again replaces the previous handler
+        logger = set_logger(stream=stream)
+        logger.info("one %d", 1)
+        stop_logger()
+        self.assertEqual(stream.getvalue(), "one 1\n")
+        self.assertNotIn(threading.current_thread(), stream.threads)
+
+    def test_after_stop(self):
+        stream = ThreadStream()
+        logger = set_logger(stream=stream)
+        stop_logger()
+        # written right away, nothing is left in a queue
+        logger.info("two %d", 2)
+        self.assertEqual(stream.getvalue(), "two 2\n")
+        self.assertIn(threading.current_thread(), stream.threads)
+        self.assertFalse(
+            [h for h in logger.handlers if isinstance(h, logging.handlers.QueueHandler)]
+        )
+        stop_logger()
+        self.assertEqual(len(logger.handlers), 1)
+
+    def test_access_log(self):
+        stream = io.StringIO()
+        set_logger(stream=stream)
+
+        async def _go():
+            echo = await echo_server()
+            echo_port = echo.sockets[0].getsockname()[1]
+            mapping = Mapping(
+                "127.0.0.1", 0, "127.0.0.1", echo_port, make_args(access_log=1.0)
+            )
+            await mapping.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", mapping.port)
+                writer.write(b"ping")
+                await reader.readexactly(4)
+                writer.close()
+                await asyncio.sleep(0.05)
+            finally:
+                mapping.close()
+                echo.close()
+
+        self.loop.run_until_complete(_go())
+        stop_logger()
+        lines = stream.getvalue().splitlines()
+        access = [line for line in lines if " in=" in line]
+        self.assertEqual(len(access), 1, lines)
+        self.assertIn("in=4 out=4", access[0])
@@ -0,0 +1,70 @@
+import asyncio
+
+from tinap.pool import UpstreamPool
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import LoopTestCase
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+class Client(asyncio.Protocol):
+    def __init__(self):
+        self.received = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.received.set_result(data)
+
+
+class TestPool(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestPool, self).setUp()
+
+    def test_acquire(self):
+        async def _run():
+            server = await self.loop.create_server(Echo, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            pool = UpstreamPool("127.0.0.1", port, minsize=2, maxsize=3)
+            pool.start()
+            try:
+                while len(pool) < 2:
+                    await asyncio.sleep(0.01)
+                client = Client()
+                transport = pool.acquire(client)
+                self.assertIs(client.transport, transport)
+                transport.write(b"ping")
+                self.assertEqual(await client.received, b"ping")
+                transport.close()
+                # the pool refills itself
+                while len(pool) < 2:
+                    await asyncio.sleep(0.01)
+            finally:
+                pool.close()
+                server.close()
+                await server.wait_closed()
+
+        self.loop.run_until_complete(_run())
+        self.assertEqual(STATS.counters["pool.hits"], 1)
+        self.assertEqual(STATS.timings["pool.saved"].count, 1)
+
+    def test_miss(self):
+        async def _run():
+            pool = UpstreamPool("127.0.0.1", 1, minsize=0, maxsize=1)
+            pool.start()
+            self.assertIsNone(pool.acquire(Client()))
+            pool.close()
+            await asyncio.sleep(0)
+
+        self.loop.run_until_complete(_run())
+        self.assertEqual(STATS.counters["pool.misses"], 1)
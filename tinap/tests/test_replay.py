@@ -0,0 +1,114 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from tinap import Proxy
+from tinap.profile import Profile
+from tinap.replay import Archive, open_archive, close_archive
+from tinap.stats import STATS
+from tinap.tests.support import LoopTestCase
+
+
+async def _server(reader, writer):
+    # answers each line, and closes after "bye"
+    count = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        count += 1
+        writer.write(b"%d:%s" % (count, line))
+        if line == b"bye\n":
+            break
+    writer.close()
+
+
+class TestReplay(LoopTestCase):
+    def setUp(self):
+        STATS.reset()
+        super(TestReplay, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "archive")
+
+    def tearDown(self):
+        close_archive()
+        super(TestReplay, self).tearDown()
+        self.tmpdir.cleanup()
+        STATS.reset()
+
+    async def _exchanges(self, upstream, lines, **kw):
+        res = []
+        async with Proxy([upstream], **kw) as proxy:
+            reader, writer = await asyncio.open_connection(*proxy.addresses[0])
+            for line in lines:
+                writer.write(line)
+                res.append(await reader.readline())
+            # the upstream closes after bye
+            res.append(await reader.read())
+            writer.close()
+        return res
+
+    def _record(self, lines):
+        async def _go():
+            server = await asyncio.start_server(_server, "127.0.0.1", 0)
+            upstream = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            try:
+                return upstream, await self._exchanges(upstream, lines)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        open_archive(self.path)
+        try:
+            return self.loop.run_until_complete(_go())
+        finally:
+            close_archive()
+
+    def test_replay(self):
+        lines = [b"hello\n", b"world\n", b"bye\n"]
+        upstream, recorded = self._record(lines)
+        self.assertEqual(recorded, [b"1:hello\n", b"2:world\n", b"3:bye\n", b""])
+        self.assertEqual(STATS.counters["archive.recorded"], 3)
+
+        # the upstream is gone
+        archive = open_archive(self.path, replay=True)
+        self.assertEqual(len(archive), 3)
+        start = time.perf_counter()
+        replayed = self.loop.run_until_complete(
+            self._exchanges(upstream, lines, profile=Profile(rtt=100))
+        )
+        self.assertEqual(replayed, recorded)
+        # shaped like the upstream responses
+        self.assertGreater(time.perf_counter() - start, 0.29)
+        self.assertEqual(STATS.counters["archive.hits"], 3)
+
+    def test_miss(self):
+        upstream, recorded = self._record([b"bye\n"])
+        open_archive(self.path, replay=True)
+
+        async def _go():
+            async with Proxy([upstream]) as proxy:
+                reader, writer = await asyncio.open_connection(*proxy.addresses[0])
+                writer.write(b"hello\n")
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(reader.readline(), 0.1)
+                writer.close()
+
+        self.loop.run_until_complete(_go())
+        self.assertEqual(STATS.counters["archive.misses"], 1)
+
+    def test_truncated(self):
+        archive = Archive(self.path)
+        archive.append(b"a" * 16, b"first")
+        archive.append(b"b" * 16, b"second")
+        archive.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        archive = Archive(self.path, replay=True)
+        self.assertEqual(len(archive), 1)
+        response, flags = archive.get(b"a" * 16)
+        self.assertEqual(response.tobytes(), b"first")
+        self.assertIsNone(archive.get(b"b" * 16))
+        del response
+        archive.close()
@@ -0,0 +1,81 @@
+import asyncio
+import socket
+
+from tinap.sockopts import SocketOptions, MIN_BUFFER
+from tinap.profile import Profile
+from tinap.throttler import Throttler
+from tinap.util import set_logger
+from tinap.tests.support import LoopTestCase
+
+
+class FakeSource:
+    def __init__(self):
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+class TestSocketOptions(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        super(TestSocketOptions, self).setUp()
+
+    def test_buffer_sizes(self):
+        # 8000 kbps is 1MB/s (minus the TCP overhead), over 100ms
+        profile = Profile(rtt=100, inkbps=8000, outkbps=0)
+        sndbuf, rcvbuf = SocketOptions().buffer_sizes(profile, "in", "out")
+        self.assertEqual(sndbuf, int(profile.bandwidth["in"] * 0.1))
+        # unlimited, we keep the system default
+        self.assertEqual(rcvbuf, 0)
+        # no latency, the buffer is not smaller than MIN_BUFFER
+        profile.update(rtt=0)
+        self.assertEqual(
+            SocketOptions().buffer_sizes(profile, "in", "out"), (MIN_BUFFER, 0)
+        )
+        self.assertEqual(
+            SocketOptions(buffer_size=0).buffer_sizes(profile, "in", "out"), (0, 0)
+        )
+        self.assertRaises(ValueError, SocketOptions().update, buffer_size=-1)
+
+    def test_apply(self):
+        profile = Profile(rtt=100, inkbps=8000, outkbps=8000)
+        sndbuf, __ = SocketOptions().buffer_sizes(profile, "out", "in")
+
+        async def _go():
+            server = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                SocketOptions().apply(writer.transport, profile, "out", "in")
+                sock = writer.get_extra_info("socket")
+                return (
+                    sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                    writer.transport.get_write_buffer_limits()[1],
+                )
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+
+        nodelay, actual_sndbuf, high = self.loop.run_until_complete(_go())
+        self.assertTrue(nodelay)
+        # the kernel may round or double it
+        self.assertTrue(actual_sndbuf >= sndbuf)
+        self.assertEqual(high, sndbuf)
+
+    def test_pause_writing(self):
+        source = FakeSource()
+        throttler = Throttler("test", None, Profile(), "in", source=source)
+        throttler.pause_writing()
+        self.assertTrue(source.paused)
+        # still paused while the queue is congested
+        throttler._follow(True)
+        throttler.resume_writing()
+        self.assertTrue(source.paused)
+        throttler._follow(False)
+        self.assertFalse(source.paused)
@@ -0,0 +1,121 @@
+import unittest
+import asyncio
+
+from tinap.socks import (
+    parse_socks_greeting,
+    parse_socks_request,
+    parse_http_connect,
+    socks_reply,
+    HandshakeError,
+    CONNECTION_REFUSED,
+)
+from tinap.mapping import Mapping
+from tinap.stats import STATS
+from tinap.util import set_logger
+from tinap.tests.support import make_args, LoopTestCase, echo_server
+
+
+class TestParsers(unittest.TestCase):
+    def test_socks(self):
+        self.assertEqual(parse_socks_greeting(b"\x05\x02"), 0)
+        self.assertEqual(parse_socks_greeting(b"\x05\x02\x02\x00"), 4)
+        self.assertRaises(HandshakeError, parse_socks_greeting, b"\x05\x01\x02")
+
+        request = b"\x05\x01\x00\x03\x09localhost\x00\x50"
+        self.assertEqual(parse_socks_request(request), ("localhost", 80, 16))
+        self.assertIsNone(parse_socks_request(request[:-1]))
+        request = b"\x05\x01\x00\x01\x7f\x00\x00\x01\x1f\x90"
+        self.assertEqual(parse_socks_request(request), ("127.0.0.1", 8080, 10))
+        request = b"\x05\x01\x00\x04" + b"\x00" * 15 + b"\x01\x01\xbb"
+        self.assertEqual(parse_socks_request(request), ("::1", 443, 22))
+        # BIND is not supported
+        request = b"\x05\x02\x00\x01\x7f\x00\x00\x01\x1f\x90"
+        self.assertRaises(HandshakeError, parse_socks_request, request)
+
+    def test_http(self):
+        request = b"CONNECT example.com:443 HTTP/1.1\r\nHost: example.com\r\n\r\n"
+        self.assertEqual(
+            parse_http_connect(request), ("example.com", 443, len(request))
+        )
+        self.assertIsNone(parse_http_connect(request[:-2]))
+        self.assertEqual(
+            parse_http_connect(b"CONNECT [::1]:443 HTTP/1.1\r\n\r\n")[:2], ("::1", 443)
+        )
+        try:
+            parse_http_connect(b"GET / HTTP/1.1\r\n\r\n")
+        except HandshakeError as e:
+            self.assertTrue(e.reply.startswith(b"HTTP/1.1 405"))
+        else:
+            raise AssertionError("GET accepted")
+        self.assertRaises(
+            HandshakeError, parse_http_connect, b"CONNECT nope HTTP/1.1\r\n\r\n"
+        )
+
+
+class TestProxy(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestProxy, self).setUp()
+
+    def _run(self, client):
+        async def _go():
+            echo = await echo_server()
+            echo_port = echo.sockets[0].getsockname()[1]
+            mapping = Mapping(
+                "127.0.0.1", 0, None, None, make_args(rtt=50), protocol="proxy"
+            )
+            await mapping.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", mapping.port)
+                try:
+                    return await asyncio.wait_for(
+                        client(reader, writer, echo_port), 5
+                    )
+                finally:
+                    writer.close()
+            finally:
+                mapping.close()
+                echo.close()
+                await echo.wait_closed()
+
+        return self.loop.run_until_complete(_go())
+
+    def test_socks(self):
+        async def client(reader, writer, port):
+            # the greeting and the request are split
+            writer.write(b"\x05\x01\x00\x05\x01\x00\x03\x09local")
+            await asyncio.sleep(0.01)
+            writer.write(b"host" + port.to_bytes(2, "big") + b"ping")
+            auth = await reader.readexactly(2)
+            reply = await reader.readexactly(10)
+            return auth, reply, await reader.readexactly(4)
+
+        auth, reply, data = self._run(client)
+        self.assertEqual(auth, b"\x05\x00")
+        self.assertEqual(reply, socks_reply(0))
+        self.assertEqual(data, b"ping")
+        self.assertEqual(STATS.counters["proxy.socks"], 1)
+
+    def test_http_connect(self):
+        async def client(reader, writer, port):
+            start = self.loop.time()
+            writer.write(b"CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n" % port)
+            status = await reader.readuntil(b"\r\n\r\n")
+            duration = self.loop.time() - start
+            writer.write(b"ping")
+            return status, duration, await reader.readexactly(4)
+
+        status, duration, data = self._run(client)
+        self.assertTrue(status.startswith(b"HTTP/1.1 200"))
+        # the reply is delayed like the data, by half of the RTT
+        self.assertTrue(duration >= 0.024, duration)
+        self.assertEqual(data, b"ping")
+
+    def test_refused(self):
+        async def client(reader, writer, port):
+            writer.write(b"\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x01")
+            await reader.readexactly(2)
+            return await reader.read()
+
+        self.assertEqual(self._run(client), socks_reply(CONNECTION_REFUSED))
@@ -0,0 +1,90 @@
+import unittest
+import importlib.util
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from tinap.tests.support import HERE, free_port
+
+# the DoH server needs them
+HAS_DOH = all(importlib.util.find_spec(name) for name in ("dns", "h2"))
+
+# only imported when the matching options are used
+LAZY = (
+    "json",
+    "cProfile",
+    "tracemalloc",
+    "dns",
+    "h2",
+    "tinap.capture",
+    "tinap.config",
+    "tinap.control",
+    "tinap.coordinator",
+    "tinap.doh",
+    "tinap.pool",
+    "tinap.socks",
+    "tinap.udp",
+)
+
+# only imported by the DoH server with --workers or --shared-cache
+DOH_LAZY = ("mmap", "multiprocessing")
+
+# seconds to import tinap and listen. make bench checks a tighter budget,
+# this one only catches a startup gone badly wrong on a loaded machine
+BUDGET = 5.0
+
+
+def _env():
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(HERE))
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (root, env.get("PYTHONPATH")) if path
+    )
+    return env
+
+
+def _imported(module):
+    code = "import sys, %s; print(' '.join(sorted(sys.modules)))" % module
+    out = subprocess.check_output([sys.executable, "-c", code], env=_env())
+    return set(out.decode().split())
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        modules = _imported("tinap")
+        self.assertEqual([name for name in LAZY if name in modules], [])
+
+    @unittest.skipIf(not HAS_DOH, "dnspython and h2 are needed")
+    def test_doh_lazy_imports(self):
+        modules = _imported("tinap.doh")
+        self.assertEqual([name for name in DOH_LAZY if name in modules], [])
+
+    def test_budget(self):
+        port = free_port()
+        code = "import sys, tinap; sys.exit(tinap.main())"
+        command = [sys.executable, "-c", code, "--port", str(port)]
+        command += ["--upstream-port", str(port + 1)]
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, env=_env(), stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < BUDGET:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                    break
+                except OSError:
+                    self.assertIsNone(proc.poll())
+                    time.sleep(0.01)
+            else:
+                self.fail("tinap is not listening after %.1fs" % BUDGET)
+        finally:
+            # the signal handlers are set once the listeners are bound
+            time.sleep(0.05)
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
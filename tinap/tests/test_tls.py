@@ -0,0 +1,68 @@
+import unittest
+import asyncio
+import shutil
+import socket
+import ssl
+import tempfile
+
+from tinap.stats import STATS
+from tinap.tls import create_context, count_handshake
+from tinap.tests.support import make_certificate, LoopTestCase
+
+
+class Hello(asyncio.Protocol):
+    def connection_made(self, transport):
+        count_handshake(transport)
+        transport.write(b"x")
+
+
+def handshakes(port, count):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    session = None
+    for i in range(count):
+        sock = ctx.wrap_socket(
+            socket.create_connection(("127.0.0.1", port)), session=session
+        )
+        sock.recv(1)
+        session = sock.session
+        sock.close()
+
+
+@unittest.skipIf(shutil.which("openssl") is None, "needs the openssl command")
+class TestTLS(LoopTestCase):
+    def setUp(self):
+        STATS.reset()
+        super(TestTLS, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cert, self.key = make_certificate(self.tmpdir.name)
+
+    def tearDown(self):
+        super(TestTLS, self).tearDown()
+        self.tmpdir.cleanup()
+        STATS.reset()
+
+    def _handshakes(self, count, **kw):
+        ctx = create_context([(self.cert, self.key)], **kw)
+
+        async def _go():
+            server = await self.loop.create_server(Hello, "127.0.0.1", 0, ssl=ctx)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                await self.loop.run_in_executor(None, handshakes, port, count)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        self.loop.run_until_complete(_go())
+
+    def test_resumption(self):
+        self._handshakes(3)
+        self.assertEqual(STATS.counters["tls.full"], 1)
+        self.assertEqual(STATS.counters["tls.resumed"], 2)
+
+    def test_no_tickets(self):
+        self._handshakes(2, tickets=0)
+        self.assertEqual(STATS.counters["tls.full"], 2)
+        self.assertEqual(STATS.counters["tls.resumed"], 0)
@@ -0,0 +1,139 @@
+import asyncio
+import socket
+import time
+
+from tinap.mapping import Mapping
+from tinap.limits import REAPER
+from tinap.stats import STATS
+from tinap.udp import MIN_QUEUE
+from tinap.util import set_logger
+from tinap.tests.support import make_args, LoopTestCase
+
+
+class EchoProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class TestUDP(LoopTestCase):
+    def setUp(self):
+        set_logger()
+        STATS.reset()
+        super(TestUDP, self).setUp()
+
+    def _run(self, args, datagrams, clients=1):
+        async def _go():
+            echo, __ = await self.loop.create_datagram_endpoint(
+                EchoProtocol, local_addr=("127.0.0.1", 0)
+            )
+            upstream_port = echo.get_extra_info("sockname")[1]
+            mapping = Mapping(
+                "127.0.0.1", 0, "127.0.0.1", upstream_port, args, protocol="udp"
+            )
+            await mapping.start()
+            socks = []
+            try:
+                for i in range(clients):
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.setblocking(False)
+                    socks.append(sock)
+                    for data in datagrams:
+                        sock.sendto(data, ("127.0.0.1", mapping.port))
+                start = time.time()
+                res = []
+                for sock in socks:
+                    for data in datagrams:
+                        res.append(await self.loop.sock_recv(sock, 2048))
+                duration = time.time() - start
+                flows = len(mapping.server.flows)
+            finally:
+                for sock in socks:
+                    sock.close()
+                mapping.close()
+                echo.close()
+            return res, duration, flows
+
+        return self.loop.run_until_complete(_go())
+
+    def test_echo(self):
+        datagrams = [b"one", b"two", b"three"]
+        res, duration, flows = self._run(make_args(rtt=100), datagrams, clients=2)
+        self.assertEqual(res, datagrams * 2)
+        self.assertEqual(flows, 2)
+        # the latency is applied once per datagram and direction, not per
+        # datagram in a row
+        self.assertTrue(0.09 < duration < 0.3, duration)
+        self.assertEqual(STATS.counters["udp.flows"], 2)
+
+    def test_default_queue(self):
+        async def _go():
+            echo, __ = await self.loop.create_datagram_endpoint(
+                EchoProtocol, local_addr=("127.0.0.1", 0)
+            )
+            upstream_port = echo.get_extra_info("sockname")[1]
+            # 10KB/s: without a bound, the burst would queue for 15s
+            args = make_args(rtt=100, inkbps=80, outkbps=80)
+            mapping = Mapping(
+                "127.0.0.1", 0, "127.0.0.1", upstream_port, args, protocol="udp"
+            )
+            await mapping.start()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                for i in range(100):
+                    sock.sendto(b"x" * 1400, ("127.0.0.1", mapping.port))
+                    if i % 10 == 0:
+                        await asyncio.sleep(0)
+                await asyncio.sleep(0.1)
+                flow = list(mapping.server.flows.values())[0]
+                return flow.data_in.backlog
+            finally:
+                sock.close()
+                mapping.close()
+                echo.close()
+
+        backlog = self.loop.run_until_complete(_go())
+        self.assertTrue(STATS.counters["udp.dropped"] > 0)
+        self.assertTrue(backlog <= MIN_QUEUE + 1400, backlog)
+
+    def test_max_flows(self):
+        async def _go():
+            args = make_args(max_connections=1)
+            mapping = Mapping("127.0.0.1", 0, "127.0.0.1", 9, args, protocol="udp")
+            await mapping.start()
+            socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in (1, 2)]
+            try:
+                for sock in socks:
+                    sock.sendto(b"x", ("127.0.0.1", mapping.port))
+                await asyncio.sleep(0.05)
+                return len(mapping.server.flows)
+            finally:
+                for sock in socks:
+                    sock.close()
+                mapping.close()
+
+        self.assertEqual(self.loop.run_until_complete(_go()), 1)
+        self.assertEqual(STATS.counters["limits.rejected"], 1)
+
+    def test_expiry(self):
+        async def _go():
+            args = make_args(udp_timeout=0.1)
+            mapping = Mapping("127.0.0.1", 0, "127.0.0.1", 9, args, protocol="udp")
+            await mapping.start()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.sendto(b"x", ("127.0.0.1", mapping.port))
+                await asyncio.sleep(0.05)
+                before = len(mapping.server.flows)
+                await asyncio.sleep(0.1)
+                REAPER._sweep()
+                after = len(mapping.server.flows)
+            finally:
+                sock.close()
+                mapping.close()
+            return before, after
+
+        self.assertEqual(self.loop.run_until_complete(_go()), (1, 0))
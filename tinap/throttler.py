@@ -1,58 +1,278 @@
 # encoding: utf-8
 import asyncio
+import collections
 import time
 
+from tinap.stats import STATS
+
+# marks the end of the stream, i.e. a half-close.
+EOF = object()
+
 
 class BandwidthControl:
-    """Adds delays to limit the bandwidth, given a max bps.
+    """Adds delays to limit the bandwidth, given a max bytes per second.
+
+    Each chunk reserves the link for the time it takes to send it, so a
+    BandwidthControl can be shared by several Throttlers to emulate a
+    link shared by several connections.
     """
 
-    def __init__(self, maxbps):
-        self.last_tick = time.perf_counter()
-        self.maxbps = maxbps * 1000.0 / 8.0
+    __slots__ = ("next_free",)
 
-    def _max_sendable(self):
-        elapsed = time.perf_counter() - self.last_tick
-        return elapsed * self.maxbps
+    def __init__(self):
+        self.next_free = time.perf_counter()
 
-    async def available(self, data):
-        if self.maxbps == 0:
+    async def available(self, data, maxbps):
+        if maxbps == 0:
             return
-        extra = len(data) - self._max_sendable()
-        if extra > 0:
-            await asyncio.sleep(float(extra) / float(self.maxbps))
-        self.last_tick = time.perf_counter()
+        now = time.perf_counter()
+        self.next_free = max(now, self.next_free) + len(data) / float(maxbps)
+        delay = self.next_free - now
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 
 class Throttler:
-    def __init__(self, name, transport, latency, bandwidth):
-        self._data = asyncio.Queue()
-        if bandwidth == 0:
-            self._ctrl = None
-        else:
-            self._ctrl = BandwidthControl(bandwidth)
-        self.latency = latency
+    """Emulates one direction of a link.
+
+    Chunks go through a bottleneck queue served at the `profile`
+    bandwidth of the `direction` ("in" or "out"), then through a delay
+    line of the profile latency before they are written to `transport`.
+    The delay line is pipelined, so consecutive chunks don't add up their
+    latencies.
+
+    When a queue `discipline` is provided (see tinap.bottleneck) and it
+    reports congestion, `source` is paused until the queue recovers. It's
+    also paused while `transport` can't take more data, see
+    pause_writing().
+
+    Throttlers of connections sharing the same link get the same
+    `bandwidth_control`.
+
+    When `capture` is provided (see tinap.capture), the chunks are
+    recorded as they are released. `hooks` (see tinap.hooks) are called
+    as well.
+    """
+
+    __slots__ = (
+        "_data",
+        "_ctrl",
+        "profile",
+        "direction",
+        "transport",
+        "name",
+        "discipline",
+        "source",
+        "backlog",
+        "_paused",
+        "_congested",
+        "_write_paused",
+        "_loop",
+        "_inflight",
+        "_release_handle",
+        "_finished",
+        "_started",
+        "_stopping",
+        "_task",
+        "capture",
+        "hooks",
+    )
+
+    def __init__(
+        self,
+        name,
+        transport,
+        profile,
+        direction,
+        discipline=None,
+        source=None,
+        bandwidth_control=None,
+        capture=None,
+        hooks=None,
+    ):
+        # idle connections are common: the task, the timers and the
+        # futures are only created when there's something to wait for.
+        self._data = collections.deque()
+        self._ctrl = bandwidth_control
+        self.profile = profile
+        self.direction = direction
         self.transport = transport
         self.name = name
-        self.finished = asyncio.Event()
+        self.discipline = discipline
+        self.source = source
+        self.backlog = 0
+        self._paused = False
+        self._congested = False
+        self._write_paused = False
+        self._loop = asyncio.get_event_loop()
+        self._inflight = collections.deque()
+        self._release_handle = None
+        self._finished = None
+        self._started = False
+        self._stopping = False
+        self._task = None
+        self.capture = capture
+        self.hooks = hooks
 
     def start(self):
-        asyncio.ensure_future(self._dequeue())
+        self._started = True
+        self._wakeup()
 
     async def stop(self):
+        """Waits for everything queued to be written.
+        """
+        if not self._started:
+            # never started, there's nowhere to write to
+            self.abort()
+            return
+        if self._finished is None:
+            self._finished = self._loop.create_future()
         self.put(None)
-        await self.finished.wait()
+        await self._finished
+
+    def abort(self):
+        """Drops everything queued, and stops right away.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._release_handle is not None:
+            self._release_handle.cancel()
+            self._release_handle = None
+        self._inflight.clear()
+        self._data.clear()
+        self.backlog = 0
+        self._started = False
+        self._finish()
+
+    def _finish(self):
+        if self._finished is not None and not self._finished.done():
+            self._finished.set_result(None)
+
+    def busy(self):
+        return self.backlog > 0 or bool(self._inflight)
+
+    def queue_state(self):
+        """Returns the bytes and the chunks waiting in the queue, the
+        chunks in the delay line, and whether the source is paused.
+        """
+        return self.backlog, len(self._data), len(self._inflight), self._paused
 
     def put(self, data):
-        self._data.put_nowait(data)
+        now = self._loop.time()
+        self._data.append((now, data))
+        if data is not None and data is not EOF:
+            self.backlog += len(data)
+            if self.discipline is not None:
+                self._follow(self.discipline.enqueue(now, self.backlog))
+        if self._task is None:
+            self._wakeup()
 
-    async def _dequeue(self):
-        while True:
-            data = await self._data.get()
-            if data is None:
-                break
-            await asyncio.sleep(self.latency)
-            if self._ctrl is not None:
-                await self._ctrl.available(data)
+    def _follow(self, congested):
+        if congested == self._congested:
+            return
+        self._congested = congested
+        if congested:
+            STATS.incr("queue.pauses")
+        self._update_source()
+
+    def pause_writing(self):
+        """Called when the write buffer of `transport` is full.
+
+        The data then waits in the queue, where it's shaped, instead of
+        piling up below us.
+        """
+        self._write_paused = True
+        self._update_source()
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._update_source()
+
+    def _update_source(self):
+        paused = self._congested or self._write_paused
+        if self.source is None or paused == self._paused:
+            return
+        self._paused = paused
+        if paused:
+            self.source.pause_reading()
+        else:
+            self.source.resume_reading()
+
+    def put_eof(self):
+        """Half-closes the transport once everything queued is written.
+        """
+        self.put(EOF)
+
+    def _write(self, data):
+        if data is not EOF:
+            if self.capture is not None:
+                self.capture.released(self.direction, data)
+            if self.hooks is not None:
+                self.hooks.released(self.direction, data)
             self.transport.write(data)
-        self.finished.set()
+        elif self.transport.can_write_eof():
+            self.transport.write_eof()
+
+    def _schedule(self, when, data):
+        if not self._inflight and when <= self._loop.time():
+            self._write(data)
+            return
+        self._inflight.append((when, data))
+        if self._release_handle is None:
+            self._release_handle = self._loop.call_at(when, self._release)
+
+    def _release(self):
+        now = self._loop.time()
+        inflight = self._inflight
+        while inflight and inflight[0][0] <= now:
+            when, data = inflight.popleft()
+            # how late we are compared to the emulated link
+            STATS.timing("shaping.lateness", now - when)
+            self._write(data)
+        if inflight:
+            self._release_handle = self._loop.call_at(inflight[0][0], self._release)
+            return
+        self._release_handle = None
+        if self._stopping:
+            self._finish()
+
+    def _wakeup(self):
+        if not self._started or not self._data:
+            return
+        if self.profile.bandwidth[self.direction] > 0:
+            self._task = asyncio.ensure_future(self._dequeue())
+            return
+        # no bandwidth limit, nothing to wait for
+        while self._data and self._task is None:
+            arrival, data = self._data.popleft()
+            self._forward(arrival, data)
+
+    def _forward(self, arrival, data):
+        if data is None:
+            self._stopping = True
+            if not self._inflight:
+                self._finish()
+            return
+        if data is EOF:
+            self._schedule(self._loop.time() + self.profile.latency, data)
+            return
+        now = self._loop.time()
+        self.backlog -= len(data)
+        STATS.timing("queue.sojourn", now - arrival)
+        if self.discipline is not None:
+            self._follow(self.discipline.dequeue(now, now - arrival, self.backlog))
+        self._schedule(now + self.profile.latency, data)
+
+    async def _dequeue(self):
+        queue = self._data
+        while queue:
+            arrival, data = queue.popleft()
+            # the profile can change at any time
+            bandwidth = self.profile.bandwidth[self.direction]
+            if bandwidth > 0 and data is not None and data is not EOF:
+                if self._ctrl is None:
+                    self._ctrl = BandwidthControl()
+                await self._ctrl.available(data, bandwidth)
+            self._forward(arrival, data)
+        self._task = None
@@ -0,0 +1,73 @@
+# encoding: utf-8
+"""TLS contexts of the DoH listener.
+
+A full handshake costs an ECDHE exchange and a signature, resuming a
+session with a ticket skips the signature. Tickets are encrypted with
+keys that OpenSSL draws when the context is created, and Python can't
+set them: to share the keys between processes, the context has to be
+created before they're forked, and rotating the keys means creating a
+new context.
+
+OpenSSL's stateful session cache can't be used from Python for server
+side resumption, so tickets are the only way to resume sessions.
+"""
+import getpass
+import ssl
+
+from tinap.stats import STATS
+
+CIPHERS = "ECDHE+AESGCM"
+
+
+class Passphrase:
+    """Asks once for the passphrase of the keys, the first time a key
+    needs one. It's used as the *password* of load_cert_chain(), so new
+    contexts can be created without asking again.
+    """
+
+    def __init__(self, prompt="Enter PEM pass phrase: "):
+        self.prompt = prompt
+        self._value = None
+
+    def __call__(self):
+        if self._value is None:
+            self._value = getpass.getpass(self.prompt)
+        return self._value
+
+
+def create_context(certs, password=None, http2=False, tickets=2, ciphers=CIPHERS):
+    """Creates a server context.
+
+    - certs: list of (certfile, keyfile). An RSA and an ECDSA certificate
+      can both be loaded, ECDSA is then used with the clients that
+      support it. Its signatures are a lot cheaper.
+    - password: passed to load_cert_chain().
+    - tickets: session tickets sent after a TLS 1.3 handshake. 0
+      disables session resumption.
+    """
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    for certfile, keyfile in certs:
+        ctx.load_cert_chain(certfile, keyfile=keyfile, password=password)
+    if http2:
+        ctx.set_alpn_protocols(["h2"])
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.options |= ssl.OP_NO_COMPRESSION
+    if tickets > 0:
+        ctx.num_tickets = tickets
+    else:
+        ctx.options |= ssl.OP_NO_TICKET
+        ctx.num_tickets = 0
+    ctx.set_ciphers(ciphers)
+    return ctx
+
+
+def count_handshake(transport):
+    """Counts the handshake of *transport* as full or resumed.
+    """
+    ssl_object = transport.get_extra_info("ssl_object")
+    if ssl_object is None:
+        return
+    if ssl_object.session_reused:
+        STATS.incr("tls.resumed")
+    else:
+        STATS.incr("tls.full")
@@ -0,0 +1,292 @@
+# encoding: utf-8
+"""UDP port forwarding, for QUIC (HTTP/3) and DNS traffic.
+
+Each client address gets a flow, with its own upstream socket and the
+same latency/bandwidth model as TCP connections, applied per datagram.
+When the bottleneck queue is congested, datagrams are dropped like a
+router would. Without --queue-limit, the queue of a shaped flow holds a
+few bandwidth-delay products, instead of growing without limit.
+
+Sockets are read directly from the event loop, draining up to
+BATCH_SIZE datagrams per wakeup, and datagrams due at the same time are
+sent in a row by the Throttler. This needs a selector event loop.
+"""
+import asyncio
+import socket
+
+from tinap.bottleneck import create_discipline
+from tinap.throttler import Throttler
+from tinap.limits import REAPER, get_admission
+from tinap.resolver import Resolver
+from tinap.sockopts import bdp
+from tinap.stats import STATS
+from tinap.util import get_logger
+
+BATCH_SIZE = 64
+MAX_DATAGRAM = 65535
+
+# default bottleneck queue of a shaped flow: that many bandwidth-delay
+# products, and at least MIN_QUEUE bytes
+QUEUE_BDPS = 4
+MIN_QUEUE = 65536
+
+
+def drain(sock, callback, batch=BATCH_SIZE):
+    """Reads up to *batch* datagrams from *sock*, and calls
+    callback(data, addr) for each one of them.
+    """
+    for i in range(batch):
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # e.g. a previous datagram was refused by the upstream
+            STATS.incr("udp.errors")
+            return
+        callback(data, addr)
+
+
+class DatagramSender:
+    """Transport-like object for Throttlers, sending each chunk as a
+    datagram.
+    """
+
+    __slots__ = ("sock", "addr")
+
+    def __init__(self, sock, addr=None):
+        self.sock = sock
+        self.addr = addr
+
+    def write(self, data):
+        try:
+            if self.addr is None:
+                self.sock.send(data)
+            else:
+                self.sock.sendto(data, self.addr)
+        except (BlockingIOError, InterruptedError):
+            STATS.incr("udp.dropped")
+        except OSError:
+            STATS.incr("udp.errors")
+
+
+class Gate:
+    """Stands for the sender of a Throttler: when the queue is congested,
+    the gate is closed and datagrams are dropped.
+    """
+
+    __slots__ = ("open",)
+
+    def __init__(self):
+        self.open = True
+
+    def pause_reading(self):
+        self.open = False
+
+    def resume_reading(self):
+        self.open = True
+
+
+class UDPFlow:
+    """Datagrams exchanged between one client address and the upstream.
+    """
+
+    __slots__ = (
+        "forwarder",
+        "addr",
+        "link",
+        "loop",
+        "sock",
+        "in_gate",
+        "out_gate",
+        "data_in",
+        "data_out",
+        "last_activity",
+    )
+
+    def __init__(self, forwarder, addr):
+        self.forwarder = forwarder
+        self.addr = addr
+        self.loop = forwarder.loop
+        self.sock = socket.socket(forwarder.upstream_family, socket.SOCK_DGRAM)
+        try:
+            self.sock.setblocking(False)
+            self.sock.connect(forwarder.upstream_addr)
+        except OSError:
+            self.sock.close()
+            raise
+        self.link = None
+        if forwarder.link is not None:
+            self.link = forwarder.link.acquire(addr[0])
+        self.in_gate = Gate()
+        self.out_gate = Gate()
+        self.data_in = forwarder.create_throttler(
+            "udp-up", DatagramSender(self.sock), "in", self.in_gate, self.link
+        )
+        self.data_out = forwarder.create_throttler(
+            "udp-down",
+            DatagramSender(forwarder.sock, addr),
+            "out",
+            self.out_gate,
+            self.link,
+        )
+        self.data_in.start()
+        self.data_out.start()
+        self.last_activity = self.loop.time()
+        self.loop.add_reader(
+            self.sock.fileno(), drain, self.sock, self._upstream_received
+        )
+        REAPER.add(self)
+
+    def received(self, data):
+        self.last_activity = self.loop.time()
+        if self.in_gate.open:
+            self.data_in.put(data)
+        else:
+            STATS.incr("udp.dropped")
+
+    def _upstream_received(self, data, addr):
+        self.last_activity = self.loop.time()
+        if self.out_gate.open:
+            self.data_out.put(data)
+        else:
+            STATS.incr("udp.dropped")
+
+    def expired(self, now):
+        if now - self.last_activity > self.forwarder.timeout:
+            return "udp_idle"
+        return None
+
+    def close(self):
+        REAPER.discard(self)
+        self.forwarder.flows.pop(self.addr, None)
+        if self.link is not None:
+            self.forwarder.link.release(self.link)
+            self.link = None
+        self.loop.remove_reader(self.sock.fileno())
+        self.data_in.abort()
+        self.data_out.abort()
+        self.sock.close()
+
+
+class UDPForwarder:
+    """Listens on *host*:*port* and forwards datagrams to the upstream.
+
+    It has the same close()/wait_closed() API as an asyncio Server.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        upstream_host,
+        upstream_port,
+        args,
+        profile,
+        link=None,
+        resolver=None,
+    ):
+        self.host = host
+        self.port = port
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.args = args
+        self.profile = profile
+        self.link = link
+        if resolver is None:
+            resolver = Resolver()
+        self.resolver = resolver
+        self.timeout = args.udp_timeout
+        self.max_flows = args.max_connections
+        self.flows = {}
+        self.sock = None
+        self.sockets = []
+        self.loop = asyncio.get_event_loop()
+        self.logger = get_logger()
+
+    async def start(self):
+        infos = await self.resolver.getaddrinfo(
+            self.upstream_host, self.upstream_port, type=socket.SOCK_DGRAM
+        )
+        self.upstream_family, __, __, __, self.upstream_addr = infos[0]
+        infos = await self.loop.getaddrinfo(
+            self.host,
+            self.port,
+            type=socket.SOCK_DGRAM,
+            flags=socket.AI_PASSIVE,
+        )
+        family, type_, proto, __, address = infos[0]
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            sock.bind(address)
+            self.loop.add_reader(sock.fileno(), drain, sock, self._received)
+        except NotImplementedError:
+            sock.close()
+            raise NotImplementedError("UDP mappings need a selector event loop")
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        self.sockets = [sock]
+
+    def queue_limit(self, direction):
+        """Returns the bottleneck queue size of the flows, in bytes.
+        """
+        if self.args.queue_limit > 0:
+            return self.args.queue_limit
+        if not self.profile.bandwidth[direction]:
+            # nothing is queued
+            return 0
+        return max(QUEUE_BDPS * bdp(self.profile, direction), MIN_QUEUE)
+
+    def create_throttler(self, name, sender, direction, gate, link=None):
+        discipline = create_discipline(
+            self.args.queue_discipline,
+            self.queue_limit(direction),
+            self.args.codel_target,
+            self.args.codel_interval,
+        )
+        control = None
+        if link is not None:
+            control = link.controls[direction]
+        return Throttler(
+            name,
+            sender,
+            self.profile,
+            direction,
+            discipline=discipline,
+            source=gate,
+            bandwidth_control=control,
+        )
+
+    def _received(self, data, addr):
+        flow = self.flows.get(addr)
+        if flow is None:
+            if self.max_flows > 0 and len(self.flows) >= self.max_flows:
+                STATS.incr("limits.rejected")
+                return
+            admission = get_admission()
+            if admission is not None and admission.overloaded:
+                STATS.incr("admission.rejected")
+                return
+            try:
+                flow = UDPFlow(self, addr)
+            except OSError as e:
+                self.logger.debug("Could not create a UDP flow: %s" % e)
+                STATS.incr("udp.errors")
+                return
+            self.flows[addr] = flow
+            STATS.incr("udp.flows")
+        flow.received(data)
+
+    def close(self):
+        for flow in list(self.flows.values()):
+            flow.close()
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    async def wait_closed(self):
+        pass
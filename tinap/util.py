@@ -1,59 +1,127 @@
 # Utilities
 import asyncio
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
-UPSTREAMS = []
+UPSTREAMS = set()
 
 
 def append_upstream(upstream):
-    UPSTREAMS.append(upstream)
+    UPSTREAMS.add(upstream)
 
 
 def remove_upstream(upstream):
-    UPSTREAMS.remove(upstream)
+    UPSTREAMS.discard(upstream)
+
+
+_CAPTURE = None
+
+
+def set_capture(capture):
+    """Sets the running tinap.capture.Capture, or None.
+
+    Kept here so the data path can look it up without importing
+    tinap.capture when nothing is captured.
+    """
+    global _CAPTURE
+    _CAPTURE = capture
+
+
+def get_capture():
+    """Returns the running Capture, or None.
+    """
+    return _CAPTURE
 
 
 def sync_shutdown(servers, *args, **kw):
     """Called on any SIGTERM/SIGINT to gracefully shutdown tinap.
     """
-    for upstream in UPSTREAMS:
+    for upstream in list(UPSTREAMS):
         upstream.close()
     for server in servers:
         server.close()
     return 1
 
 
+def cancel_tasks(loop):
+    """Cancels the tasks still running on *loop*, and waits for them.
+    """
+    tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
 async def shutdown(servers):
     """Called on any SIGTERM/SIGKILL to gracefully shutdown tinap.
     """
     sync_shutdown(servers)
 
 
-_DNS_CACHE = {}
-
+_LOGGER = None
+_HANDLER = None
+_LISTENER = None
 
-async def resolve(host, port=80):
-    if host in _DNS_CACHE:
-        return _DNS_CACHE[host]
-    addrinfo = await asyncio.get_event_loop().getaddrinfo(host, port)
-    _DNS_CACHE[host] = addrinfo[0][4][0]
-    return _DNS_CACHE[host]
 
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # the message is formatted in the listener thread. That's fine as
+        # long as the arguments are not modified after the call, which is
+        # the case in tinap (strings and numbers).
+        return record
 
-_LOGGER = None
 
+def set_logger(level=logging.INFO, stream=None):
+    """Configures the tinap logger.
 
-def set_logger(level=logging.INFO):
-    global _LOGGER
+    Records are queued, then formatted and written to *stream* (stderr by
+    default) from a background thread, so a slow terminal can't stall the
+    event loop.
+    """
+    global _LOGGER, _HANDLER, _LISTENER
+    stop_logger()
     _LOGGER = logging.getLogger("tinap")
     _LOGGER.setLevel(level)
-    ch = logging.StreamHandler()
+    if _HANDLER is not None:
+        _LOGGER.removeHandler(_HANDLER)
+    records = queue.SimpleQueue()
+    ch = logging.StreamHandler(stream)
     ch.setLevel(level)
-    _LOGGER.addHandler(ch)
+    _LISTENER = QueueListener(records, ch, respect_handler_level=True)
+    _LISTENER.start()
+    _HANDLER = _QueueHandler(records)
+    _LOGGER.addHandler(_HANDLER)
     return _LOGGER
 
 
+def stop_logger():
+    """Writes the pending records, and stops the logging thread.
+
+    The next records are written directly, instead of piling up in a
+    queue nobody reads.
+    """
+    global _HANDLER, _LISTENER
+    if _LISTENER is None:
+        return
+    _LISTENER.stop()
+    _LOGGER.removeHandler(_HANDLER)
+    _HANDLER = _LISTENER.handlers[0]
+    _LOGGER.addHandler(_HANDLER)
+    _LISTENER = None
+
+
+atexit.register(stop_logger)
+
+
 def get_logger():
+    """Returns the tinap logger.
+
+    When tinap is embedded and set_logger() was not called, the records
+    go to the handlers configured by the application.
+    """
     if _LOGGER is None:
-        raise Exception("Logging not configured yet")
+        return logging.getLogger("tinap")
     return _LOGGER
@@ -1,3 +1,8 @@
 openssl genrsa -des3 -out private_key.pem 2048
 openssl req -new -sha256 -key private_key.pem -out server.csr
 openssl req -x509 -sha256 -days 365 -key private_key.pem -in server.csr -out server.pem
+
+# ECDSA (P-256): cheaper handshakes, use with --ecdsa-certfile/--ecdsa-keyfile
+openssl ecparam -name prime256v1 -genkey -noout -out ecdsa_key.pem
+openssl req -new -sha256 -key ecdsa_key.pem -out ecdsa.csr
+openssl req -x509 -sha256 -days 365 -key ecdsa_key.pem -in ecdsa.csr -out ecdsa.pem